@@ -0,0 +1,208 @@
+'''
+Admission control for expensive routes
+
+Every limited route gets a number of concurrent requests per worker
+process and a token bucket per client, keyed by the client address or
+by the subject of the bearer token once it has been verified. A request
+that finds no free slot within ADMISSION_QUEUE_TIMEOUT seconds gets a
+503, a client that has used up its bucket gets a 429; both carry a
+Retry-After header and are counted in jobportal_admission_shed_total.
+
+ADMISSION_LIMITS maps "METHOD rule" to its limits and replaces
+DEFAULT_LIMITS; in the environment it is given as JSON:
+
+    ADMISSION_LIMITS='{"GET /vacancies": {"concurrency": 4, "rate": 20,
+                                          "burst": 40}}'
+
+"rate" is in requests per second. An empty mapping turns admission
+control off.
+'''
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import g, jsonify, request
+
+from auth import AuthError, parse_auth_header
+from metrics import metrics
+
+DEFAULT_LIMITS = {
+    'GET /vacancies': {
+        'concurrency': 2, 'rate': 5, 'burst': 20},
+    'GET /vacancies/<int:vacancy_id>/applications': {
+        'concurrency': 2, 'rate': 5, 'burst': 20},
+    'GET /candidates/<int:candidate_id>/applications': {
+        'concurrency': 2, 'rate': 5, 'burst': 20}
+}
+QUEUE_TIMEOUT = 0.0
+RETRY_AFTER = 1
+# The least recently used buckets are dropped when a route tracks more
+# clients than this
+MAX_CLIENTS = 10000
+
+metrics.describe('admission_shed_total', 'counter',
+                 'Requests rejected by admission control.')
+metrics.describe('admission_in_flight', 'gauge',
+                 'Requests holding a slot of a limited route.')
+
+
+class RouteLimit:
+    def __init__(self, concurrency=None, rate=None, burst=None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or rate
+        self.slots = threading.BoundedSemaphore(concurrency) \
+            if concurrency else None
+        self.active = 0
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, client, now):
+        '''Takes a token of `client` and returns 0, or the seconds until
+        the next token when the bucket is empty.'''
+        if not self.rate:
+            return 0
+        with self.lock:
+            tokens, updated = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self.buckets[client] = (tokens - 1, now)
+                wait = 0
+            else:
+                self.buckets[client] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            self.buckets.move_to_end(client)
+            if len(self.buckets) > MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def acquire(self, timeout):
+        if self.slots is None:
+            return True
+        if not self.slots.acquire(timeout=timeout):
+            return False
+        with self.lock:
+            self.active += 1
+        return True
+
+    def release(self):
+        if self.slots is None:
+            return
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+
+def client_key(address=None):
+    '''Subject of the bearer token if the token has already been verified
+    in this app context (see auth.get_verified_payload), else the client
+    address. Public routes never verify tokens, and anybody can make up
+    tokens with new subjects, so unverified subjects are not used.
+    `address` replaces the address of the request, for the requests of a
+    batch whose headers come from the client.'''
+    try:
+        token = parse_auth_header(request.headers.get('Authorization'))
+    except (AuthError, IndexError):
+        token = None
+    payload = g.get('verified_tokens', {}).get(token) if token else None
+    if payload and payload.get('sub'):
+        return 'sub:' + str(payload['sub'])
+    return address or client_address()
+
+
+def client_address():
+    # the last address is the one added by the proxy in front of the app
+    route = request.access_route
+    return 'addr:' + str(route[-1] if route else request.remote_addr)
+
+
+def _shed(status, message, retry_after, route, reason):
+    metrics.inc('admission_shed_total', {'method': request.method,
+                                         'route': route, 'reason': reason})
+    response = jsonify({
+      'success': False,
+      'error': status,
+      'message': message
+    })
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, int(math.ceil(
+        retry_after))))
+    return response
+
+
+def _in_flight_gauges(limits):
+    def collect():
+        return [('admission_in_flight',
+                 {'method': key.split(' ', 1)[0],
+                  'route': key.split(' ', 1)[1]}, limit.active)
+                for key, limit in limits.items()
+                if limit.slots is not None]
+    return collect
+
+
+class Admission:
+    '''The limits of the routes of an app'''
+
+    def __init__(self, limits, queue_timeout, retry_after):
+        self.limits = limits
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+    def admit(self, method, rule, client):
+        '''Applies the limits of `rule` to a request of `client`. Returns
+        (response, None) when the request is shed, else (None, limit)
+        where limit holds a slot to release() after the request, or is
+        None when the route has no concurrency limit.'''
+        limit = self.limits.get(method + ' ' + rule)
+        if limit is None:
+            return None, None
+        wait = limit.take(client, time.monotonic())
+        if wait:
+            return _shed(429, 'Too many requests', wait, rule, 'rate'), None
+        if not limit.acquire(self.queue_timeout):
+            return _shed(503, 'Service unavailable', self.retry_after,
+                         rule, 'concurrency'), None
+        return None, limit
+
+
+def setup_admission(app):
+    configured = app.config.get(
+        'ADMISSION_LIMITS', os.environ.get('ADMISSION_LIMITS'))
+    if configured is None:
+        configured = DEFAULT_LIMITS
+    elif isinstance(configured, str):
+        configured = json.loads(configured)
+    limits = {key: RouteLimit(**settings)
+              for key, settings in configured.items() if settings}
+    if not limits:
+        return
+
+    queue_timeout = float(app.config.get(
+        'ADMISSION_QUEUE_TIMEOUT',
+        os.environ.get('ADMISSION_QUEUE_TIMEOUT', QUEUE_TIMEOUT)))
+    retry_after = float(app.config.get(
+        'ADMISSION_RETRY_AFTER',
+        os.environ.get('ADMISSION_RETRY_AFTER', RETRY_AFTER)))
+    admission = Admission(limits, queue_timeout, retry_after)
+    # also applied to the requests of a POST /batch (see batch.py)
+    app.extensions['admission'] = admission
+    metrics.register_gauges(_in_flight_gauges(limits))
+
+    @app.before_request
+    def admit_request():
+        rule = request.url_rule
+        if rule is None:
+            return
+        shed, limit = admission.admit(request.method, rule.rule,
+                                      client_key())
+        if shed is not None:
+            return shed
+        g.admission_limit = limit
+
+    @app.teardown_request
+    def release_slot(exception=None):
+        limit = g.pop('admission_limit', None)
+        if limit is not None:
+            limit.release()
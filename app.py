@@ -6,30 +6,93 @@ from flask import (
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import func
+from sqlalchemy.orm import contains_eager, load_only, undefer, \
+  undefer_group
 from models import (
   setup_db,
+  db,
   Company,
   Candidate,
   Vacancy,
-  Application
+  Application,
+  ApplicationRollup,
+  parse_datetime
 )
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from auth import (
   AuthError,
+  check_company,
   requires_auth
 )
-import math
+from admission import setup_admission
+from autocomplete import setup_autocomplete
+from batch import setup_batch
+from events import setup_events
+from facets import setup_vacancy_facets
+from fieldsets import company_fieldset, vacancy_fieldset
+from idempotency import setup_idempotency
+from metrics import setup_metrics
+from profiling import setup_profiling
+from querystats import setup_query_stats
+from salaries import setup_salary_stats
+from similar import setup_similar_vacancies
+from sync import setup_delta_sync
+from traffic import setup_traffic_capture
 import os
 import sys
 
 ITEMS_PER_PAGE = 10
+STATS_DAYS = 90
+MAX_IDS = 100
+
+
+def requested_ids(max_ids):
+    '''Ids of a multi-get (`?ids=1,2,3`) in request order without
+    duplicates, or None if the request has no ids parameter'''
+    value = request.args.get('ids')
+    if value is None:
+        return None
+    try:
+        ids = list(dict.fromkeys(
+            int(part) for part in value.split(',') if part.strip()))
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > max_ids:
+        abort(400)
+    return ids
+
+
+def in_request_order(rows, ids):
+    '''Orders the rows of an IN query like the requested ids and
+    returns them with the ids that were not found'''
+    found = {row.id: row for row in rows}
+    return [found[id] for id in ids if id in found], \
+        [id for id in ids if id not in found]
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
     CORS(app, resources={r'/*': {'origin': '*'}})
+    setup_traffic_capture(app)
+    setup_query_stats(app)
+    setup_metrics(app, db)
+    setup_profiling(app)
+    setup_idempotency(app, db)
+    setup_admission(app)
+    setup_batch(app, db)
+    setup_salary_stats(app, db)
+    setup_vacancy_facets(app, db)
+    setup_autocomplete(app, db)
+    setup_similar_vacancies(app, db)
+    setup_delta_sync(app)
+    setup_events(app)
+    max_ids = int(app.config.get(
+        'MULTI_GET_MAX_IDS', os.environ.get('MULTI_GET_MAX_IDS', MAX_IDS)))
 
     # set up an Access-Control-Allow decorator
     @app.after_request
@@ -59,7 +122,21 @@ def create_app(test_config=None):
     # Get all companies
     @app.route('/companies', methods=['GET'])
     def get_companies():
-        companies = Company.query.all()
+        # Get several companies by id (?ids=1,2,3)
+        ids = requested_ids(max_ids)
+        if ids is not None:
+            fieldset = company_fieldset()
+            companies, missing = in_request_order(fieldset.query(
+              Company.query.options(undefer_group('text'))).filter(
+              Company.id.in_(ids)).all(), ids)
+
+            return jsonify({
+              'success': True,
+              'companies': fieldset.format(companies, Company.format),
+              'missing': missing
+            })
+
+        companies = Company.query.options(load_only('id', 'name')).all()
 
         company_list = {company.id: company.name for company in companies}
 
@@ -71,14 +148,66 @@ def create_app(test_config=None):
     # Get company details by company id
     @app.route('/companies/<int:company_id>', methods=['GET'])
     def get_company_details(company_id):
-        company = Company.query.filter(Company.id == company_id).one_or_none()
+        fieldset = company_fieldset()
+        company = fieldset.query(Company.query.options(
+          undefer_group('text'))).filter(
+          Company.id == company_id).one_or_none()
 
         if company is None:
             abort(404)
 
         return jsonify({
           'success': True,
-          'company': company.format()
+          'company': fieldset.format([company], Company.format)[0]
+        })
+
+    # Get hiring statistics of a company, read from the rollups
+    @app.route('/companies/<int:company_id>/stats', methods=['GET'])
+    @requires_auth('get:candidates')
+    def get_company_stats(payload, company_id):
+        check_company(company_id, payload)
+        if db.session.query(Company.id).filter(
+          Company.id == company_id).scalar() is None:
+            abort(404)
+
+        per_vacancy = db.session.query(
+          ApplicationRollup.vacancy_id,
+          func.sum(ApplicationRollup.applications),
+          func.min(ApplicationRollup.first_submitted),
+          func.max(ApplicationRollup.date_posted)).filter(
+          ApplicationRollup.company_id == company_id).group_by(
+          ApplicationRollup.vacancy_id).order_by(
+          ApplicationRollup.vacancy_id).all()
+
+        since = date.today() - timedelta(days=STATS_DAYS - 1)
+        per_day = db.session.query(
+          ApplicationRollup.day,
+          func.sum(ApplicationRollup.applications)).filter(
+          ApplicationRollup.company_id == company_id,
+          ApplicationRollup.day >= since).group_by(
+          ApplicationRollup.day).order_by(ApplicationRollup.day).all()
+
+        vacancies = [{
+          'vacancy_id': vacancy_id,
+          'applications': applications,
+          # time from posting to the first application
+          'first_application_seconds': max(0, int(
+            (first - posted).total_seconds())) if first and posted else None
+        } for vacancy_id, applications, first, posted in per_vacancy]
+        delays = [vacancy['first_application_seconds']
+                  for vacancy in vacancies
+                  if vacancy['first_application_seconds'] is not None]
+        average_delay = sum(delays) // len(delays) if delays else None
+
+        return jsonify({
+          'success': True,
+          'company_id': company_id,
+          'vacancies': vacancies,
+          'applications_per_day': [{
+            'day': day.isoformat(),
+            'applications': applications
+          } for day, applications in per_day],
+          'average_first_application_seconds': average_delay
         })
 
     # Add a new company profile
@@ -129,7 +258,8 @@ def create_app(test_config=None):
     @app.route('/companies/<int:company_id>', methods=['PATCH'])
     @requires_auth('patch:companies')
     def update_company(payload, company_id):
-        company = Company.query.filter(Company.id == company_id).one_or_none()
+        company = Company.query.options(undefer_group('text')).filter(
+          Company.id == company_id).one_or_none()
 
         if company is None:
             abort(404)
@@ -187,6 +317,22 @@ def create_app(test_config=None):
     '''
     CANDIDATE
     '''
+    # View several candidate profiles by id (?ids=1,2,3)
+    @app.route('/candidates', methods=['GET'])
+    def get_candidates():
+        ids = requested_ids(max_ids)
+        if ids is None:
+            abort(400)
+
+        candidates, missing = in_request_order(
+          Candidate.query.filter(Candidate.id.in_(ids)).all(), ids)
+
+        return jsonify({
+          'success': True,
+          'candidates': [candidate.format() for candidate in candidates],
+          'missing': missing
+        })
+
     # View candidate profile by id
     @app.route('/candidates/<int:candidate_id>', methods=['GET'])
     def get_candidate_details(candidate_id):
@@ -211,7 +357,7 @@ def create_app(test_config=None):
 
             new_name = body.get('name')
             new_surname = body.get('surname')
-            new_date_of_birth = body.get('date_of_birth')
+            new_date_of_birth = parse_datetime(body.get('date_of_birth'))
             new_city = body.get('city')
             new_region = body.get('region')
             new_email = body.get('email')
@@ -264,9 +410,9 @@ def create_app(test_config=None):
 
             body = request.get_json()
             candidate.name = body.get('name', candidate.name)
-            candidate.surname = body.get('surname', candidate.name)
-            candidate.date_of_birth = body.get(
-              'date_of_birth', candidate.date_of_birth)
+            candidate.surname = body.get('surname', candidate.surname)
+            candidate.date_of_birth = parse_datetime(body.get(
+              'date_of_birth', candidate.date_of_birth))
             candidate.city = body.get('city', candidate.city)
             candidate.region = body.get('region', candidate.region)
             candidate.email = body.get('email', candidate.email)
@@ -321,10 +467,26 @@ def create_app(test_config=None):
     # Get the list of vacancies
     @app.route('/vacancies', methods=['GET'])
     def get_vacancies():
-        vacancies = Vacancy.query.join(
-          Company, Vacancy.company_id == Company.id).all()
+        # Get details of several vacancies by id (?ids=1,2,3)
+        # Only some fields (?fields=...) and related data (?include=...)
+        fieldset = vacancy_fieldset()
+        query = Vacancy.query
 
-        vacancy_short_list = [vacancy.format_short() for vacancy in vacancies]
+        ids = requested_ids(max_ids)
+        if ids is not None:
+            vacancies, missing = in_request_order(fieldset.query(
+              query.options(undefer_group('text'))).filter(
+              Vacancy.id.in_(ids)).all(), ids)
+
+            return jsonify({
+              'success': True,
+              'vacancies': fieldset.format(vacancies, Vacancy.format_long),
+              'missing': missing
+            })
+
+        vacancies = fieldset.query(query).all()
+
+        vacancy_short_list = fieldset.format(vacancies, Vacancy.format_short)
 
         return jsonify({
           'success': True,
@@ -334,16 +496,17 @@ def create_app(test_config=None):
     # Get details of a vacancy by id
     @app.route('/vacancies/<int:vacancy_id>', methods=['GET'])
     def get_vacancy_details(vacancy_id):
-        vacancy = Vacancy.query.join(
-          Company, Vacancy.company_id == Company.id). \
-          filter(Vacancy.id == vacancy_id).one_or_none()
+        fieldset = vacancy_fieldset()
+        vacancy = fieldset.query(Vacancy.query.options(
+          undefer_group('text'))).filter(
+          Vacancy.id == vacancy_id).one_or_none()
 
         if vacancy is None:
             abort(404)
 
         return jsonify({
           'success': True,
-          'vacancy': vacancy.format_long()
+          'vacancy': fieldset.format([vacancy], Vacancy.format_long)[0]
         })
 
     # Add a new vacancy
@@ -386,7 +549,7 @@ def create_app(test_config=None):
     @requires_auth('patch:vacancies')
     def update_vacancy(payload, vacancy_id):
         try:
-            vacancy = Vacancy.query.filter(
+            vacancy = Vacancy.query.options(undefer_group('text')).filter(
               Vacancy.id == vacancy_id
             ).one_or_none()
 
@@ -441,16 +604,26 @@ def create_app(test_config=None):
     @app.route('/candidates/<int:candidate_id>/applications', methods=['GET'])
     @requires_auth('get:applications')
     def get_applications_by_candidate_id(payload, candidate_id):
-        applications = Application.query.join(
-          Vacancy, Application.vacancy_id == Vacancy.id) \
-          .join(Candidate, Application.candidate_id == Candidate.id) \
-          .join(Company, Application.company_id == Company.id) \
-          .filter(Application.candidate_id == candidate_id).all()
-
         # Pagination
         page = request.args.get('page', 1, type=int)
-        start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
+        if page < 1:
+            abort(404)
+
+        applications = Application.query.join(
+          Vacancy, Application.vacancy_id == Vacancy.id).join(
+          Candidate, Application.candidate_id == Candidate.id).join(
+          Company, Application.company_id == Company.id).options(
+          contains_eager(Application.vacancies),
+          contains_eager(Application.candidate),
+          contains_eager(Application.companies),
+          undefer(Application.cover_letter)).filter(
+          Application.candidate_id == candidate_id).order_by(
+          Application.id).limit(ITEMS_PER_PAGE).offset(
+          (page - 1) * ITEMS_PER_PAGE).all()
+
+        # Raise error if pagination fetches no applications
+        if not applications:
+            abort(404)
 
         applications_list = [{
           'application_id': application.id,
@@ -462,30 +635,36 @@ def create_app(test_config=None):
           'date_submitted': application.date_submitted
         } for application in applications]
 
-        # Raise error if pagination fetches no applications
-        if page > math.ceil(len(applications_list) / ITEMS_PER_PAGE):
-            abort(404)
-
         return jsonify({
           'success': True,
-          'applications_list': applications_list[start:end],
-          'number_applications': len(applications_list)
+          'applications_list': applications_list,
+          'number_applications': applications[0].candidate.application_count
         })
 
     # Get the list of applications by vacancy id (for companies)
     @app.route('/vacancies/<int:vacancy_id>/applications', methods=['GET'])
     @requires_auth('get:candidates')
     def get_applications_by_vacancy_id(payload, vacancy_id):
-        applications = Application.query.join(
-          Vacancy, Application.vacancy_id == Vacancy.id) \
-          .join(Candidate, Application.candidate_id == Candidate.id) \
-          .join(Company, Application.company_id == Company.id) \
-          .filter(Vacancy.id == vacancy_id).all()
-
         # Pagination
         page = request.args.get('page', 1, type=int)
-        start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
+        if page < 1:
+            abort(404)
+
+        applications = Application.query.join(
+          Vacancy, Application.vacancy_id == Vacancy.id).join(
+          Candidate, Application.candidate_id == Candidate.id).join(
+          Company, Application.company_id == Company.id).options(
+          contains_eager(Application.vacancies),
+          contains_eager(Application.candidate),
+          contains_eager(Application.companies),
+          undefer(Application.cover_letter)).filter(
+          Vacancy.id == vacancy_id).order_by(
+          Application.id).limit(ITEMS_PER_PAGE).offset(
+          (page - 1) * ITEMS_PER_PAGE).all()
+
+        # Raise error if pagination fetches no applications
+        if not applications:
+            abort(404)
 
         applications_list = [{
           'vacancy_id': application.vacancies.id,
@@ -497,14 +676,10 @@ def create_app(test_config=None):
           'date_submitted': application.date_submitted
         } for application in applications]
 
-        # Raise error if pagination fetches no applications
-        if page > math.ceil(len(applications_list) / ITEMS_PER_PAGE):
-            abort(404)
-
         return jsonify({
           'success': True,
-          'applications_list': applications_list[start:end],
-          'number_applications': len(applications_list)
+          'applications_list': applications_list,
+          'number_applications': applications[0].vacancies.application_count
         })
 
     # Add a new application by vacancy id
@@ -608,6 +783,15 @@ def create_app(test_config=None):
           'message': 'Bad request'
         }), 400
 
+    # Error handler for 410 ("Gone")
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+          'success': False,
+          'error': 410,
+          'message': 'Gone'
+        }), 410
+
     # Error handler for 406 ("Not acceptable")
     @app.errorhandler(406)
     def not_acceptable(error):
@@ -625,8 +809,6 @@ def create_app(test_config=None):
     return app
 
 
-APP = create_app()
-
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
-    APP.run(host='0.0.0.0', port=port)
+    create_app().run(host='0.0.0.0', port=port)
@@ -0,0 +1,763 @@
+'''
+ASGI variant of the API
+
+Serves the routes of create_app with the same JSON contracts from a
+single asyncio event loop: queries run through the `databases` async
+drivers (asyncpg for Postgres, aiosqlite for SQLite) using the tables
+declared in models.py, and the Auth0 key set is fetched with httpx and
+cached for JWKS_CACHE_SECONDS. While a request waits on the database or
+on Auth0 the loop keeps serving other requests. It also serves the
+Server-Sent Events streams of new vacancies and applications (events.py).
+
+    uvicorn --factory asgi:create_asgi_app --port 8000
+'''
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from functools import wraps
+from types import SimpleNamespace
+
+import databases
+import sqlalchemy as sa
+from flask.json import JSONEncoder
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+import auth
+from auth import AuthError
+from events import (
+    KEEPALIVE_SECONDS,
+    Broker,
+    application_event,
+    events_backend,
+    stream_filters,
+    vacancy_event
+)
+from models import (
+    Company,
+    Candidate,
+    Vacancy,
+    Application,
+    ApplicationRollup,
+    application_count_updates,
+    company_name_of,
+    copy_company_names,
+    parse_datetime,
+    rollup_added,
+    rollup_inserted,
+    rollup_key,
+    rollup_removed,
+    tombstone
+)
+
+ITEMS_PER_PAGE = 10
+JWKS_CACHE_SECONDS = 600
+DB_POOL_SIZE = 20
+
+companies = Company.__table__
+candidates = Candidate.__table__
+vacancies = Vacancy.__table__
+applications = Application.__table__
+
+COMPANY_FIELDS = ['name', 'industry', 'employee', 'city', 'region',
+                  'address', 'email', 'phone', 'logo_link', 'facebook_link',
+                  'website_link', 'description', 'seeking_employee']
+CANDIDATE_FIELDS = ['name', 'surname', 'date_of_birth', 'city', 'region',
+                    'email', 'phone', 'facebook_link', 'linkedin_link',
+                    'address', 'work_experience', 'education', 'seeking_job',
+                    'desired_salary', 'desired_industry']
+VACANCY_FIELDS = ['job_title', 'job_description', 'requirements',
+                  'benefits', 'city', 'region', 'min_salary']
+# the columns of Vacancy.format_short, without the long texts
+VACANCY_SHORT_COLUMNS = [vacancies.c.id, vacancies.c.job_title,
+                         vacancies.c.city, vacancies.c.region,
+                         vacancies.c.min_salary, vacancies.c.date_posted,
+                         vacancies.c.company_id, vacancies.c.company_name,
+                         vacancies.c.application_count]
+
+ERROR_MESSAGES = {
+    400: 'Bad request',
+    404: 'Not found',
+    406: 'Not acceptable',
+    422: 'Unprocessable',
+    500: 'Internal server error'
+}
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type, Authorization, true'),
+    (b'access-control-allow-methods', b'GET, POST, PATCH, DELETE, OPTIONS'),
+    (b'access-control-allow-credentials', b'true')
+]
+
+
+class JSONResponse(Response):
+    '''Serializes like flask.jsonify, e.g. datetimes as HTTP dates.'''
+    media_type = 'application/json'
+
+    def render(self, content):
+        return json.dumps(content, cls=JSONEncoder).encode('utf-8')
+
+
+class JWKSCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.jwks = None
+        self.expires = 0.0
+        self.lock = asyncio.Lock()
+
+    async def get(self):
+        if self.jwks is None or time.monotonic() >= self.expires:
+            async with self.lock:
+                if self.jwks is None or time.monotonic() >= self.expires:
+                    self.jwks = await auth.get_jwks_async()
+                    self.expires = time.monotonic() + self.ttl
+        return self.jwks
+
+
+class CORSHeaders:
+    '''Adds the headers create_app sends with every response.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message, headers=list(
+                    message.get('headers', [])) + CORS_HEADERS)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+def abort(status_code):
+    raise HTTPException(status_code)
+
+
+async def get_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def requires_auth(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            token = auth.parse_auth_header(
+                request.headers.get('Authorization'))
+            jwks = await request.app.state.jwks.get()
+            payload = auth.decode_jwt(token, jwks)
+            auth.check_permissions(permission, payload)
+            return await f(request, payload)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+def row_object(row, **related):
+    '''Lets the format methods of models.py serialize a result row.'''
+    return SimpleNamespace(**dict(row.items()), **related)
+
+
+def vacancy_query(columns=None):
+    '''All columns of the vacancies, or only `columns` for listings'''
+    return sa.select(list(columns or [vacancies]))
+
+
+def page_query(request, query):
+    '''Restricts `query` to the requested page of applications'''
+    try:
+        page = int(request.query_params.get('page', 1))
+    except ValueError:
+        page = 1
+    if page < 1:
+        abort(404)
+    return query.order_by(applications.c.id).limit(ITEMS_PER_PAGE) \
+        .offset((page - 1) * ITEMS_PER_PAGE)
+
+
+def page_response(rows, applications_list):
+    # Raise error if pagination fetches no applications
+    if not rows:
+        abort(404)
+
+    return JSONResponse({
+      'success': True,
+      'applications_list': applications_list,
+      'number_applications': rows[0]['number_applications']
+    })
+
+
+async def delete_unreferenced(database, table, row_id, references):
+    '''Deletes a row unless other rows still point at it; like the ORM
+    cascade in create_app, referenced rows cannot be deleted (422).'''
+    async with database.transaction():
+        row = await database.fetch_one(
+            sa.select([table.c.id]).where(table.c.id == row_id))
+        if row is None:
+            abort(422)
+        for column in references:
+            referenced = await database.fetch_one(
+                sa.select([column]).where(column == row_id).limit(1))
+            if referenced is not None:
+                abort(422)
+        await database.execute(table.delete().where(table.c.id == row_id))
+        # the delta sync reports deletions of the tables it syncs
+        if 'updated_at' in table.c:
+            await database.execute(tombstone(table, row_id))
+
+
+async def roll_up(database, company_id, vacancy_id, submitted):
+    '''Adds an application to its rollup, like the mapper event in
+    models.py; `databases` reports no row counts, so the rollup is looked
+    up first.'''
+    rollups = ApplicationRollup.__table__
+    existing = await database.fetch_one(sa.select([rollups.c.day]).where(
+        rollup_key(company_id, vacancy_id, submitted.date())))
+    if existing is None:
+        try:
+            async with database.transaction():
+                await database.execute(
+                    rollup_inserted(company_id, vacancy_id, submitted))
+            return
+        except Exception:
+            # created by a concurrent application in the meantime
+            pass
+    await database.execute(rollup_added(company_id, vacancy_id, submitted))
+
+
+def create_asgi_app(database_url=None):
+    database_url = database_url or os.environ['DATABASE_URL']
+    if database_url.startswith('postgres://'):
+        database_url = 'postgresql://' + database_url[len('postgres://'):]
+    pool_size = int(os.environ.get('ASYNC_DB_POOL_SIZE', DB_POOL_SIZE))
+    if database_url.startswith('sqlite'):
+        database = databases.Database(database_url)
+    else:
+        database = databases.Database(database_url, min_size=1,
+                                      max_size=pool_size)
+    broker = Broker()
+    events = events_backend(broker, database_url)
+    keepalive = float(os.environ.get('EVENTS_KEEPALIVE_SECONDS',
+                                     KEEPALIVE_SECONDS))
+
+    '''
+    ROUTES
+    '''
+    # Welcome message
+    async def index(request):
+        return JSONResponse({
+          'message': 'Welcome to My Job Portal Backend API Project. '
+          + 'Please refer to the API documentation in README.md to view '
+          + 'and test available endpoints.'
+        })
+
+    '''
+    COMPANY
+    '''
+    # Get all companies
+    async def get_companies(request):
+        rows = await database.fetch_all(
+            sa.select([companies.c.id, companies.c.name]))
+
+        return JSONResponse({
+          'success': True,
+          'companies': {row['id']: row['name'] for row in rows}
+        })
+
+    # Get company details by company id
+    async def get_company_details(request):
+        company = await database.fetch_one(companies.select().where(
+            companies.c.id == request.path_params['company_id']))
+
+        if company is None:
+            abort(404)
+
+        return JSONResponse({
+          'success': True,
+          'company': Company.format(row_object(company))
+        })
+
+    # Add a new company profile
+    @requires_auth('post:companies')
+    async def add_company(request, payload):
+        try:
+            body = await get_json(request)
+            await database.execute(companies.insert().values(
+                updated_at=datetime.utcnow(),
+                **{field: body.get(field) for field in COMPANY_FIELDS}))
+            return JSONResponse({
+              'success': True
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Update a company by id
+    @requires_auth('patch:companies')
+    async def update_company(request, payload):
+        company_id = request.path_params['company_id']
+        company = await database.fetch_one(
+            companies.select().where(companies.c.id == company_id))
+
+        if company is None:
+            abort(404)
+
+        try:
+            body = await get_json(request)
+            async with database.transaction():
+                await database.execute(
+                    companies.update().where(companies.c.id == company_id)
+                    .values(updated_at=datetime.utcnow(),
+                            **{field: body.get(field, company[field])
+                               for field in COMPANY_FIELDS}))
+                # keep the copies of the name on the vacancies in step
+                if body.get('name', company['name']) != company['name']:
+                    await database.execute(copy_company_names(company_id))
+
+            return JSONResponse({
+              'success': True,
+              'id': company_id
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Delete a company by ID
+    @requires_auth('delete:companies')
+    async def delete_company(request, payload):
+        company_id = request.path_params['company_id']
+        try:
+            await delete_unreferenced(
+                database, companies, company_id,
+                [vacancies.c.company_id, applications.c.company_id])
+        except HTTPException:
+            raise
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+        return JSONResponse({
+          'success': True,
+          'id': company_id
+        })
+
+    '''
+    CANDIDATE
+    '''
+    # View candidate profile by id
+    async def get_candidate_details(request):
+        candidate = await database.fetch_one(candidates.select().where(
+            candidates.c.id == request.path_params['candidate_id']))
+
+        if candidate is None:
+            abort(404)
+
+        return JSONResponse({
+          'success': True,
+          'candidate': Candidate.format(row_object(candidate))
+        })
+
+    # Add a new candidate profile
+    @requires_auth('post:candidates')
+    async def add_candidate_profile(request, payload):
+        try:
+            body = await get_json(request)
+            values = {field: body.get(field) for field in CANDIDATE_FIELDS}
+            values['date_of_birth'] = parse_datetime(values['date_of_birth'])
+            await database.execute(candidates.insert().values(**values))
+            return JSONResponse({
+              'success': True
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Update a candidate profile by id
+    @requires_auth('patch:candidates')
+    async def update_candidate_profile(request, payload):
+        candidate_id = request.path_params['candidate_id']
+        try:
+            candidate = await database.fetch_one(candidates.select().where(
+                candidates.c.id == candidate_id))
+
+            if candidate is None:
+                abort(404)
+
+            body = await get_json(request)
+            values = {field: body.get(field, candidate[field])
+                      for field in CANDIDATE_FIELDS}
+            values['date_of_birth'] = parse_datetime(values['date_of_birth'])
+            await database.execute(
+                candidates.update().where(candidates.c.id == candidate_id)
+                .values(**values))
+            return JSONResponse({
+              'success': True,
+              'id': candidate_id
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Delete a candidate profile by id
+    @requires_auth('delete:candidates')
+    async def delete_candidate_profile(request, payload):
+        candidate_id = request.path_params['candidate_id']
+        try:
+            await delete_unreferenced(database, candidates, candidate_id,
+                                      [applications.c.candidate_id])
+        except HTTPException:
+            raise
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+        return JSONResponse({
+          'success': True,
+          'id': candidate_id
+        })
+
+    '''
+    VACANCY
+    '''
+    # Get the list of vacancies
+    async def get_vacancies(request):
+        rows = await database.fetch_all(vacancy_query(VACANCY_SHORT_COLUMNS))
+
+        return JSONResponse({
+          'success': True,
+          'vacancies': [Vacancy.format_short(row_object(row))
+                        for row in rows]
+        })
+
+    # Get details of a vacancy by id
+    async def get_vacancy_details(request):
+        vacancy = await database.fetch_one(vacancy_query().where(
+            vacancies.c.id == request.path_params['vacancy_id']))
+
+        if vacancy is None:
+            abort(404)
+
+        return JSONResponse({
+          'success': True,
+          'vacancy': Vacancy.format_long(row_object(vacancy))
+        })
+
+    # Add a new vacancy
+    @requires_auth('post:vacancies')
+    async def add_vacancy(request, payload):
+        try:
+            body = await get_json(request)
+            values = {field: body.get(field) for field in VACANCY_FIELDS}
+            values['date_posted'] = datetime.now()
+            values['company_id'] = body.get('company_id')
+            values['company_name'] = company_name_of(values['company_id'])
+            values['updated_at'] = datetime.utcnow()
+            vacancy_id = await database.execute(
+                vacancies.insert().values(**values))
+            await events.publish(database, 'vacancy', vacancy_event(
+                SimpleNamespace(id=vacancy_id, **values)))
+            return JSONResponse({
+              'success': True
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Update a vacancy by id
+    @requires_auth('patch:vacancies')
+    async def update_vacancy(request, payload):
+        vacancy_id = request.path_params['vacancy_id']
+        try:
+            vacancy = await database.fetch_one(vacancies.select().where(
+                vacancies.c.id == vacancy_id))
+
+            if vacancy is None:
+                abort(404)
+
+            body = await get_json(request)
+            values = {field: body.get(field, vacancy[field])
+                      for field in VACANCY_FIELDS}
+            values['date_posted'] = datetime.now()
+            values['updated_at'] = datetime.utcnow()
+            await database.execute(
+                vacancies.update().where(vacancies.c.id == vacancy_id)
+                .values(**values))
+            return JSONResponse({
+              'success': True,
+              'id': vacancy_id
+            })
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Delete a vacancy by id
+    @requires_auth('delete:vacancies')
+    async def delete_vacancy(request, payload):
+        vacancy_id = request.path_params['vacancy_id']
+        try:
+            await delete_unreferenced(database, vacancies, vacancy_id,
+                                      [applications.c.vacancy_id])
+        except HTTPException:
+            raise
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+        return JSONResponse({
+          'success': True,
+          'id': vacancy_id
+        })
+
+    '''
+    APPLICATION
+    '''
+    # Get the list of applications by candidate id (for candidates)
+    @requires_auth('get:applications')
+    async def get_applications_by_candidate_id(request, payload):
+        rows = await database.fetch_all(page_query(request, sa.select(
+            [applications, vacancies.c.job_title,
+             companies.c.name.label('company_name'),
+             candidates.c.application_count.label('number_applications')])
+            .select_from(applications
+                         .join(vacancies,
+                               applications.c.vacancy_id == vacancies.c.id)
+                         .join(candidates,
+                               applications.c.candidate_id == candidates.c.id)
+                         .join(companies,
+                               applications.c.company_id == companies.c.id))
+            .where(applications.c.candidate_id ==
+                   request.path_params['candidate_id'])))
+
+        return page_response(rows, [{
+          'application_id': row['id'],
+          'vacancy_id': row['vacancy_id'],
+          'vacancy_job_title': row['job_title'],
+          'company_id': row['company_id'],
+          'company_name': row['company_name'],
+          'cover_letter': row['cover_letter'],
+          'date_submitted': row['date_submitted']
+        } for row in rows])
+
+    # Get the list of applications by vacancy id (for companies)
+    @requires_auth('get:candidates')
+    async def get_applications_by_vacancy_id(request, payload):
+        rows = await database.fetch_all(page_query(request, sa.select(
+            [applications,
+             candidates.c.name.label('candidate_name'),
+             candidates.c.surname.label('candidate_surname'),
+             vacancies.c.application_count.label('number_applications')])
+            .select_from(applications
+                         .join(vacancies,
+                               applications.c.vacancy_id == vacancies.c.id)
+                         .join(candidates,
+                               applications.c.candidate_id == candidates.c.id)
+                         .join(companies,
+                               applications.c.company_id == companies.c.id))
+            .where(vacancies.c.id == request.path_params['vacancy_id'])))
+
+        return page_response(rows, [{
+          'vacancy_id': row['vacancy_id'],
+          'application_id': row['id'],
+          'candidate_id': row['candidate_id'],
+          'candidate_name': row['candidate_name'],
+          'candidate_surname': row['candidate_surname'],
+          'cover_letter': row['cover_letter'],
+          'date_submitted': row['date_submitted']
+        } for row in rows])
+
+    # Add a new application by vacancy id
+    @requires_auth('post:application')
+    async def add_application_by_vacancy_id(request, payload):
+        vacancy_id = request.path_params['vacancy_id']
+        vacancy = await database.fetch_one(
+            sa.select([vacancies.c.id]).where(vacancies.c.id == vacancy_id))
+
+        if vacancy is None:
+            abort(404)
+
+        body = await get_json(request)
+        new_candidate_id = body.get('candidate_id')
+
+        # Check if multiple applications are submitted
+        duplicate = await database.fetch_one(
+            sa.select([applications.c.id]).where(sa.and_(
+                applications.c.candidate_id == new_candidate_id,
+                applications.c.vacancy_id == vacancy_id)))
+
+        if duplicate is not None:
+            abort(406)
+
+        submitted = datetime.now()
+        async with database.transaction():
+            application_id = await database.execute(
+                applications.insert().values(
+                    company_id=body.get('company_id'),
+                    vacancy_id=vacancy_id,
+                    candidate_id=new_candidate_id,
+                    cover_letter=body.get('cover_letter', None),
+                    date_submitted=submitted))
+            for statement in application_count_updates(
+                    vacancy_id, body.get('company_id'), new_candidate_id, 1):
+                await database.execute(statement)
+            await roll_up(database, body.get('company_id'), vacancy_id,
+                          submitted)
+        await events.publish(database, 'application', application_event(
+            SimpleNamespace(id=application_id,
+                            company_id=body.get('company_id'),
+                            vacancy_id=vacancy_id,
+                            candidate_id=new_candidate_id,
+                            date_submitted=submitted)))
+        return JSONResponse({
+          'success': True
+        })
+
+    # Delete an application
+    @requires_auth('delete:application')
+    async def delete_application(request, payload):
+        application_id = request.path_params['application_id']
+        try:
+            async with database.transaction():
+                application = await database.fetch_one(
+                    applications.select().where(
+                        applications.c.id == application_id))
+                await delete_unreferenced(database, applications,
+                                          application_id, [])
+                for statement in application_count_updates(
+                        application['vacancy_id'], application['company_id'],
+                        application['candidate_id'], -1):
+                    await database.execute(statement)
+                if application['date_submitted'] is not None:
+                    for statement in rollup_removed(
+                            application['company_id'],
+                            application['vacancy_id'],
+                            application['date_submitted']):
+                        await database.execute(statement)
+        except HTTPException:
+            raise
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+        return JSONResponse({
+          'success': True,
+          'id': application_id
+        })
+
+    '''
+    EVENTS
+    '''
+    def event_stream(request, channel):
+        filters = stream_filters(channel, request.query_params)
+        if filters is None:
+            abort(400)
+        return StreamingResponse(
+            broker.events(channel, filters, keepalive),
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    # Stream the new vacancies matching filters (for candidates)
+    async def stream_vacancies(request):
+        return event_stream(request, 'vacancy')
+
+    # Stream the new applications to the vacancies of the company of the
+    # caller
+    @requires_auth('get:candidates')
+    async def stream_applications(request, payload):
+        company_id = request.query_params.get('company_id')
+        if not company_id:
+            abort(400)
+        auth.check_company(company_id, payload)
+        return event_stream(request, 'application')
+
+    '''
+    ERROR HANDLERS
+    '''
+    async def http_error(request, exc):
+        if exc.status_code not in ERROR_MESSAGES:
+            return JSONResponse({
+              'success': False,
+              'error': exc.status_code,
+              'message': exc.detail
+            }, status_code=exc.status_code)
+        return JSONResponse({
+          'success': False,
+          'error': exc.status_code,
+          'message': ERROR_MESSAGES[exc.status_code]
+        }, status_code=exc.status_code)
+
+    async def server_error(request, exc):
+        print(sys.exc_info())
+        return JSONResponse({
+          'success': False,
+          'error': 500,
+          'message': 'Internal server error'
+        }, status_code=500)
+
+    # Error handler for Auth decorator
+    async def auth_error(request, exc):
+        return JSONResponse(exc.error, status_code=exc.status_code)
+
+    routes = [
+        Route('/', index, methods=['GET']),
+        Route('/companies', get_companies, methods=['GET']),
+        Route('/companies', add_company, methods=['POST']),
+        Route('/companies/{company_id:int}', get_company_details,
+              methods=['GET']),
+        Route('/companies/{company_id:int}', update_company,
+              methods=['PATCH']),
+        Route('/companies/{company_id:int}', delete_company,
+              methods=['DELETE']),
+        Route('/candidates', add_candidate_profile, methods=['POST']),
+        Route('/candidates/{candidate_id:int}', get_candidate_details,
+              methods=['GET']),
+        Route('/candidates/{candidate_id:int}', update_candidate_profile,
+              methods=['PATCH']),
+        Route('/candidates/{candidate_id:int}', delete_candidate_profile,
+              methods=['DELETE']),
+        Route('/vacancies', get_vacancies, methods=['GET']),
+        Route('/vacancies', add_vacancy, methods=['POST']),
+        Route('/vacancies/{vacancy_id:int}', get_vacancy_details,
+              methods=['GET']),
+        Route('/vacancies/{vacancy_id:int}', update_vacancy,
+              methods=['PATCH']),
+        Route('/vacancies/{vacancy_id:int}', delete_vacancy,
+              methods=['DELETE']),
+        Route('/candidates/{candidate_id:int}/applications',
+              get_applications_by_candidate_id, methods=['GET']),
+        Route('/vacancies/{vacancy_id:int}/applications',
+              get_applications_by_vacancy_id, methods=['GET']),
+        Route('/vacancies/{vacancy_id:int}/applications',
+              add_application_by_vacancy_id, methods=['POST']),
+        Route('/applications/{application_id:int}', delete_application,
+              methods=['DELETE']),
+        Route('/events/vacancies', stream_vacancies, methods=['GET']),
+        Route('/events/applications', stream_applications, methods=['GET'])
+    ]
+
+    app = Starlette(
+        routes=routes,
+        exception_handlers={
+            HTTPException: http_error,
+            AuthError: auth_error,
+            Exception: server_error
+        },
+        on_startup=[database.connect, events.start],
+        on_shutdown=[events.stop, database.disconnect])
+    app.state.database = database
+    app.state.events = broker
+    app.state.jwks = JWKSCache(float(os.environ.get(
+        'JWKS_CACHE_SECONDS', JWKS_CACHE_SECONDS)))
+    app.add_middleware(CORSHeaders)
+    return app
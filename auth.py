@@ -1,5 +1,5 @@
 import json
-from flask import request, _request_ctx_stack
+from flask import g, request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
@@ -9,6 +9,10 @@ import os
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
+# Custom claim with the id of the company of a company user, added to the
+# access token by an Auth0 rule from the app_metadata of the user
+COMPANY_CLAIM = os.environ.get('COMPANY_CLAIM',
+                               'https://jobportal/company_id')
 
 
 # AuthError Exception
@@ -20,7 +24,11 @@ class AuthError(Exception):
 
 # Auth Header
 def get_token_auth_header():
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+# Extract the bearer token from an Authorization header value
+def parse_auth_header(auth):
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -66,10 +74,39 @@ def check_permissions(permission, payload):
     return True
 
 
+# Check that the token belongs to a user of the company
+def check_company(company_id, payload):
+    if str(payload.get(COMPANY_CLAIM)) != str(company_id):
+        raise AuthError({
+            'code': 'forbidden',
+            'description': 'Token is not issued for this company.'
+        }, 403)
+    return True
+
+
+# Fetch the JSON Web Key Set published by Auth0
+def get_jwks():
+    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+    return json.loads(jsonurl.read())
+
+
+# Fetch the JSON Web Key Set without blocking the event loop (ASGI app)
+async def get_jwks_async():
+    import httpx
+    async with httpx.AsyncClient() as client:
+        res = await client.get(
+            f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+        res.raise_for_status()
+        return res.json()
+
+
 # Veryfy jwt token
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return decode_jwt(token, get_jwks())
+
+
+# Verify a jwt token against the given key set
+def decode_jwt(token, jwks):
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -122,13 +159,22 @@ def verify_decode_jwt(token):
             }, 401)
 
 
+# Verify a token once per app context; the requests of a POST /batch
+# share the app context of the batch
+def get_verified_payload(token):
+    payloads = g.setdefault('verified_tokens', {})
+    if token not in payloads:
+        payloads[token] = verify_decode_jwt(token)
+    return payloads[token]
+
+
 # Decorator for Flask APIs
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            payload = get_verified_payload(token)
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
@@ -0,0 +1,106 @@
+'''
+Locally signed tokens and a stub JWKS
+
+Lets benchmarks and tests call routes protected by requires_auth without
+reaching Auth0: install() points the auth module at a generated RSA key
+and token() signs JWTs that verify against it.
+'''
+import base64
+import time
+from Crypto.PublicKey import RSA
+from jose import jwt
+import auth
+
+STUB_DOMAIN = 'jobportal.local'
+STUB_AUDIENCE = 'jobportal'
+STUB_KID = 'local-stub-key'
+
+# Permissions of the two Auth0 roles (see README.md)
+COMPANY_PERMISSIONS = [
+    'post:companies',
+    'patch:companies',
+    'delete:companies',
+    'post:vacancies',
+    'patch:vacancies',
+    'delete:vacancies',
+    'get:candidates'
+]
+
+CANDIDATE_PERMISSIONS = [
+    'post:candidates',
+    'patch:candidates',
+    'delete:candidates',
+    'post:application',
+    'delete:application',
+    'get:applications'
+]
+
+
+def _b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+class LocalAuth:
+    def __init__(self, kid=STUB_KID, key_size=2048):
+        self.kid = kid
+        self.key = RSA.generate(key_size)
+        self.private_pem = self.key.exportKey('PEM').decode('ascii')
+        self._saved = None
+
+    def jwks(self):
+        return {
+            'keys': [{
+                'kty': 'RSA',
+                'kid': self.kid,
+                'use': 'sig',
+                'alg': 'RS256',
+                'n': _b64_uint(self.key.n),
+                'e': _b64_uint(self.key.e)
+            }]
+        }
+
+    def token(self, permissions, subject='auth0|local', expires_in=3600,
+              company_id=None):
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + STUB_DOMAIN + '/',
+            'sub': subject,
+            'aud': STUB_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        if company_id is not None:
+            claims[auth.COMPANY_CLAIM] = company_id
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def company_token(self, subject='auth0|company', company_id=1):
+        return self.token(COMPANY_PERMISSIONS, subject,
+                          company_id=company_id)
+
+    def candidate_token(self, subject='auth0|candidate'):
+        return self.token(CANDIDATE_PERMISSIONS, subject)
+
+    async def jwks_async(self):
+        return self.jwks()
+
+    def install(self):
+        '''Make the auth module trust this key instead of Auth0.'''
+        if self._saved is None:
+            self._saved = (auth.AUTH0_DOMAIN, auth.API_AUDIENCE,
+                           auth.ALGORITHMS, auth.get_jwks,
+                           auth.get_jwks_async)
+        auth.AUTH0_DOMAIN = STUB_DOMAIN
+        auth.API_AUDIENCE = STUB_AUDIENCE
+        auth.ALGORITHMS = ['RS256']
+        auth.get_jwks = self.jwks
+        auth.get_jwks_async = self.jwks_async
+        return self
+
+    def uninstall(self):
+        if self._saved is not None:
+            (auth.AUTH0_DOMAIN, auth.API_AUDIENCE, auth.ALGORITHMS,
+             auth.get_jwks, auth.get_jwks_async) = self._saved
+            self._saved = None
@@ -0,0 +1,260 @@
+'''
+Autocomplete
+
+GET /autocomplete?q=dat&type=title returns the job titles (type=title,
+the default) or company names (type=company) starting with q, most
+frequent first and then most recent first. Case and repeated spaces are
+ignored.
+
+The lookups never reach the database. Every worker process keeps a
+sorted list of the distinct values, read once on the first request, and
+finds the values of a prefix with bisect. Prefixes of more than
+SCAN_LIMIT values keep their best values precomputed, so a lookup
+never ranks more than SCAN_LIMIT values. The index is updated after the
+app has committed a vacancy or company write (see changes.py).
+'''
+import heapq
+import sys
+import threading
+from bisect import bisect_left, insort
+
+from flask import abort, jsonify, request
+from sqlalchemy import select
+
+from changes import subscribe
+from metrics import metrics
+from models import Company, Vacancy
+
+MAX_RESULTS = 10
+# more values than this are not ranked per request
+SCAN_LIMIT = 256
+# best values kept per precomputed prefix
+CACHED = 2 * MAX_RESULTS
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def next_prefix(prefix):
+    '''The smallest string after all strings starting with `prefix`, or
+    None if there is none (`prefix` is empty or only U+10FFFF)'''
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class PrefixIndex:
+    '''Distinct values of `column`, ranked by their number of rows and
+    then by the highest id of their rows'''
+
+    def __init__(self, column):
+        self.column = column
+        self.keys = []
+        # normalized value -> [value, sorted ids of its rows]
+        self.entries = {}
+        # id -> normalized value
+        self.ids = {}
+        # prefix -> best normalized values, for prefixes of many values
+        self.top = {}
+        self.lock = threading.Lock()
+
+    def score(self, key):
+        ids = self.entries[key][1]
+        return len(ids), ids[-1]
+
+    def end(self, prefix, low, high):
+        '''Position after the keys in [low, high) starting with `prefix`'''
+        upper = next_prefix(prefix)
+        if upper is None:
+            return high
+        return bisect_left(self.keys, upper, low, high)
+
+    def rank(self, keys, limit=CACHED):
+        return heapq.nlargest(limit, keys, key=self.score)
+
+    def build(self, rows):
+        '''Builds the index from (id, value) rows'''
+        with self.lock:
+            self.entries = {}
+            self.ids = {}
+            for row_id, value in rows:
+                self._count(row_id, value)
+            self.keys = sorted(self.entries)
+            self.top = {}
+            self._precompute('', 0, len(self.keys))
+
+    def _count(self, row_id, value):
+        if not value or not value.strip():
+            return None
+        key = normalize(value)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [value, [row_id]]
+        else:
+            insort(entry[1], row_id)
+        self.ids[row_id] = key
+        return key
+
+    def _precompute(self, prefix, low, high):
+        '''Best values of the keys[low:high] starting with `prefix`;
+        stored for the prefixes of more than SCAN_LIMIT values'''
+        if high - low <= SCAN_LIMIT:
+            return self.rank(self.keys[low:high])
+        best = []
+        position = low
+        if self.keys[position] == prefix:
+            best.append(prefix)
+            position += 1
+        while position < high:
+            child = self.keys[position][:len(prefix) + 1]
+            end = self.end(child, position, high)
+            best.extend(self._precompute(child, position, end))
+            position = end
+        best = self.rank(best)
+        self.top[prefix] = best
+        return best
+
+    def search(self, prefix, limit=MAX_RESULTS):
+        prefix = normalize(prefix)
+        # add and remove change the lists and entries in place
+        with self.lock:
+            best = self.top.get(prefix)
+            if best is None:
+                low = bisect_left(self.keys, prefix)
+                high = self.end(prefix, low, len(self.keys))
+                if high - low > SCAN_LIMIT:
+                    best = self._precompute(prefix, low, high)
+                else:
+                    best = self.rank(self.keys[low:high], limit)
+            return [{'value': self.entries[key][0],
+                     'count': len(self.entries[key][1])}
+                    for key in best[:limit]]
+
+    def add(self, row_id, value):
+        with self.lock:
+            key = self._count(row_id, value)
+            if key is None:
+                return
+            if len(self.entries[key][1]) == 1:
+                insort(self.keys, key)
+            # the score of the key only went up; the values outside of a
+            # list never rank above its last value
+            for length in range(len(key) + 1):
+                best = self.top.get(key[:length])
+                if best is None:
+                    continue
+                if key in best:
+                    best[:] = self.rank(best)
+                elif not best or self.score(key) >= self.score(best[-1]):
+                    best[:] = self.rank(best + [key])
+
+    def remove(self, row_id):
+        with self.lock:
+            key = self.ids.pop(row_id, None)
+            if key is None:
+                return
+            ids = self.entries[key][1]
+            # the highest id left ranks the value by recency from now on
+            del ids[bisect_left(ids, row_id)]
+            if not ids:
+                del self.entries[key]
+                del self.keys[bisect_left(self.keys, key)]
+            for length in range(len(key) + 1):
+                prefix = key[:length]
+                best = self.top.get(prefix)
+                if best is None or key not in best:
+                    continue
+                # values outside of the list may rank higher now, unless
+                # the key still ranks at least as high as the last value
+                best.remove(key)
+                if key in self.entries and best \
+                        and self.score(key) >= self.score(best[-1]):
+                    best[:] = self.rank(best + [key])
+                elif len(best) < MAX_RESULTS:
+                    del self.top[prefix]
+
+    def load(self, connection, ids=None):
+        '''(id, value) rows of the column, of `ids` only if given'''
+        table = self.column.table
+        # in id order, so that the ids of a value are appended when built
+        query = select([table.c.id, self.column]).order_by(table.c.id)
+        if ids is not None:
+            query = query.where(table.c.id.in_(ids))
+        return connection.execute(query).fetchall()
+
+    def update(self, changes, connection):
+        '''Applies (action, id) changes, reading the new values'''
+        ids = list(dict.fromkeys(row_id for action, row_id in changes))
+        rows = dict(self.load(connection, ids))
+        for row_id in ids:
+            self.remove(row_id)
+            if row_id in rows:
+                self.add(row_id, rows[row_id])
+
+
+class Autocomplete:
+    def __init__(self, db):
+        self.db = db
+        self.indexes = {
+            'title': PrefixIndex(Vacancy.__table__.c.job_title),
+            'company': PrefixIndex(Company.__table__.c.name)
+        }
+        self.built = set()
+        self.lock = threading.Lock()
+
+    def index(self, kind):
+        index = self.indexes[kind]
+        if kind not in self.built:
+            with self.lock:
+                if kind not in self.built:
+                    index.build(index.load(self.db.session))
+                    self.built.add(kind)
+        return index
+
+    def refresh(self, kind, changes, connection=None):
+        if kind not in self.built:
+            return
+        try:
+            if connection is not None:
+                self.indexes[kind].update(changes, connection)
+            else:
+                with self.db.engine.connect() as connection:
+                    self.indexes[kind].update(changes, connection)
+        except Exception:
+            print(sys.exc_info())
+            # read again on the next request
+            self.built.discard(kind)
+
+    def vacancies_changed(self, changes):
+        self.refresh('title', changes)
+
+    def companies_changed(self, changes):
+        self.refresh('company', changes)
+
+
+def setup_autocomplete(app, db):
+    autocomplete = Autocomplete(db)
+    app.extensions['autocomplete'] = autocomplete
+    subscribe(autocomplete.vacancies_changed, Vacancy)
+    subscribe(autocomplete.companies_changed, Company)
+    metrics.register_gauges(lambda: [
+        ('autocomplete_values', {'type': kind}, len(index.keys))
+        for kind, index in autocomplete.indexes.items()])
+
+    # Complete job titles or company names
+    @app.route('/autocomplete', methods=['GET'])
+    def get_autocomplete():
+        query = request.args.get('q', '')
+        kind = request.args.get('type', 'title')
+        limit = request.args.get('limit', MAX_RESULTS, type=int)
+        if not query.strip() or kind not in autocomplete.indexes \
+                or not 0 < limit <= MAX_RESULTS:
+            abort(400)
+
+        return jsonify({
+          'success': True,
+          'type': kind,
+          'results': autocomplete.index(kind).search(query, limit)
+        })
@@ -0,0 +1,141 @@
+'''
+Batch requests
+
+POST /batch runs a list of requests to the other routes of the API in
+one round trip:
+
+    {
+      "transaction": false,
+      "requests": [
+        {"method": "GET", "path": "/companies/1"},
+        {"method": "PATCH", "path": "/vacancies/2",
+         "body": {"min_salary": 100000}}
+      ]
+    }
+
+The requests are dispatched in order inside the app context of the
+batch. They share its database session and the Authorization header of
+the batch, unless a request sends "headers" of its own, so a token is
+verified only once. The before/after request hooks (metrics, admission
+control, idempotency keys) apply to the batch as a whole, and admission
+control also applies to each of its requests, so that a batch does not
+get around the limits of a route.
+
+With "transaction": true nothing is committed until every request has
+succeeded. The batch stops at the first response with an error status
+and rolls back all of its changes.
+'''
+import sys
+from flask import _request_ctx_stack, abort, jsonify, request
+from werkzeug.exceptions import BadRequest, InternalServerError
+from werkzeug.test import EnvironBuilder
+
+from admission import client_address, client_key
+
+MAX_REQUESTS = 50
+METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+
+
+def _dispatch(app, environ, address):
+    '''Serves one request of the batch with the view and error handlers
+    of the app, but without its request hooks. Admission control is
+    applied to it for the client `address` of the batch, or the subject
+    of its token once verified.'''
+    ctx = app.request_context(environ)
+    ctx.match_request()
+    _request_ctx_stack.push(ctx)
+    admission = app.extensions.get('admission')
+    limit = None
+    try:
+        try:
+            rule = ctx.request.url_rule
+            if rule is not None and rule.endpoint == 'run_batch':
+                raise BadRequest()
+            if admission is not None and rule is not None:
+                shed, limit = admission.admit(
+                    ctx.request.method, rule.rule, client_key(address))
+                if shed is not None:
+                    return shed
+            return app.make_response(app.dispatch_request())
+        except Exception as e:
+            try:
+                return app.make_response(app.handle_user_exception(e))
+            except Exception:
+                print(sys.exc_info())
+                return app.make_response(
+                    app.handle_http_exception(InternalServerError()))
+    finally:
+        if limit is not None:
+            limit.release()
+        _request_ctx_stack.pop()
+
+
+def _read_requests(body, max_requests):
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('requests'), list):
+        abort(400)
+    requests = body['requests']
+    if not requests or len(requests) > max_requests:
+        abort(400)
+    for item in requests:
+        if not isinstance(item, dict) or \
+                str(item.get('method', 'GET')).upper() not in METHODS or \
+                not isinstance(item.get('path'), str) or \
+                not item['path'].startswith('/') or \
+                not isinstance(item.get('headers', {}), dict):
+            abort(400)
+    return requests
+
+
+def setup_batch(app, db):
+    max_requests = int(app.config.get('BATCH_MAX_REQUESTS', MAX_REQUESTS))
+
+    # Run several requests in one round trip
+    @app.route('/batch', methods=['POST'])
+    def run_batch():
+        body = request.get_json(silent=True)
+        requests = _read_requests(body, max_requests)
+        transaction = bool(body.get('transaction', False))
+        headers = {}
+        if 'Authorization' in request.headers:
+            headers['Authorization'] = request.headers['Authorization']
+        # the headers of the requests come from the client, so their
+        # address is the one of the batch
+        address = client_address()
+
+        responses = []
+        failed = False
+        db.session.info['defer_commit'] = transaction
+        try:
+            for item in requests:
+                response = _dispatch(app, EnvironBuilder(
+                    path=item['path'], base_url=request.host_url,
+                    method=item.get('method', 'GET').upper(),
+                    headers=dict(headers, **item.get('headers', {})),
+                    json=item.get('body'),
+                    environ_base={'REMOTE_ADDR': request.remote_addr}
+                ).get_environ(), address)
+
+                responses.append({
+                  'status': response.status_code,
+                  'body': response.get_json(silent=True)
+                })
+                if response.status_code >= 400:
+                    failed = True
+                    if transaction:
+                        break
+                    # discard what the failed request left in the session
+                    db.session.rollback()
+        finally:
+            db.session.info.pop('defer_commit', None)
+
+        if transaction:
+            if failed:
+                db.session.rollback()
+            else:
+                db.session.commit()
+
+        return jsonify({
+          'success': not failed,
+          'responses': responses
+        })
@@ -0,0 +1,157 @@
+'''
+Async serving benchmark
+
+Seeds a temporary SQLite database, starts the ASGI variant (asgi.py on
+uvicorn) and the WSGI app (gunicorn with gthread workers), and keeps
+--connections simultaneous keep-alive connections busy calling the public
+GET routes for a fixed time:
+
+    python -m benchmarks.bench_async --connections 1000 --duration 10
+    python -m benchmarks.bench_async --workers 1 --out async.json
+'''
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_serving import free_port, wait_until_ready
+from benchmarks.common import (
+    HTTPDriver,
+    SCALE_TIERS,
+    boot_app,
+    default_database_url,
+    environment,
+    save_results,
+    summarize
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+async def connection(port, paths, offset, deadline, latencies, errors):
+    i = offset
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+            writer.write(('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'
+                          % path).encode('ascii'))
+            status = await read_response(reader)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            status = 0
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.01)
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors[0] += 1
+    if writer is not None:
+        writer.close()
+
+
+async def load(port, paths, duration, connections):
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        connection(port, paths, n, deadline, latencies, errors)
+        for n in range(connections)])
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+
+def run_server(name, command, env, paths, args):
+    port = free_port()
+    command = [part.replace('{port}', str(port)) for part in command]
+    process = subprocess.Popen(command, cwd=ROOT,
+                               env=dict(env, PORT=str(port)),
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(HTTPDriver('127.0.0.1', port))
+        asyncio.run(load(port, paths, 1.0, min(args.connections, 32)))
+        result = asyncio.run(load(port, paths, args.duration,
+                                  args.connections))
+    finally:
+        process.terminate()
+        process.wait()
+    print('%-10s %10s req/s  p50 %8s ms  p95 %8s ms  p99 %8s ms  '
+          'errors %d' % (name, result['throughput_rps'], result['p50_ms'],
+                         result['p95_ms'], result['p99_ms'],
+                         result['errors']))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tier', choices=sorted(SCALE_TIERS),
+                        default='small')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    database_url = default_database_url()
+    app, ctx = boot_app(database_url, args.tier)
+    paths = ['/companies', '/vacancies'] + \
+        ['/companies/%d' % (i % ctx['companies'] + 1) for i in range(10)] + \
+        ['/vacancies/%d' % (i % ctx['vacancies'] + 1) for i in range(10)] + \
+        ['/candidates/%d' % (i % ctx['candidates'] + 1) for i in range(10)]
+
+    env = dict(os.environ, DATABASE_URL=database_url, ADMISSION_LIMITS='{}',
+               WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_WORKER_CLASS='gthread',
+               GUNICORN_THREADS=str(args.threads))
+    results = {
+        'asgi': run_server(
+            'asgi', [sys.executable, '-m', 'uvicorn', '--factory',
+                     'asgi:create_asgi_app', '--host', '127.0.0.1',
+                     '--port', '{port}', '--workers', str(args.workers),
+                     '--backlog', str(max(2048, args.connections)),
+                     '--no-access-log'], env, paths, args),
+        'gunicorn': run_server(
+            'gunicorn', [sys.executable, '-m', 'gunicorn', '--config',
+                         'gunicorn.conf.py', '--backlog',
+                         str(max(2048, args.connections)),
+                         'app:create_app()'],
+            env, paths, args)
+    }
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(), tier=args.tier,
+                         connections=args.connections,
+                         workers=args.workers, threads=args.threads),
+            'servers': results
+        })
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+'''
+Autocomplete benchmark
+
+Builds the autocomplete prefix index (autocomplete.py) from synthetic
+distinct job titles and reports the build time and the p50/p99 latency
+of lookups for random prefixes of 1 to 8 characters of the titles:
+
+    python -m benchmarks.bench_autocomplete --titles 1000000
+    python -m benchmarks.bench_autocomplete --titles 100000 --lookups 50000
+'''
+import argparse
+import random
+import sys
+import time
+
+from autocomplete import PrefixIndex
+from benchmarks.common import environment, percentile, save_results
+from models import Vacancy
+
+LEVELS = ['Junior', 'Senior', 'Lead', 'Principal', 'Staff', 'Head of']
+ROLES = ['Python Developer', 'Data Engineer', 'Data Scientist',
+         'Frontend Engineer', 'Product Manager', 'DevOps Engineer',
+         'Sales Manager', 'Accountant', 'Designer', 'Nurse', 'Teacher']
+
+
+def titles(count, seed_value=0):
+    rng = random.Random(seed_value)
+    for i in range(count):
+        yield i + 1, '%s %s %s %d' % (
+            rng.choice(LEVELS), rng.choice(ROLES),
+            rng.choice(['', 'II', 'III', '(remote)']), i)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--titles', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    rows = list(titles(args.titles))
+    index = PrefixIndex(Vacancy.__table__.c.job_title)
+    start = time.perf_counter()
+    index.build(rows)
+    build_ms = (time.perf_counter() - start) * 1e3
+
+    rng = random.Random(1)
+    prefixes = [title[:rng.randint(1, 8)]
+                for _, title in rng.choices(rows, k=args.lookups)]
+    latencies = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        index.search(prefix)
+        latencies.append((time.perf_counter() - start) * 1e3)
+    latencies.sort()
+    results = {
+        'build_ms': round(build_ms, 1),
+        'p50_ms': round(percentile(latencies, 50), 4),
+        'p99_ms': round(percentile(latencies, 99), 4),
+        'max_ms': round(latencies[-1], 4)
+    }
+    print('%d titles, build %.0f ms, lookup p50 %.4f ms p99 %.4f ms '
+          'max %.4f ms' % (args.titles, results['build_ms'],
+                           results['p50_ms'], results['p99_ms'],
+                           results['max_ms']))
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(), titles=args.titles,
+                         lookups=args.lookups),
+            'results': results
+        })
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
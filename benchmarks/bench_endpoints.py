@@ -0,0 +1,290 @@
+'''
+Endpoint benchmark
+
+Boots create_app against a throwaway SQLite file (default) or a local
+Postgres, seeds one of the scale tiers from benchmarks/common.py and
+drives every route through the Flask test client or a real WSGI server.
+requires_auth is satisfied with locally signed tokens (see auth_stub.py).
+
+Reports throughput and p50/p95/p99 latency per route and optionally
+saves the results as JSON to compare later runs against:
+
+    python -m benchmarks.bench_endpoints --tier medium --out base.json
+    python -m benchmarks.bench_endpoints --tier medium --baseline base.json
+
+WARNING: all tables of the benchmark database are dropped and re-created.
+'''
+import argparse
+import sys
+import threading
+import time
+from datetime import datetime
+
+from benchmarks.common import (
+    SCALE_TIERS,
+    TestClientDriver,
+    WSGIServerDriver,
+    boot_app,
+    compare,
+    default_database_url,
+    environment,
+    load_results,
+    print_table,
+    save_results,
+    summarize
+)
+
+
+class Scenario:
+    '''One route under test. `call(i, ids)` returns the (path, body,
+    headers) of the i-th request; `prepare(n)`, if given, creates n
+    disposable rows beforehand and returns their ids.'''
+
+    def __init__(self, name, method, call, prepare=None):
+        self.name = name
+        self.method = method
+        self.call = call
+        self.prepare = prepare
+
+
+def build_scenarios(app, db, models, ctx, company, candidate):
+    vacancies_with_apps = ctx['vacancies_with_applications']
+
+    def cycle(count):
+        return lambda i: i % count + 1
+
+    company_id = cycle(ctx['companies'])
+    candidate_id = cycle(ctx['candidates'])
+    vacancy_id = cycle(ctx['vacancies'])
+
+    def create(make_rows):
+        def prepare(n):
+            with app.app_context():
+                rows = make_rows(n)
+                db.session.add_all(rows)
+                db.session.commit()
+                return [row.id for row in rows]
+        return prepare
+
+    def companies(n):
+        return [models.Company('Disposable %d' % i, 'IT', 1, 'Berlin',
+                               'Berlin', None, None, None, None, None,
+                               None, None, False) for i in range(n)]
+
+    def candidates(n):
+        return [models.Candidate('Disposable', str(i), None, 'Berlin',
+                                 'Berlin', None, None, None, None, None,
+                                 None, None, True, None, None)
+                for i in range(n)]
+
+    def vacancies(n):
+        return [models.Vacancy('Disposable %d' % i, None, None, None,
+                               'Berlin', 'Berlin', 50000, datetime.now(), 1)
+                for i in range(n)]
+
+    def applications(n):
+        # one fresh candidate per application keeps the pairs unique
+        new_candidates = candidates(n)
+        db.session.add_all(new_candidates)
+        db.session.flush()
+        return [models.Application(1, 1, c.id, 'Disposable', datetime.now())
+                for c in new_candidates]
+
+    company_post = {
+        'name': 'Benchmark Inc.',
+        'industry': 'IT',
+        'city': 'Berlin',
+        'region': 'Berlin',
+        'seeking_employee': True
+    }
+    candidate_post = {'name': 'Max', 'surname': 'Musterman'}
+    vacancy_post = {
+        'job_title': 'Benchmark Engineer',
+        'city': 'Berlin',
+        'region': 'Berlin',
+        'company_id': 1
+    }
+
+    return [
+        # Public reads
+        Scenario('GET /', 'GET', lambda i, ids: ('/', None, None)),
+        Scenario('GET /companies', 'GET',
+                 lambda i, ids: ('/companies', None, None)),
+        Scenario('GET /companies/<id>', 'GET',
+                 lambda i, ids: ('/companies/%d' % company_id(i), None,
+                                 None)),
+        Scenario('GET /candidates/<id>', 'GET',
+                 lambda i, ids: ('/candidates/%d' % candidate_id(i), None,
+                                 None)),
+        Scenario('GET /vacancies', 'GET',
+                 lambda i, ids: ('/vacancies', None, None)),
+        Scenario('GET /vacancies/<id>', 'GET',
+                 lambda i, ids: ('/vacancies/%d' % vacancy_id(i), None,
+                                 None)),
+
+        # Authorized reads
+        Scenario('GET /candidates/<id>/applications', 'GET',
+                 lambda i, ids: ('/candidates/%d/applications'
+                                 % candidate_id(i), None, candidate)),
+        Scenario('GET /vacancies/<id>/applications', 'GET',
+                 lambda i, ids: ('/vacancies/%d/applications'
+                                 % vacancies_with_apps[
+                                     i % len(vacancies_with_apps)],
+                                 None, company)),
+
+        # Writes
+        Scenario('POST /companies', 'POST',
+                 lambda i, ids: ('/companies', company_post, company)),
+        Scenario('PATCH /companies/<id>', 'PATCH',
+                 lambda i, ids: ('/companies/%d' % company_id(i),
+                                 {'employee': i}, company)),
+        Scenario('POST /candidates', 'POST',
+                 lambda i, ids: ('/candidates', candidate_post, candidate)),
+        Scenario('PATCH /candidates/<id>', 'PATCH',
+                 lambda i, ids: ('/candidates/%d' % candidate_id(i),
+                                 {'city': 'Berlin'}, candidate)),
+        Scenario('POST /vacancies', 'POST',
+                 lambda i, ids: ('/vacancies', vacancy_post, company)),
+        Scenario('PATCH /vacancies/<id>', 'PATCH',
+                 lambda i, ids: ('/vacancies/%d' % vacancy_id(i),
+                                 {'min_salary': 60000 + i}, company)),
+        Scenario('POST /vacancies/<id>/applications', 'POST',
+                 lambda i, ids: ('/vacancies/1/applications', {
+                     'company_id': 1,
+                     'candidate_id': ids[i],
+                     'cover_letter': 'Benchmark'
+                 }, candidate),
+                 prepare=create(candidates)),
+
+        # Deletes consume rows created by `prepare`
+        Scenario('DELETE /applications/<id>', 'DELETE',
+                 lambda i, ids: ('/applications/%d' % ids[i], None,
+                                 candidate),
+                 prepare=create(applications)),
+        Scenario('DELETE /vacancies/<id>', 'DELETE',
+                 lambda i, ids: ('/vacancies/%d' % ids[i], None, company),
+                 prepare=create(vacancies)),
+        Scenario('DELETE /candidates/<id>', 'DELETE',
+                 lambda i, ids: ('/candidates/%d' % ids[i], None,
+                                 candidate),
+                 prepare=create(candidates)),
+        Scenario('DELETE /companies/<id>', 'DELETE',
+                 lambda i, ids: ('/companies/%d' % ids[i], None, company),
+                 prepare=create(companies))
+    ]
+
+
+def run_scenario(driver, scenario, requests, warmup, concurrency):
+    total = warmup + requests
+    ids = scenario.prepare(total) if scenario.prepare else None
+    calls = [scenario.call(i, ids) for i in range(total)]
+
+    for path, body, headers in calls[:warmup]:
+        driver.request(scenario.method, path, body, headers)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(chunk):
+        for path, body, headers in chunk:
+            start = time.perf_counter()
+            status = driver.request(scenario.method, path, body, headers)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not 200 <= status < 300:
+                    errors[0] += 1
+
+    timed = calls[warmup:]
+    threads = [threading.Thread(target=worker, args=(timed[n::concurrency],))
+               for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return summarize(latencies, elapsed, errors[0])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database',
+                        help='SQLAlchemy URL of a dedicated benchmark '
+                             'database (default: temporary SQLite file)')
+    parser.add_argument('--tier', choices=sorted(SCALE_TIERS),
+                        default='small')
+    parser.add_argument('--driver', choices=['test-client', 'wsgi-server'],
+                        default='test-client')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--routes', default='',
+                        help='only run routes whose name contains this')
+    parser.add_argument('--out', help='save results as JSON')
+    parser.add_argument('--baseline', help='compare with a saved JSON run')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='exit non-zero if any p95 regresses by more '
+                             'than this many percent against --baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app, ctx = boot_app(args.database or default_database_url(), args.tier)
+
+    from auth_stub import LocalAuth
+    import models
+    from models import db
+
+    signer = LocalAuth().install()
+    company = {'Authorization': 'Bearer ' + signer.company_token()}
+    candidate = {'Authorization': 'Bearer ' + signer.candidate_token()}
+
+    if args.driver == 'wsgi-server':
+        driver = WSGIServerDriver(app)
+    else:
+        driver = TestClientDriver(app)
+
+    routes = {}
+    try:
+        for scenario in build_scenarios(app, db, models, ctx, company,
+                                        candidate):
+            if args.routes not in scenario.name:
+                continue
+            routes[scenario.name] = run_scenario(
+                driver, scenario, args.requests, args.warmup,
+                args.concurrency)
+    finally:
+        driver.close()
+        signer.uninstall()
+
+    results = {
+        'meta': dict(environment(),
+                     tier=args.tier,
+                     database=app.config['SQLALCHEMY_DATABASE_URI']
+                     .split(':', 1)[0],
+                     driver=driver.name,
+                     requests=args.requests,
+                     concurrency=args.concurrency),
+        'routes': routes
+    }
+
+    print_table(routes)
+    if args.out:
+        save_results(args.out, results)
+
+    if args.baseline:
+        worst = compare(routes, load_results(args.baseline)['routes'])
+        if args.max_regression is not None and worst > args.max_regression:
+            print('p95 regressed by %.1f%% (limit %.1f%%)'
+                  % (worst, args.max_regression))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
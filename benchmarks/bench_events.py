@@ -0,0 +1,101 @@
+'''
+Live events benchmark
+
+Opens idle Server-Sent Events streams against the ASGI app in-process
+(no sockets) and reports the memory they hold and the time to publish a
+vacancy to all of them, with some of the streams matching its filters:
+
+    python -m benchmarks.bench_events --streams 1000 10000
+'''
+import argparse
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+
+from benchmarks.common import environment, save_results
+from events import Broker
+
+CITIES = ['Berlin', 'Paris', 'Madrid', 'Rome', 'Vienna']
+
+
+def noop_receive():
+    '''receive() of a client that stays connected'''
+    forever = asyncio.Event()
+
+    async def receive():
+        await forever.wait()
+    return receive
+
+
+async def run(count, keepalive):
+    from starlette.responses import StreamingResponse
+
+    broker = Broker()
+    received = [0]
+
+    async def send(message):
+        if message['type'] == 'http.response.body' and \
+                message.get('body', b'').startswith(b'event:'):
+            received[0] += 1
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/events/vacancies',
+             'headers': []}
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tasks = []
+    for i in range(count):
+        response = StreamingResponse(broker.events(
+            'vacancy', {'city': CITIES[i % len(CITIES)]}, keepalive),
+            media_type='text/event-stream')
+        tasks.append(asyncio.ensure_future(
+            response(scope, noop_receive(), send)))
+    # let every stream subscribe and send its first chunk
+    while sum(len(streams) for streams in broker.streams.values()) < count:
+        await asyncio.sleep(0.01)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    held = sum(stat.size_diff for stat in after.compare_to(before, 'lineno'))
+
+    start = time.perf_counter()
+    broker.publish('vacancy', {'id': 1, 'city': 'Berlin'})
+    while received[0] < count // len(CITIES):
+        await asyncio.sleep(0)
+    delivered_ms = (time.perf_counter() - start) * 1e3
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        'streams': count,
+        'bytes_per_stream': round(held / count),
+        'delivered': received[0],
+        'publish_ms': round(delivered_ms, 3)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--streams', type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    results = []
+    for count in args.streams:
+        result = asyncio.run(run(count, keepalive=60))
+        results.append(result)
+        print('%(streams)d idle streams: %(bytes_per_stream)d bytes each, '
+              'publish to %(delivered)d of them in %(publish_ms).1f ms'
+              % result)
+
+    if args.out:
+        save_results(args.out, {'meta': environment(), 'results': results})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
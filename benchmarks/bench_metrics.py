@@ -0,0 +1,72 @@
+'''
+Metrics overhead benchmark
+
+Serves a trivial route through the Flask test client with and without
+the hooks installed by setup_metrics and reports the difference per
+request, which should stay below 50 microseconds:
+
+    python -m benchmarks.bench_metrics --requests 20000
+'''
+import argparse
+import sys
+import tempfile
+import time
+
+from flask import Flask, jsonify
+
+BUDGET_US = 50.0
+
+
+def make_app(with_metrics, directory=None):
+    app = Flask(__name__)
+    if directory:
+        app.config['METRICS_MULTIPROC_DIR'] = directory
+
+    @app.route('/ping')
+    def ping():
+        return jsonify({'success': True})
+
+    if with_metrics:
+        from metrics import setup_metrics
+        setup_metrics(app)
+    return app
+
+
+def per_request_us(app, requests):
+    client = app.test_client()
+    for _ in range(200):
+        client.get('/ping')
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get('/ping')
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--multiprocess', action='store_true',
+                        help='also write snapshots for multi-process mode')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp() if args.multiprocess else None
+    bare = make_app(False)
+    measured = make_app(True, directory)
+
+    # best of several rounds to filter out scheduler noise
+    without = min(per_request_us(bare, args.requests)
+                  for _ in range(args.rounds))
+    with_hooks = min(per_request_us(measured, args.requests)
+                     for _ in range(args.rounds))
+    overhead = with_hooks - without
+
+    print('without metrics: %8.1f us/request' % without)
+    print('with metrics:    %8.1f us/request' % with_hooks)
+    print('overhead:        %8.1f us/request (budget %.0f us)'
+          % (overhead, BUDGET_US))
+    return 0 if overhead < BUDGET_US else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+'''
+Salary statistics benchmark
+
+Times the computation of the salary statistics snapshot (salaries.py)
+for synthetic vacancies. The vacancies are first collapsed to the
+(city, region, industry, salary, count) rows the database query returns:
+
+    python -m benchmarks.bench_salaries --vacancies 1000000
+    python -m benchmarks.bench_salaries --vacancies 5000000 --cities 500
+'''
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.common import environment, save_results
+from salaries import compute_salary_stats
+
+INDUSTRIES = 20
+REGIONS = 50
+
+
+def salary_rows(vacancies, cities, seed_value=0):
+    rng = np.random.default_rng(seed_value)
+    city = rng.integers(0, cities, vacancies)
+    industry = rng.integers(0, INDUSTRIES, vacancies)
+    salary = np.round(rng.lognormal(11, 0.4, vacancies), -3).astype(np.int64)
+    # GROUP BY city, region, industry, min_salary
+    (city, industry, salary), counts = np.unique(
+        np.stack([city, industry, salary]), axis=1, return_counts=True)
+    return [('City %d' % c, 'Region %d' % (c % REGIONS), 'Industry %d' % i,
+             int(s), int(n))
+            for c, i, s, n in zip(city.tolist(), industry.tolist(),
+                                  salary.tolist(), counts.tolist())]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--vacancies', type=int, default=1000000)
+    parser.add_argument('--cities', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    rows = salary_rows(args.vacancies, args.cities)
+    timings = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        stats = compute_salary_stats(rows)
+        timings.append((time.perf_counter() - start) * 1e3)
+    best = min(timings)
+    print('%d vacancies, %d rows, %d groups: %.1f ms'
+          % (args.vacancies, len(rows), len(stats), best))
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(), vacancies=args.vacancies,
+                         cities=args.cities, rounds=args.rounds),
+            'rows': len(rows),
+            'groups': len(stats),
+            'compute_ms': round(best, 3)
+        })
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+'''
+Serving mode benchmark
+
+Seeds a temporary SQLite database, then starts the app with the Flask
+development server (`python app.py`, the previous Procfile entry) and
+with gunicorn (gunicorn.conf.py), and loads each with concurrent clients
+calling the public GET routes for a fixed time:
+
+    python -m benchmarks.bench_serving --duration 10 --concurrency 32
+    python -m benchmarks.bench_serving --workers 4 --worker-class gevent
+'''
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks.common import (
+    HTTPDriver,
+    SCALE_TIERS,
+    boot_app,
+    default_database_url,
+    environment,
+    save_results,
+    summarize
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_until_ready(driver, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if driver.request('GET', '/') == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('server did not start on port %d' % driver.port)
+
+
+def load(driver, paths, duration, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(offset):
+        i = offset
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                status = driver.request('GET', path)
+            except OSError:
+                status = 0
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status != 200:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(n,))
+               for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+
+def run_server(name, command, env, paths, args):
+    port = free_port()
+    env = dict(env, PORT=str(port))
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        driver = HTTPDriver('127.0.0.1', port)
+        wait_until_ready(driver)
+        load(driver, paths, 1.0, args.concurrency)
+        result = load(driver, paths, args.duration, args.concurrency)
+    finally:
+        process.terminate()
+        process.wait()
+    print('%-12s %10s req/s  p50 %8s ms  p95 %8s ms  p99 %8s ms  '
+          'errors %d' % (name, result['throughput_rps'], result['p50_ms'],
+                         result['p95_ms'], result['p99_ms'],
+                         result['errors']))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tier', choices=sorted(SCALE_TIERS),
+                        default='small')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--worker-class', default='gthread')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    database_url = default_database_url()
+    app, ctx = boot_app(database_url, args.tier)
+    paths = ['/companies', '/vacancies'] + \
+        ['/companies/%d' % (i % ctx['companies'] + 1) for i in range(10)] + \
+        ['/vacancies/%d' % (i % ctx['vacancies'] + 1) for i in range(10)] + \
+        ['/candidates/%d' % (i % ctx['candidates'] + 1) for i in range(10)]
+
+    env = dict(os.environ, DATABASE_URL=database_url, ADMISSION_LIMITS='{}',
+               WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_WORKER_CLASS=args.worker_class,
+               GUNICORN_THREADS=str(args.threads))
+    results = {
+        'dev-server': run_server(
+            'dev-server', [sys.executable, 'app.py'], env, paths, args),
+        'gunicorn': run_server(
+            'gunicorn', [sys.executable, '-m', 'gunicorn', '--config',
+                         'gunicorn.conf.py', 'app:create_app()'], env, paths,
+            args)
+    }
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(), tier=args.tier,
+                         concurrency=args.concurrency,
+                         workers=args.workers,
+                         worker_class=args.worker_class),
+            'servers': results
+        })
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
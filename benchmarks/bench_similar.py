@@ -0,0 +1,115 @@
+'''
+Similar vacancies benchmark
+
+Indexes synthetic vacancy texts in the MinHash/LSH index (similar.py),
+a tenth of them near duplicates of another one, and reports the time
+per signature, the latency of lookups and the share of near duplicates
+found. The number of vacancies compared per lookup should stay about
+the same whatever the number of vacancies:
+
+    python -m benchmarks.bench_similar --vacancies 10000 100000
+'''
+import argparse
+import random
+import sys
+import time
+
+from benchmarks.common import environment, percentile, save_results
+from similar import (
+    DUPLICATE_SIMILARITY,
+    SimilarityIndex,
+    band_keys,
+    signature
+)
+
+WORDS = ['python', 'sql', 'data', 'pipelines', 'team', 'customers',
+         'remote', 'office', 'senior', 'junior', 'design', 'build',
+         'maintain', 'cloud', 'reports', 'sales', 'support', 'nurse',
+         'patients', 'shifts', 'teaching', 'students', 'budget', 'plan']
+
+
+def texts(count, seed_value=0):
+    '''(title, description, index of the original or None) rows'''
+    rng = random.Random(seed_value)
+    rows = []
+    for i in range(count):
+        if rows and rng.random() < 0.1:
+            original = rng.randrange(len(rows))
+            title, description, _ = rows[original]
+            rows.append((title, description + ' apply now', original))
+        else:
+            rows.append(('%s %d' % (rng.choice(WORDS), i), ' '.join(
+                rng.choice(WORDS) for _ in range(rng.randint(30, 80))),
+                None))
+    return rows
+
+
+def run(count, lookups):
+    rows = texts(count)
+    index = SimilarityIndex(None)
+    start = time.perf_counter()
+    for vacancy_id, (title, description, _) in enumerate(rows):
+        index._add(vacancy_id, signature([title, description]))
+    signature_ms = (time.perf_counter() - start) * 1e3 / count
+    index.built = True
+
+    rng = random.Random(1)
+    latencies = []
+    compared = 0
+    for vacancy_id in rng.sample(range(count), min(lookups, count)):
+        vacancy_signature = index.signatures[vacancy_id]
+        start = time.perf_counter()
+        index.similar(vacancy_id, vacancy_signature)
+        latencies.append((time.perf_counter() - start) * 1e3)
+        compared += len(set().union(*(
+            index.buckets.get(key, ())
+            for key in band_keys(vacancy_signature))))
+    latencies.sort()
+
+    duplicates = [(vacancy_id, row[2]) for vacancy_id, row in enumerate(rows)
+                  if row[2] is not None]
+    found = 0
+    for vacancy_id, original in duplicates:
+        if any(similar_id == original and similarity >= DUPLICATE_SIMILARITY
+               for similarity, similar_id in index.similar(
+                   vacancy_id, index.signatures[vacancy_id])):
+            found += 1
+    return {
+        'vacancies': count,
+        'signature_ms': round(signature_ms, 4),
+        'p50_ms': round(percentile(latencies, 50), 4),
+        'p99_ms': round(percentile(latencies, 99), 4),
+        'compared_per_lookup': round(compared / len(latencies), 1),
+        'duplicates_found': round(found / max(len(duplicates), 1), 3)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--vacancies', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    results = []
+    for count in args.vacancies:
+        result = run(count, args.lookups)
+        results.append(result)
+        print('%(vacancies)d vacancies: %(signature_ms).3f ms per signature, '
+              'lookup p50 %(p50_ms).3f ms p99 %(p99_ms).3f ms, '
+              '%(compared_per_lookup).1f compared, '
+              '%(duplicates_found).1f%% duplicates found'
+              % dict(result,
+                     duplicates_found=result['duplicates_found'] * 100))
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(), lookups=args.lookups),
+            'results': results
+        })
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
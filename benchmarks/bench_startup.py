@@ -0,0 +1,93 @@
+'''
+Startup benchmark
+
+Seeds a temporary SQLite database, then measures in fresh interpreters
+how long it takes to import app.py, to build the app with create_app and
+to serve the first and the second request through the test client:
+
+    python -m benchmarks.bench_startup --rounds 10
+    python -m benchmarks.bench_startup --path /vacancies --out startup.json
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.common import (
+    SCALE_TIERS,
+    boot_app,
+    default_database_url,
+    environment,
+    percentile,
+    save_results
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ['import_ms', 'create_app_ms', 'first_request_ms',
+          'second_request_ms']
+
+MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+client = app.test_client()
+status = client.get(sys.argv[1]).status_code
+first = time.perf_counter()
+client.get(sys.argv[1])
+second = time.perf_counter()
+print(json.dumps({
+    'status': status,
+    'import_ms': (imported - start) * 1e3,
+    'create_app_ms': (created - imported) * 1e3,
+    'first_request_ms': (first - created) * 1e3,
+    'second_request_ms': (second - first) * 1e3
+}))
+'''
+
+
+def measure(database_url, path):
+    output = subprocess.check_output(
+        [sys.executable, '-c', MEASURE, path], cwd=ROOT,
+        env=dict(os.environ, DATABASE_URL=database_url))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tier', choices=sorted(SCALE_TIERS),
+                        default='small')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--path', default='/companies')
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    database_url = default_database_url()
+    boot_app(database_url, args.tier)
+
+    runs = [measure(database_url, args.path) for _ in range(args.rounds)]
+    results = {}
+    for phase in PHASES:
+        values = sorted(run[phase] for run in runs)
+        results[phase] = {
+            'p50_ms': round(percentile(values, 50), 3),
+            'max_ms': round(values[-1], 3)
+        }
+        print('%-18s p50 %9.3f ms  max %9.3f ms'
+              % (phase, results[phase]['p50_ms'], results[phase]['max_ms']))
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(), tier=args.tier, rounds=args.rounds,
+                         path=args.path),
+            'phases': results
+        })
+    return 0 if all(run['status'] == 200 for run in runs) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+'''
+Long text benchmark
+
+Measures how many bytes the listing and detail routes read from the
+database in three modes, each on its own freshly seeded SQLite file:
+
+- eager: the long texts are undeferred in every query, as they were
+  before they became deferred
+- deferred: the default, listings do not select the long texts
+- compressed: deferred, and texts above --threshold bytes are stored
+  compressed (TEXT_COMPRESSION_THRESHOLD)
+
+The bytes are counted by running every SELECT of a request again on a
+separate connection and adding up the sizes of the returned values, so
+they approximate what the database sends, not what the driver buffers:
+
+    python -m benchmarks.bench_text --tier medium --out text.json
+'''
+import argparse
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Load, Query
+
+from benchmarks.common import (
+    SCALE_TIERS,
+    boot_app,
+    default_database_url,
+    environment,
+    percentile,
+    save_results
+)
+
+ROUTES = ['/vacancies', '/companies', '/vacancies/1', '/companies/1']
+MODES = ['eager', 'deferred', 'compressed']
+
+
+def value_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, datetime):
+        return len(value.isoformat())
+    return 8
+
+
+class ByteCounter:
+    '''Adds up the size of the rows returned by the SELECTs of an engine'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.bytes = 0
+        self.connection = engine.raw_connection()
+        event.listen(engine, 'after_cursor_execute', self.count)
+
+    def count(self, conn, cursor, statement, parameters, context,
+              executemany):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            return
+        replay = self.connection.cursor()
+        replay.execute(statement, parameters)
+        self.bytes += sum(value_size(value) for row in replay.fetchall()
+                          for value in row)
+        replay.close()
+
+    def close(self):
+        event.remove(self.engine, 'after_cursor_execute', self.count)
+        self.connection.close()
+
+
+def undefer_texts(query):
+    '''Loads the long texts of every entity of `query` again'''
+    import models
+    entities = [description['entity']
+                for description in query.column_descriptions]
+    return query.options(*[
+        Load(model).undefer_group('text')
+        for model in (models.Company, models.Vacancy, models.Application)
+        if model in entities])
+
+
+def measure(app, requests):
+    from models import db
+
+    client = app.test_client()
+    results = {}
+    with app.app_context():
+        engine = db.engine
+    for path in ROUTES:
+        client.get(path)
+        counter = ByteCounter(engine)
+        try:
+            status = client.get(path).status_code
+            size = counter.bytes
+        finally:
+            counter.close()
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            client.get(path)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        results[path] = {
+            'status': status,
+            'db_bytes': size,
+            'p50_ms': round(percentile(latencies, 50) * 1e3, 3)
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tier', choices=sorted(SCALE_TIERS),
+                        default='small')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--threshold', type=int, default=256,
+                        help='TEXT_COMPRESSION_THRESHOLD of compressed mode')
+    parser.add_argument('--out', help='save results as JSON')
+    args = parser.parse_args(argv)
+
+    modes = {}
+    for mode in MODES:
+        threshold = args.threshold if mode == 'compressed' else 0
+        app, ctx = boot_app(default_database_url(mode), args.tier,
+                            TEXT_COMPRESSION_THRESHOLD=threshold)
+        if mode == 'eager':
+            event.listen(Query, 'before_compile', undefer_texts, retval=True)
+        try:
+            modes[mode] = measure(app, args.requests)
+        finally:
+            if mode == 'eager':
+                event.remove(Query, 'before_compile', undefer_texts)
+
+    print('%-16s %-10s %12s %9s %9s' % ('route', 'mode', 'db bytes',
+                                        'change', 'p50 ms'))
+    for path in ROUTES:
+        before = modes['eager'][path]['db_bytes']
+        for mode in MODES:
+            result = modes[mode][path]
+            change = (result['db_bytes'] - before) / before * 100.0 \
+                if before else 0.0
+            print('%-16s %-10s %12d %+8.1f%% %9.3f' % (
+                path, mode, result['db_bytes'], change, result['p50_ms']))
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(), tier=args.tier,
+                         threshold=args.threshold),
+            'modes': modes
+        })
+    return 0 if all(result['status'] == 200 for results in modes.values()
+                    for result in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
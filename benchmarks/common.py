@@ -0,0 +1,335 @@
+'''
+Shared helpers for the benchmark scripts: scale tiers, seeding,
+latency summaries and JSON result files.
+'''
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+# Number of rows seeded per table for each scale tier
+SCALE_TIERS = {
+    'small': {
+        'companies': 10,
+        'candidates': 50,
+        'vacancies': 100,
+        'applications_per_candidate': 4
+    },
+    'medium': {
+        'companies': 100,
+        'candidates': 500,
+        'vacancies': 2000,
+        'applications_per_candidate': 8
+    },
+    'large': {
+        'companies': 500,
+        'candidates': 5000,
+        'vacancies': 20000,
+        'applications_per_candidate': 10
+    }
+}
+
+CITIES = [
+    ('San Francisco', 'California'),
+    ('Mountain View', 'California'),
+    ('Seattle', 'Washington'),
+    ('Austin', 'Texas'),
+    ('New York', 'New York'),
+    ('Boston', 'Massachusetts'),
+    ('Berlin', 'Berlin'),
+    ('Munich', 'Bavaria')
+]
+
+INDUSTRIES = ['IT', 'Finance', 'Retail', 'Healthcare', 'Logistics']
+
+JOB_TITLES = [
+    'Full-Stack Developer',
+    'Backend Engineer',
+    'Frontend Developer',
+    'Data Engineer',
+    'Data Scientist',
+    'DevOps Engineer',
+    'Product Manager',
+    'QA Engineer',
+    'Site Reliability Engineer',
+    'Mobile Developer'
+]
+
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua. ')
+
+
+def default_database_url(name='bench'):
+    path = os.path.join(tempfile.mkdtemp(prefix='jobportal-'), name + '.db')
+    return 'sqlite:///' + path
+
+
+def text(rng, min_sentences, max_sentences):
+    return LOREM * rng.randint(min_sentences, max_sentences)
+
+
+def company_row(rng, i):
+    city, region = rng.choice(CITIES)
+    return {
+        'name': 'Company %d' % i,
+        'industry': rng.choice(INDUSTRIES),
+        'employee': rng.randint(5, 50000),
+        'city': city,
+        'region': region,
+        'address': '%d Main Street' % i,
+        'email': 'jobs%d@example.com' % i,
+        'phone': '+1 555 %04d' % (i % 10000),
+        'logo_link': None,
+        'facebook_link': None,
+        'website_link': 'https://company%d.example.com' % i,
+        'description': text(rng, 2, 8),
+        'seeking_employee': True
+    }
+
+
+def candidate_row(rng, i):
+    city, region = rng.choice(CITIES)
+    return {
+        'name': 'Candidate',
+        'surname': 'Number %d' % i,
+        'date_of_birth': datetime(1970, 1, 1) + timedelta(
+            days=rng.randint(0, 12000)),
+        'city': city,
+        'region': region,
+        'email': 'candidate%d@example.com' % i,
+        'phone': None,
+        'facebook_link': None,
+        'linkedin_link': None,
+        'address': None,
+        'work_experience': text(rng, 1, 4),
+        'education': 'BSc Computer Science',
+        'seeking_job': True,
+        'desired_salary': rng.randrange(30000, 150000, 5000),
+        'desired_industry': rng.choice(INDUSTRIES)
+    }
+
+
+def vacancy_row(rng, i, company_id):
+    city, region = rng.choice(CITIES)
+    return {
+        'job_title': rng.choice(JOB_TITLES),
+        'job_description': text(rng, 5, 20),
+        'requirements': text(rng, 2, 10),
+        'benefits': text(rng, 1, 5),
+        'city': city,
+        'region': region,
+        'min_salary': rng.randrange(30000, 150000, 5000),
+        'date_posted': datetime(2020, 1, 1) + timedelta(minutes=i),
+        'company_id': company_id,
+        'company_name': 'Company %d' % company_id
+    }
+
+
+def seed(db, models, tier, seed_value=0):
+    '''Fill empty tables with the row counts of the given scale tier.
+
+    Rows are inserted in id order into freshly created tables, so the
+    n-th row of each table has id n.'''
+    sizes = SCALE_TIERS[tier]
+    rng = random.Random(seed_value)
+    engine = db.engine
+
+    companies = [company_row(rng, i) for i in range(1, sizes['companies'] + 1)]
+    engine.execute(models.Company.__table__.insert(), companies)
+
+    candidates = [candidate_row(rng, i)
+                  for i in range(1, sizes['candidates'] + 1)]
+    engine.execute(models.Candidate.__table__.insert(), candidates)
+
+    vacancies = [vacancy_row(rng, i, (i - 1) % sizes['companies'] + 1)
+                 for i in range(1, sizes['vacancies'] + 1)]
+    engine.execute(models.Vacancy.__table__.insert(), vacancies)
+
+    applications = []
+    for candidate_id in range(1, sizes['candidates'] + 1):
+        picked = rng.sample(range(1, sizes['vacancies'] + 1),
+                            sizes['applications_per_candidate'])
+        for vacancy_id in picked:
+            applications.append({
+                'company_id': vacancies[vacancy_id - 1]['company_id'],
+                'vacancy_id': vacancy_id,
+                'candidate_id': candidate_id,
+                'cover_letter': text(rng, 1, 3),
+                'date_submitted': datetime(2020, 6, 1) + timedelta(
+                    minutes=len(applications))
+            })
+    engine.execute(models.Application.__table__.insert(), applications)
+    with engine.begin() as connection:
+        models.reconcile_application_counts(connection)
+
+    return {
+        'companies': len(companies),
+        'candidates': len(candidates),
+        'vacancies': len(vacancies),
+        'applications': len(applications),
+        'vacancies_with_applications': sorted(
+            set(a['vacancy_id'] for a in applications))
+    }
+
+
+def boot_app(database_url, tier, **config):
+    '''Create the app on a freshly created and seeded database; `config`
+    is added to the configuration of the app.'''
+    from app import create_app
+    import models
+    from models import db
+
+    # a single benchmark client would be rate limited by admission.py
+    app = create_app(dict({'DATABASE_URL': database_url,
+                           'ADMISSION_LIMITS': {}}, **config))
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        ctx = seed(db, models, tier)
+    return app, ctx
+
+
+class TestClientDriver:
+    name = 'test-client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        res = self.client.open(path, method=method, json=body,
+                               headers=headers)
+        return res.status_code
+
+    def close(self):
+        pass
+
+
+class HTTPDriver:
+    name = 'http'
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        conn = http.client.HTTPConnection(self.host, self.port)
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            res = conn.getresponse()
+            res.read()
+            return res.status
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+class WSGIServerDriver(HTTPDriver):
+    '''Serves the app with Werkzeug's threaded server on a free port.'''
+    name = 'wsgi-server'
+
+    def __init__(self, app):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietHandler)
+        HTTPDriver.__init__(self, '127.0.0.1', self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(sorted_values, p):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(p / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, elapsed, errors=0):
+    '''Summarize request latencies (in seconds) measured over `elapsed`
+    seconds of wall time. Latencies are reported in milliseconds.'''
+    values = sorted(latencies)
+    count = len(values)
+
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 3)
+
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput_rps': round(count / elapsed, 2) if elapsed else None,
+        'mean_ms': ms(sum(values) / count) if count else None,
+        'p50_ms': ms(percentile(values, 50)),
+        'p95_ms': ms(percentile(values, 95)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None
+    }
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z'
+    }
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_table(routes):
+    header = '%-45s %8s %10s %9s %9s %9s %6s' % (
+        'route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors')
+    print(header)
+    print('-' * len(header))
+    for name in sorted(routes):
+        r = routes[name]
+        print('%-45s %8d %10s %9s %9s %9s %6d' % (
+            name, r['requests'], r['throughput_rps'], r['p50_ms'],
+            r['p95_ms'], r['p99_ms'], r['errors']))
+
+
+def compare(routes, baseline_routes, metric='p95_ms'):
+    '''Print the relative change of `metric` against a baseline run and
+    return the worst regression in percent.'''
+    worst = 0.0
+    print('\n%-45s %12s %12s %9s' % ('route', 'baseline', 'current',
+                                     'change'))
+    for name in sorted(routes):
+        if name not in baseline_routes:
+            continue
+        before = baseline_routes[name].get(metric)
+        after = routes[name].get(metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100.0
+        worst = max(worst, change)
+        print('%-45s %12s %12s %+8.1f%%' % (name, before, after, change))
+    return worst
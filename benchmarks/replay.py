@@ -0,0 +1,180 @@
+'''
+Replay captured traffic
+
+Re-issues requests recorded by the TRAFFIC_CAPTURE_FILE middleware
+(traffic.py) with their original spacing, or `--speed` times faster,
+and reports the latency distribution per route.
+
+Requests go either to a running instance (`--target`, with `--token`
+sent on every request) or, by default, to a local instance booted on a
+seeded SQLite database whose tokens are signed locally. Captured request
+bodies are not stored, so POST/PATCH requests carry a placeholder body of
+the captured size:
+
+    python -m benchmarks.replay capture.log capture.log.1 --speed 2
+    python -m benchmarks.replay capture.log --target 127.0.0.1:5000 \\
+        --token "$USER_TOKEN_COMPANY" --out replay.json
+'''
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from benchmarks.common import (
+    SCALE_TIERS,
+    HTTPDriver,
+    WSGIServerDriver,
+    boot_app,
+    default_database_url,
+    environment,
+    print_table,
+    save_results,
+    summarize
+)
+
+ROUTE_PARAMETER = re.compile(r'<(?:[^:<>]+:)?([^<>]+)>')
+
+
+def load_capture(paths):
+    '''Read captured requests from the given files, oldest first.'''
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records = [r for r in records if r.get('route')]
+    records.sort(key=lambda r: r['ts'])
+    return records
+
+
+def build_path(record):
+    view_args = record.get('view_args') or {}
+    path = ROUTE_PARAMETER.sub(
+        lambda m: str(view_args.get(m.group(1), m.group(0))),
+        record['route'])
+    if record.get('args'):
+        path += '?' + urlencode(record['args'], doseq=True)
+    return path
+
+
+def placeholder_body(record):
+    if record['method'] not in ('POST', 'PATCH', 'PUT'):
+        return None
+    size = record.get('body_bytes') or 0
+    return {'padding': 'x' * max(0, size - len('{"padding": ""}'))}
+
+
+def replay(driver, records, speed, workers, headers):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lags = []
+    lock = threading.Lock()
+
+    def issue(record, due):
+        lag = time.perf_counter() - due
+        name = '%s %s' % (record['method'], record['route'])
+        start = time.perf_counter()
+        status = driver.request(record['method'], build_path(record),
+                                placeholder_body(record), headers)
+        elapsed = time.perf_counter() - start
+        with lock:
+            lags.append(lag)
+            latencies[name].append(elapsed)
+            if status >= 500:
+                errors[name] += 1
+
+    first_ts = records[0]['ts']
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for record in records:
+            due = started + (record['ts'] - first_ts) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(issue, record, due)
+    elapsed = time.perf_counter() - started
+
+    routes = {name: summarize(values, elapsed, errors[name])
+              for name, values in latencies.items()}
+    return routes, summarize(lags, elapsed), elapsed
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('capture', nargs='+', help='captured traffic files')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay rate as a multiple of the original')
+    parser.add_argument('--workers', type=int, default=32,
+                        help='maximum number of requests in flight')
+    parser.add_argument('--target',
+                        help='host:port of a running instance (default: '
+                             'boot a local instance)')
+    parser.add_argument('--token', help='bearer token sent with --target')
+    parser.add_argument('--database',
+                        help='database of the local instance (default: '
+                             'temporary SQLite file)')
+    parser.add_argument('--tier', choices=sorted(SCALE_TIERS),
+                        default='medium',
+                        help='scale tier seeded into the local instance')
+    parser.add_argument('--out', help='save results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    records = load_capture(args.capture)
+    if not records:
+        print('No captured requests found.')
+        return 1
+
+    signer = None
+    if args.target:
+        host, _, port = args.target.partition(':')
+        driver = HTTPDriver(host, int(port or 80))
+        token = args.token
+    else:
+        from auth_stub import (
+            CANDIDATE_PERMISSIONS,
+            COMPANY_PERMISSIONS,
+            LocalAuth
+        )
+        app, ctx = boot_app(args.database or default_database_url(),
+                            args.tier)
+        signer = LocalAuth().install()
+        token = signer.token(COMPANY_PERMISSIONS + CANDIDATE_PERMISSIONS)
+        driver = WSGIServerDriver(app)
+    headers = {'Authorization': 'Bearer ' + token} if token else None
+
+    try:
+        routes, lag, elapsed = replay(driver, records, args.speed,
+                                      args.workers, headers)
+    finally:
+        driver.close()
+        if signer is not None:
+            signer.uninstall()
+
+    print_table(routes)
+    print('\n%d requests replayed in %.1fs at %gx; dispatch lag p99 %s ms'
+          % (len(records), elapsed, args.speed, lag['p99_ms']))
+
+    if args.out:
+        save_results(args.out, {
+            'meta': dict(environment(),
+                         captured_requests=len(records),
+                         speed=args.speed,
+                         target=args.target or 'local'),
+            'dispatch_lag': lag,
+            'routes': routes
+        })
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+'''
+Change notifications
+
+Modules that keep data derived from the vacancies or the companies
+subscribe here. After a session has committed, every subscriber of a
+model is called with the list of (action, id) of that model written by
+the transaction, action being "insert", "update" or "delete". Nothing
+is sent for rolled back transactions. Writes that bypass the ORM (bulk
+statements, the ASGI app, other processes) are not seen.
+'''
+import sys
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from models import Company, Vacancy
+
+INFO_KEY = 'changes'
+MODELS = (Vacancy, Company)
+
+_subscribers = {model: [] for model in MODELS}
+
+
+def subscribe(callback, model=Vacancy):
+    _subscribers[model].append(callback)
+
+
+def unsubscribe(callback, model=Vacancy):
+    if callback in _subscribers[model]:
+        _subscribers[model].remove(callback)
+
+
+def _record(model, action):
+    def record(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(INFO_KEY, {}).setdefault(
+                model, []).append((action, target.id))
+    return record
+
+
+for _model in MODELS:
+    for _action in ('insert', 'update', 'delete'):
+        event.listen(_model, 'after_' + _action, _record(_model, _action))
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify(session):
+    changes = session.info.pop(INFO_KEY, None)
+    if not changes:
+        return
+    for model, model_changes in changes.items():
+        for callback in list(_subscribers[model]):
+            try:
+                callback(model_changes)
+            except Exception:
+                print(sys.exc_info())
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop(INFO_KEY, None)
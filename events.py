@@ -0,0 +1,256 @@
+'''
+Live events
+
+Server-Sent Events streams of the ASGI app (asgi.py), served from the
+event loop so that an idle connection costs one task and a small queue:
+
+    GET /events/vacancies?city=&region=&company_id=&min_salary=
+        new vacancies matching the filters, for candidates
+    GET /events/applications?company_id=&vacancy_id=
+        new applications to the vacancies of a company, for the users
+        of that company (see auth.check_company)
+
+The write handlers publish events through a broker that fans them out
+to the streams of its process. EVENTS_BACKEND chooses how events reach
+the broker:
+
+    memory    (default) directly, so only the writes of the same ASGI
+              process are seen; enough for one process or locally
+    postgres  through Postgres NOTIFY, so the streams of every ASGI
+              process also see the writes of the others and of the
+              Flask app (sent in the transaction of the write)
+
+The Procfile runs the Flask app and the ASGI app as separate processes,
+so it sets EVENTS_BACKEND=postgres for both unless it is set already.
+
+Events are delivered at most once: a stream whose client cannot keep up
+is closed, and clients that reconnect catch up with the delta sync
+(sync.py).
+'''
+import asyncio
+import json
+import os
+import sys
+
+from flask.json import JSONEncoder
+from sqlalchemy import event, func, select
+
+from models import Application, Vacancy
+
+BACKEND = 'memory'
+QUEUE_SIZE = 100
+KEEPALIVE_SECONDS = 15.0
+RECONNECT_SECONDS = 5.0
+# channel -> filters of its streams
+CHANNELS = {
+    'vacancy': ('city', 'region', 'company_id', 'min_salary'),
+    'application': ('company_id', 'vacancy_id')
+}
+INTEGER_FILTERS = ('company_id', 'vacancy_id', 'min_salary')
+
+
+def vacancy_event(vacancy):
+    return {
+        'id': vacancy.id,
+        'job_title': vacancy.job_title,
+        'city': vacancy.city,
+        'region': vacancy.region,
+        'min_salary': vacancy.min_salary,
+        'company_id': vacancy.company_id
+    }
+
+
+def application_event(application):
+    return {
+        'id': application.id,
+        'company_id': application.company_id,
+        'vacancy_id': application.vacancy_id,
+        'candidate_id': application.candidate_id,
+        'date_submitted': application.date_submitted
+    }
+
+
+def encode_event(data):
+    return json.dumps(data, cls=JSONEncoder)
+
+
+def notify(channel, data):
+    '''Postgres NOTIFY of an event, delivered when its transaction
+    commits'''
+    return select([func.pg_notify(channel, encode_event(data))])
+
+
+def matches(data, filters):
+    for name, value in filters.items():
+        if name == 'min_salary':
+            if data.get('min_salary') is None or data['min_salary'] < value:
+                return False
+        elif data.get(name) != value:
+            return False
+    return True
+
+
+def stream_filters(channel, params):
+    '''Filters of a stream from its query parameters; None if invalid'''
+    filters = {}
+    for name in CHANNELS[channel]:
+        value = params.get(name)
+        if not value:
+            continue
+        if name in INTEGER_FILTERS:
+            try:
+                value = int(value)
+            except ValueError:
+                return None
+        filters[name] = value
+    return filters
+
+
+class Stream:
+    def __init__(self, channel, filters, queue_size):
+        self.channel = channel
+        self.filters = filters
+        self.queue = asyncio.Queue(queue_size)
+
+
+class Broker:
+    '''Fans the events published in this process out to its streams'''
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.streams = {channel: set() for channel in CHANNELS}
+
+    def subscribe(self, channel, filters):
+        stream = Stream(channel, filters, self.queue_size)
+        self.streams[channel].add(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        self.streams[stream.channel].discard(stream)
+
+    def publish(self, channel, data):
+        for stream in list(self.streams[channel]):
+            if not matches(data, stream.filters):
+                continue
+            try:
+                stream.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # the client does not keep up; it is disconnected and
+                # has to catch up
+                self.unsubscribe(stream)
+                while not stream.queue.empty():
+                    stream.queue.get_nowait()
+                stream.queue.put_nowait(None)
+
+    async def events(self, channel, filters, keepalive):
+        '''Server-Sent Events of a new stream, with a comment every
+        `keepalive` seconds so that proxies keep the connection open'''
+        stream = self.subscribe(channel, filters)
+        try:
+            yield 'retry: %d\n\n' % (RECONNECT_SECONDS * 1000)
+            while True:
+                try:
+                    data = await asyncio.wait_for(stream.queue.get(),
+                                                  keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                if data is None:
+                    return
+                yield 'event: %s\ndata: %s\n\n' % (
+                    stream.channel, encode_event(data))
+        finally:
+            self.unsubscribe(stream)
+
+
+class MemoryBackend:
+    def __init__(self, broker):
+        self.broker = broker
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, database, channel, data):
+        self.broker.publish(channel, data)
+
+
+class PostgresBackend:
+    '''Publishes with NOTIFY and listens on a dedicated asyncpg
+    connection, which is opened again when it is lost'''
+
+    def __init__(self, broker, database_url):
+        self.broker = broker
+        self.database_url = database_url
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.ensure_future(self.listen())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def publish(self, database, channel, data):
+        await database.execute(notify(channel, data))
+
+    def received(self, connection, pid, channel, payload):
+        self.broker.publish(channel, json.loads(payload))
+
+    async def listen(self):
+        # only needed with Postgres, like the asyncpg driver of databases
+        import asyncpg
+
+        while True:
+            lost = asyncio.Event()
+            try:
+                connection = await asyncpg.connect(self.database_url)
+                connection.add_termination_listener(
+                    lambda connection: lost.set())
+                for channel in CHANNELS:
+                    await connection.add_listener(channel, self.received)
+                try:
+                    await lost.wait()
+                finally:
+                    await connection.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(sys.exc_info())
+            await asyncio.sleep(RECONNECT_SECONDS)
+
+
+def events_backend(broker, database_url):
+    backend = os.environ.get('EVENTS_BACKEND', BACKEND)
+    if backend == 'postgres':
+        return PostgresBackend(broker, database_url)
+    return MemoryBackend(broker)
+
+
+'''
+setup_events(app)
+    makes the ORM publish the new vacancies and applications of the
+    Flask app when EVENTS_BACKEND is "postgres"; with the memory backend
+    nobody could receive them, as the streams are served by the ASGI app
+'''
+
+
+def publish_vacancy(mapper, connection, vacancy):
+    connection.execute(notify('vacancy', vacancy_event(vacancy)))
+
+
+def publish_application(mapper, connection, application):
+    connection.execute(notify('application', application_event(application)))
+
+
+def setup_events(app):
+    backend = app.config.get('EVENTS_BACKEND',
+                             os.environ.get('EVENTS_BACKEND', BACKEND))
+    if backend != 'postgres':
+        return
+    for model, listener in ((Vacancy, publish_vacancy),
+                            (Application, publish_application)):
+        if not event.contains(model, 'after_insert', listener):
+            event.listen(model, 'after_insert', listener)
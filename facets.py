@@ -0,0 +1,151 @@
+'''
+Vacancy search facets
+
+GET /vacancies/facets?city=&region=&industry=&salary= returns the number
+of vacancies per city, region, industry (of the company) and minimum
+salary bucket. The counts of a facet honour the filters on the other
+facets but not its own, so the values of a facet stay selectable.
+
+The vacancies are counted by one grouped query over the four columns;
+its rows are cached and every request adds them up for its filters. The
+cache is dropped after vacancy and company writes of the app (see
+changes.py) and expires after VACANCY_FACETS_CACHE_SECONDS for writes
+it does not see, like those of the ASGI app.
+'''
+import os
+import time
+
+from flask import abort, jsonify, request
+from sqlalchemy import case, func, select
+
+from changes import subscribe
+from metrics import metrics
+from models import Company, Vacancy
+
+CACHE_SECONDS = 60.0
+# lower bounds of the salary buckets, the last one is open-ended
+SALARY_BUCKETS = (0, 25000, 50000, 75000, 100000, 150000)
+FACETS = ('city', 'region', 'industry', 'salary')
+
+
+def salary_bucket_label(bucket):
+    if bucket == len(SALARY_BUCKETS) - 1:
+        return '%d+' % SALARY_BUCKETS[bucket]
+    return '%d-%d' % (SALARY_BUCKETS[bucket], SALARY_BUCKETS[bucket + 1])
+
+
+SALARY_LABELS = [salary_bucket_label(bucket)
+                 for bucket in range(len(SALARY_BUCKETS))]
+
+
+def salary_bucket(column):
+    '''Index of the salary bucket of `column` in SQL, NULL without salary'''
+    return case([(column < lower, bucket - 1)
+                 for bucket, lower in enumerate(SALARY_BUCKETS) if bucket]
+                + [(column.isnot(None), len(SALARY_BUCKETS) - 1)],
+                else_=None)
+
+
+def load_facet_rows(connection):
+    '''(city, region, industry, salary bucket, count) of the vacancies'''
+    vacancies = Vacancy.__table__
+    companies = Company.__table__
+    columns = [vacancies.c.city, vacancies.c.region, companies.c.industry,
+               salary_bucket(vacancies.c.min_salary)]
+    return connection.execute(
+        select(columns + [func.count()])
+        .select_from(vacancies.join(
+            companies, vacancies.c.company_id == companies.c.id))
+        .group_by(*columns)).fetchall()
+
+
+def count_facets(rows, filters):
+    '''Counts of every facet value in `rows` that match the filters of
+    the other facets, and the number of vacancies matching all filters'''
+    counts = {facet: {} for facet in FACETS}
+    total = 0
+    for row in rows:
+        values = row[:len(FACETS)]
+        failed = [i for i, value in enumerate(values)
+                  if filters[i] is not None and filters[i] != value]
+        if not failed:
+            total += row[-1]
+        if len(failed) > 1:
+            continue
+        for i, value in enumerate(values):
+            if value is not None and (not failed or failed == [i]):
+                counts[FACETS[i]][value] = \
+                    counts[FACETS[i]].get(value, 0) + row[-1]
+    return counts, total
+
+
+def format_facet(facet, counts):
+    if facet == 'salary':
+        return [{'value': SALARY_LABELS[bucket], 'count': count}
+                for bucket, count in sorted(counts.items())]
+    return [{'value': value, 'count': count} for value, count in
+            sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+
+
+class VacancyFacets:
+    def __init__(self, db, ttl):
+        self.db = db
+        self.ttl = ttl
+        self.rows = None
+        self.expires = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def get_rows(self):
+        rows = self.rows
+        if rows is not None and time.monotonic() < self.expires:
+            self.hits += 1
+            return rows
+        self.misses += 1
+        generation = self.generation
+        expires = time.monotonic() + self.ttl
+        rows = load_facet_rows(self.db.session)
+        # not cached when vacancies were written while loading
+        if generation == self.generation:
+            self.rows = rows
+            self.expires = expires
+        return rows
+
+    def invalidate(self, changes=None):
+        self.generation += 1
+        self.rows = None
+
+
+def requested_filters():
+    filters = [request.args.get(facet) or None for facet in FACETS]
+    salary = filters[-1]
+    if salary is not None:
+        if salary not in SALARY_LABELS:
+            abort(400)
+        filters[-1] = SALARY_LABELS.index(salary)
+    return filters
+
+
+def setup_vacancy_facets(app, db):
+    facets = VacancyFacets(db, float(app.config.get(
+        'VACANCY_FACETS_CACHE_SECONDS',
+        os.environ.get('VACANCY_FACETS_CACHE_SECONDS', CACHE_SECONDS))))
+    app.extensions['vacancy_facets'] = facets
+    subscribe(facets.invalidate, Vacancy)
+    subscribe(facets.invalidate, Company)
+    metrics.register_cache('vacancy_facets',
+                           lambda: (facets.hits, facets.misses))
+
+    # Get the number of vacancies per value of the search filters
+    @app.route('/vacancies/facets', methods=['GET'])
+    def get_vacancy_facets():
+        filters = requested_filters()
+        counts, total = count_facets(facets.get_rows(), filters)
+
+        return jsonify({
+          'success': True,
+          'total': total,
+          'facets': {facet: format_facet(facet, counts[facet])
+                     for facet in FACETS}
+        })
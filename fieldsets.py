@@ -0,0 +1,106 @@
+'''
+Sparse fieldsets and includes
+
+?fields=job_title,city returns only these fields of every item and
+selects only their columns in SQL; the id is always returned.
+
+?include=company,application_count adds related data to the items. Each
+relation is loaded with one query for all items of the response, by the
+keys collected from the items (like a dataloader), instead of one query
+per item; application_count is read from the counter of the vacancy.
+Unknown fields or includes are rejected with 400.
+'''
+from flask import abort, request
+from sqlalchemy.orm import load_only, undefer_group
+
+from models import Company, Vacancy
+
+
+def _requested_names(argument):
+    value = request.args.get(argument)
+    if value is None:
+        return None
+    names = list(dict.fromkeys(
+        name.strip() for name in value.split(',') if name.strip()))
+    if not names:
+        abort(400)
+    return names
+
+
+def load_companies(company_ids):
+    return {company.id: company.format() for company in
+            Company.query.options(undefer_group('text')).filter(
+                Company.id.in_(company_ids)).all()}
+
+
+class Include:
+    '''Loads the values of an include for a list of keys at once;
+    `batch(keys)` returns {key: value}, missing keys get `default`.
+    Without `batch` the value is the key column itself.'''
+
+    def __init__(self, key, batch, default=None):
+        self.key = key
+        self.batch = batch
+        self.default = default
+
+    def add_to(self, name, items, rows):
+        if self.batch is None:
+            for item, row in zip(items, rows):
+                item[name] = getattr(row, self.key)
+            return
+        keys = list(dict.fromkeys(getattr(row, self.key) for row in rows))
+        values = self.batch(keys) if keys else {}
+        for item, row in zip(items, rows):
+            item[name] = values.get(getattr(row, self.key), self.default)
+
+
+class Fieldset:
+    '''Fields and includes requested for items of `model`'''
+
+    def __init__(self, model, includes=None):
+        self.model = model
+        self.columns = model.__table__.columns.keys()
+        self.fields = _requested_names('fields')
+        self.includes = _requested_names('include') or []
+        available = includes or {}
+        if self.fields is not None and any(
+                name not in self.columns for name in self.fields):
+            abort(400)
+        if any(name not in available for name in self.includes):
+            abort(400)
+        self.loaders = [(name, available[name]) for name in self.includes]
+
+    def query(self, default_query):
+        '''`default_query` when all fields are returned, otherwise a query
+        of the model that loads only the requested columns'''
+        if self.fields is None:
+            return default_query
+        required = ['id'] + [loader.key for name, loader in self.loaders]
+        return self.model.query.options(
+            load_only(*dict.fromkeys(required + self.fields)))
+
+    def format(self, rows, default_format):
+        if self.fields is None:
+            items = [default_format(row) for row in rows]
+        else:
+            items = [dict({'id': row.id}, **{
+                name: getattr(row, name) for name in self.fields})
+                for row in rows]
+        for name, loader in self.loaders:
+            loader.add_to(name, items, rows)
+        return items
+
+
+VACANCY_INCLUDES = {
+    'company': Include('company_id', load_companies),
+    # kept for clients of the include, the counter is a column now
+    'application_count': Include('application_count', None)
+}
+
+
+def vacancy_fieldset():
+    return Fieldset(Vacancy, VACANCY_INCLUDES)
+
+
+def company_fieldset():
+    return Fieldset(Company)
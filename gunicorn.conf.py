@@ -0,0 +1,69 @@
+'''
+Gunicorn settings for production serving
+
+The app is imported once in the master process (preload_app) and the
+workers are forked from it, so they share its memory copy-on-write.
+Workers are recycled after GUNICORN_MAX_REQUESTS requests and
+`kill -HUP <master pid>` reloads them gracefully. Database connections
+inherited from the master are discarded in every new worker.
+
+    gunicorn --config gunicorn.conf.py 'app:create_app()'
+
+GUNICORN_WORKER_CLASS selects "gthread" (default, GUNICORN_THREADS
+threads per worker) or "gevent" (requires gevent, and psycogreen for
+cooperative Postgres connections).
+'''
+import multiprocessing
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '5000')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS',
+                                        1000))
+
+preload_app = True
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER',
+                                         max_requests // 10))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+
+def on_starting(server):
+    # Snapshots of the previous deployment's workers must not be summed up.
+    # The preloaded app already uses the directory, so only the snapshot
+    # files are removed.
+    from metrics import remove_snapshots
+    directory = os.environ.get('METRICS_MULTIPROC_DIR')
+    if directory:
+        remove_snapshots(directory)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            pass
+
+    # Connections opened by the master must not be shared between workers
+    from metrics import metrics
+    from models import db
+    db.get_engine(server.app.wsgi()).dispose()
+    metrics.reset()
+
+
+def child_exit(server, worker):
+    # Recycled workers would otherwise leave one snapshot file each
+    from metrics import fold_snapshot
+    directory = os.environ.get('METRICS_MULTIPROC_DIR')
+    if directory:
+        fold_snapshot(directory, worker.pid)
@@ -0,0 +1,262 @@
+'''
+Idempotency keys for POST routes
+
+A POST request carrying an Idempotency-Key header is served once; its
+response is stored for IDEMPOTENCY_TTL seconds and retries with the same
+key get the stored response (marked with Idempotent-Replayed: true)
+without running the handler again. Keys are scoped to the subject of
+the bearer token, which is verified before any stored response is looked
+up; requests without a valid token are served without idempotency and
+rejected by requires_auth. Reusing a key for a different request is
+rejected with 422. A retry that arrives while the first request is still
+being served waits for it, at most IDEMPOTENCY_WAIT seconds (409 after
+that).
+
+IDEMPOTENCY_STORE selects where responses are kept:
+
+- "memory" (default) keeps the IDEMPOTENCY_MAX_KEYS most recent keys in
+  the worker process. Every worker has its own keys, so a retry served
+  by another worker runs again: with several workers, as in the
+  gunicorn deployment of the Procfile, use "database"
+- "database" keeps them in the idempotency_keys table, shared by all
+  workers. A key whose first request is still running is only held for
+  IDEMPOTENCY_LEASE seconds, so that retries can take over the key of a
+  worker that died before storing its response
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import Response, g, jsonify, request
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+from auth import AuthError, get_token_auth_header, get_verified_payload
+from models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+TTL = 24 * 60 * 60
+MAX_KEYS = 10000
+WAIT = 10.0
+# longest time a request may hold a key of the database store; at least
+# the gunicorn worker timeout
+LEASE = 30.0
+POLL_INTERVAL = 0.05
+# Responses a retry should not get again: authorization failures, shed
+# or conflicting requests and server errors
+NOT_STORED = (401, 403, 409, 429)
+
+
+class MemoryStore:
+    def __init__(self, max_keys, ttl):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.records = OrderedDict()
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        record = self.records.get(key)
+        if record is not None and record['expires'] < time.time():
+            del self.records[key]
+            return None
+        return record
+
+    def acquire(self, key, fingerprint, timeout):
+        '''Returns the stored record of `key`, or None when the caller
+        now owns the key and must call release(); raises TimeoutError
+        when another request keeps it for longer than `timeout`.'''
+        with self.lock:
+            record = self._get(key)
+            if record is not None:
+                return record
+            entry = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        if not entry[0].acquire(timeout=timeout):
+            self._leave(key, entry)
+            raise TimeoutError(key)
+        with self.lock:
+            record = self._get(key)
+        if record is not None:
+            entry[0].release()
+            self._leave(key, entry)
+        return record
+
+    def _leave(self, key, entry):
+        with self.lock:
+            entry[1] -= 1
+            if not entry[1]:
+                self.key_locks.pop(key, None)
+
+    def release(self, key, record=None):
+        entry = self.key_locks[key]
+        if record is not None:
+            with self.lock:
+                self.records[key] = dict(record,
+                                         expires=time.time() + self.ttl)
+                self.records.move_to_end(key)
+                while len(self.records) > self.max_keys:
+                    self.records.popitem(last=False)
+        entry[0].release()
+        self._leave(key, entry)
+
+
+class DatabaseStore:
+    '''Uses connections of its own, so that a pending key is visible to
+    the other workers before the handler has committed.'''
+
+    def __init__(self, engine, ttl, lease=LEASE):
+        self.engine = engine
+        self.ttl = ttl
+        self.lease = lease
+        self.table = IdempotencyKey.__table__
+        # (key, thread) -> expiry of the pending row inserted by a request
+        # of this process, which tells it from the row of a request that
+        # took the key over
+        self.leases = {}
+
+    def _get(self, connection, key):
+        '''The row of `key`; expired rows, stored responses or pending
+        rows of a request that did not finish in time, are deleted'''
+        now = datetime.utcnow()
+        row = connection.execute(self.table.select().where(
+            self.table.c.key == key)).first()
+        if row is not None and row['expires'] < now:
+            connection.execute(self.table.delete().where(and_(
+                self.table.c.key == key, self.table.c.expires < now)))
+            return None
+        return row
+
+    def acquire(self, key, fingerprint, timeout):
+        deadline = time.time() + timeout
+        while True:
+            with self.engine.begin() as connection:
+                row = self._get(connection, key)
+                if row is not None and row['status'] is not None:
+                    return dict(row)
+            if row is None:
+                expires = datetime.utcnow() + timedelta(seconds=self.lease)
+                try:
+                    with self.engine.begin() as connection:
+                        connection.execute(self.table.insert().values(
+                            key=key, fingerprint=fingerprint,
+                            expires=expires))
+                    self.leases[key, threading.get_ident()] = expires
+                    return None
+                except IntegrityError:
+                    pass
+            if time.time() >= deadline:
+                raise TimeoutError(key)
+            time.sleep(POLL_INTERVAL)
+
+    def release(self, key, record=None):
+        owned = and_(self.table.c.key == key,
+                     self.table.c.status.is_(None),
+                     self.table.c.expires == self.leases.pop(
+                         (key, threading.get_ident()), None))
+        with self.engine.begin() as connection:
+            if record is None:
+                connection.execute(self.table.delete().where(owned))
+                return
+            connection.execute(self.table.update().where(owned).values(
+                status=record['status'], body=record['body'],
+                content_type=record['content_type'],
+                expires=datetime.utcnow() + timedelta(seconds=self.ttl)))
+            # expired keys of other clients are removed along the way
+            connection.execute(self.table.delete().where(
+                self.table.c.expires < datetime.utcnow()))
+
+
+def _error(status, message):
+    response = jsonify({
+      'success': False,
+      'error': status,
+      'message': message
+    })
+    response.status_code = status
+    return response
+
+
+def _verified_subject():
+    '''Subject of the bearer token, None without a valid token. The
+    payload is kept for requires_auth, which does not verify it again.'''
+    try:
+        return get_verified_payload(get_token_auth_header()).get('sub')
+    except AuthError:
+        return None
+
+
+def _replay(record):
+    response = Response(record['body'], status=record['status'],
+                        content_type=record['content_type'])
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def setup_idempotency(app, db):
+    ttl = float(app.config.get(
+        'IDEMPOTENCY_TTL', os.environ.get('IDEMPOTENCY_TTL', TTL)))
+    wait = float(app.config.get(
+        'IDEMPOTENCY_WAIT', os.environ.get('IDEMPOTENCY_WAIT', WAIT)))
+    kind = app.config.get(
+        'IDEMPOTENCY_STORE', os.environ.get('IDEMPOTENCY_STORE', 'memory'))
+    if kind == 'database':
+        store = DatabaseStore(db.get_engine(app), ttl, float(app.config.get(
+            'IDEMPOTENCY_LEASE', os.environ.get('IDEMPOTENCY_LEASE', LEASE))))
+    else:
+        store = MemoryStore(int(app.config.get(
+            'IDEMPOTENCY_MAX_KEYS',
+            os.environ.get('IDEMPOTENCY_MAX_KEYS', MAX_KEYS))), ttl)
+    app.extensions['idempotency'] = store
+
+    @app.before_request
+    def replay_response():
+        key = request.headers.get(HEADER)
+        if request.method != 'POST' or not key:
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            return _error(400, 'Bad request')
+
+        subject = _verified_subject()
+        if subject is None:
+            return
+        scoped_key = hashlib.sha256(
+            ('%s\0%s' % (subject, key)).encode()).hexdigest()
+        fingerprint = hashlib.sha256(b'\0'.join([
+            request.method.encode(), request.full_path.encode(),
+            request.get_data()])).hexdigest()
+        try:
+            record = store.acquire(scoped_key, fingerprint, wait)
+        except TimeoutError:
+            return _error(409, 'Request with this idempotency key '
+                          'is in progress')
+        if record is None:
+            g.idempotency = (scoped_key, fingerprint)
+            return
+        if record['fingerprint'] != fingerprint:
+            return _error(422, 'Idempotency key was used for '
+                          'a different request')
+        return _replay(record)
+
+    @app.after_request
+    def store_response(response):
+        owned = g.get('idempotency')
+        if owned is not None and response.status_code < 500 and \
+                response.status_code not in NOT_STORED:
+            g.idempotency_record = {
+                'fingerprint': owned[1],
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'content_type': response.content_type
+            }
+        return response
+
+    @app.teardown_request
+    def release_key(exception=None):
+        owned = g.pop('idempotency', None)
+        if owned is not None:
+            store.release(owned[0], g.pop('idempotency_record', None))
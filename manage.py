@@ -1,14 +1,89 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
-
-from app import APP
-from models import db
-
-migrate = Migrate(APP, db)
-manager = Manager(APP)
-
-manager.add_command('db', MigrateCommand)
-
-
-if __name__ == '__main__':
-    manager.run()
+import os
+
+from flask_script import Command, Manager
+from flask_migrate import Migrate, MigrateCommand
+
+from app import create_app
+from models import (
+    backfill_updated_at,
+    copy_company_names,
+    db,
+    purge_tombstones,
+    rebuild_application_rollups,
+    reconcile_application_counts
+)
+from sync import RETENTION_DAYS
+
+
+def make_app():
+    app = create_app()
+    Migrate(app, db)
+    return app
+
+
+class CreateDB(Command):
+    '''Creates the tables of all models that do not exist yet'''
+
+    def run(self):
+        db.create_all()
+
+
+class BackfillCompanyNames(Command):
+    '''Copies the company names to the company_name of their vacancies'''
+
+    def run(self):
+        db.session.execute(copy_company_names())
+        db.session.commit()
+
+
+class ReconcileCounters(Command):
+    '''Repairs the application counters that drifted from the
+    applications table; meant to be run periodically, e.g. by cron'''
+
+    def run(self):
+        repaired = reconcile_application_counts(db.session)
+        db.session.commit()
+        print('repaired %d application counters' % repaired)
+
+
+class BackfillRollups(Command):
+    '''Rebuilds the application rollups from the applications table'''
+
+    def run(self):
+        rebuild_application_rollups(db.session)
+        db.session.commit()
+
+
+class BackfillUpdatedAt(Command):
+    '''Stamps the companies and vacancies written before updated_at
+    existed, so that the delta sync returns them'''
+
+    def run(self):
+        backfill_updated_at(db.session)
+        db.session.commit()
+
+
+class PurgeTombstones(Command):
+    '''Deletes the tombstones older than DELTA_SYNC_RETENTION_DAYS;
+    meant to be run periodically, e.g. by cron'''
+
+    def run(self):
+        purged = purge_tombstones(db.session, float(os.environ.get(
+            'DELTA_SYNC_RETENTION_DAYS', RETENTION_DAYS)))
+        db.session.commit()
+        print('purged %d tombstones' % purged)
+
+
+manager = Manager(make_app)
+
+manager.add_command('db', MigrateCommand)
+manager.add_command('create_db', CreateDB())
+manager.add_command('backfill_company_names', BackfillCompanyNames())
+manager.add_command('reconcile_counters', ReconcileCounters())
+manager.add_command('backfill_rollups', BackfillRollups())
+manager.add_command('backfill_updated_at', BackfillUpdatedAt())
+manager.add_command('purge_tombstones', PurgeTombstones())
+
+
+if __name__ == '__main__':
+    manager.run()
@@ -0,0 +1,411 @@
+'''
+Prometheus metrics
+
+Records request counts, in-flight requests and latency and response size
+histograms per route template, plus database pool and cache statistics,
+and serves them in the Prometheus text format on /metrics.
+
+With several worker processes, set METRICS_MULTIPROC_DIR to a directory
+shared by the workers. Every process then writes a snapshot of its
+values there (at most every METRICS_FLUSH_INTERVAL seconds and on exit)
+and /metrics adds up the snapshots of all processes, so a scrape gives
+the same totals whichever worker answers it. The snapshots of exited
+workers are folded into one (fold_snapshot, called by gunicorn), so
+that recycled workers do not leave files behind.
+'''
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+FLUSH_INTERVAL = 1.0
+# counters and histograms of all exited processes
+DEAD_SNAPSHOT = 'metrics-dead.json'
+# times a scrape reads the snapshots again when a process was folded
+# while they were read
+COLLECT_ATTEMPTS = 3
+
+PREFIX = 'jobportal_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name -> (type, help) of every exported metric
+DESCRIPTIONS = {
+    'http_requests_total': (
+        'counter', 'HTTP requests by method, route and status.'),
+    'http_requests_in_flight': (
+        'gauge', 'HTTP requests currently being served.'),
+    'http_request_duration_seconds': (
+        'histogram', 'Time spent serving HTTP requests.'),
+    'http_response_size_bytes': (
+        'histogram', 'Size of HTTP response bodies.'),
+    'db_pool_size': (
+        'gauge', 'Connections kept open by the database pool.'),
+    'db_pool_checked_out': (
+        'gauge', 'Database connections currently in use.'),
+    'db_pool_overflow': (
+        'gauge', 'Database connections opened beyond the pool size.'),
+    'cache_hits_total': ('counter', 'Cache lookups answered by the cache.'),
+    'cache_misses_total': ('counter', 'Cache lookups that missed.'),
+    'cache_hit_ratio': ('gauge', 'Share of cache lookups that hit.')
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in labels)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.in_flight = 0
+        self.gauge_collectors = []
+        self.caches = {}
+        self.directory = None
+        self.flush_interval = FLUSH_INTERVAL
+        self.next_flush = 0.0
+
+    def reset(self):
+        '''Forget the values inherited from a parent process.'''
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.in_flight = 0
+            self.next_flush = 0.0
+
+    def describe(self, name, kind, help_text):
+        DESCRIPTIONS.setdefault(name, (kind, help_text))
+
+    def inc(self, name, labels=None, amount=1):
+        key = (name, _labels_key(labels or {}))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, buckets, labels, value):
+        key = (name, _labels_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # one slot per bucket, +Inf, then the sum
+                histogram = self.histograms[key] = \
+                    [0] * (len(buckets) + 1) + [0.0]
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def register_gauges(self, collector):
+        '''`collector()` returns a list of (name, labels, value).'''
+        self.gauge_collectors.append(collector)
+
+    def register_cache(self, name, stats):
+        '''`stats()` returns the (hits, misses) counted by a cache.'''
+        self.caches[name] = stats
+
+    def snapshot(self):
+        gauges = [('http_requests_in_flight', {}, self.in_flight)]
+        for collector in self.gauge_collectors:
+            try:
+                gauges.extend(collector())
+            except Exception:
+                pass
+        counters = []
+        for cache, stats in self.caches.items():
+            hits, misses = stats()
+            counters.append(('cache_hits_total', {'cache': cache}, hits))
+            counters.append(('cache_misses_total', {'cache': cache}, misses))
+        with self.lock:
+            counters.extend((name, dict(labels), value)
+                            for (name, labels), value
+                            in self.counters.items())
+            histograms = [(name, dict(labels), list(values))
+                          for (name, labels), values
+                          in self.histograms.items()]
+        return {
+            'pid': os.getpid(),
+            'counters': counters,
+            'gauges': [(name, dict(labels), value)
+                       for name, labels, value in gauges],
+            'histograms': histograms
+        }
+
+    def _path(self, pid):
+        return os.path.join(self.directory, 'metrics-%d.json' % pid)
+
+    def flush(self):
+        if not self.directory:
+            return
+        _write_snapshot(self._path(os.getpid()), self.snapshot())
+
+    def maybe_flush(self, now):
+        if self.directory and now >= self.next_flush:
+            self.next_flush = now + self.flush_interval
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        '''Snapshots of this and, in multi-process mode, every other
+        process. Gauges of processes that have exited are dropped.'''
+        snapshots = [self.snapshot()]
+        if self.directory:
+            for _ in range(COLLECT_ATTEMPTS):
+                others, consistent = self._read_snapshots()
+                if consistent:
+                    break
+            snapshots.extend(others)
+        return snapshots
+
+    def _read_snapshots(self):
+        '''(snapshots of the other processes, False if a process was
+        folded into the dead snapshot meanwhile and could be missed)'''
+        dead_path = os.path.join(self.directory, DEAD_SNAPSHOT)
+        dead = _read_snapshot(dead_path)
+        snapshots = [dead] if dead else []
+        folded = set(dead['folded']) if dead else set()
+        own = os.getpid()
+        for path in glob.glob(os.path.join(self.directory,
+                                           'metrics-*.json')):
+            if path == dead_path:
+                continue
+            snapshot = _read_snapshot(path)
+            if snapshot is None or snapshot['pid'] == own \
+                    or snapshot['pid'] in folded:
+                continue
+            if not _alive(snapshot['pid']):
+                snapshot['gauges'] = []
+            snapshots.append(snapshot)
+        after = _read_snapshot(dead_path)
+        return snapshots, set(after['folded'] if after else ()) <= folded
+
+    def render(self):
+        counters = {}
+        gauges = {}
+        histograms = {}
+        for snapshot in self.collect():
+            _add(counters, snapshot['counters'])
+            _add(gauges, snapshot['gauges'])
+            _add(histograms, snapshot['histograms'])
+
+        for (name, labels), _ in list(counters.items()):
+            if name == 'cache_hits_total':
+                hits = counters[(name, labels)]
+                misses = counters.get(('cache_misses_total', labels), 0)
+                lookups = hits + misses
+                gauges[('cache_hit_ratio', labels)] = \
+                    hits / lookups if lookups else 0.0
+
+        lines = []
+        by_name = {}
+        for (name, labels), value in counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in gauges.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name in sorted(by_name):
+            self._header(lines, name)
+            for labels, value in sorted(by_name[name]):
+                lines.append('%s%s%s %s' % (PREFIX, name,
+                                            _format_labels(labels),
+                                            _number(value)))
+
+        for name in sorted(set(name for name, _ in histograms)):
+            buckets = _buckets_of(name)
+            self._header(lines, name)
+            for (hname, labels), values in sorted(histograms.items()):
+                if hname != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), values[:-1]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append('%s%s_bucket%s %d' % (
+                        PREFIX, name,
+                        _format_labels(labels + (('le', le),)), cumulative))
+                lines.append('%s%s_sum%s %s' % (
+                    PREFIX, name, _format_labels(labels),
+                    _number(values[-1])))
+                lines.append('%s%s_count%s %d' % (
+                    PREFIX, name, _format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name):
+        kind, help_text = DESCRIPTIONS.get(name, ('untyped', ''))
+        lines.append('# HELP %s%s %s' % (PREFIX, name, help_text))
+        lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+
+
+def _buckets_of(name):
+    if name == 'http_response_size_bytes':
+        return SIZE_BUCKETS
+    return LATENCY_BUCKETS
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(path, snapshot):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def _add(totals, entries):
+    for name, labels, value in entries:
+        key = (name, _labels_key(labels))
+        if isinstance(value, list):
+            total = totals.setdefault(key, [0] * len(value))
+            for i, item in enumerate(value):
+                total[i] += item
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def fold_snapshot(directory, pid):
+    '''Adds the counters and histograms of the exited process `pid` to
+    the snapshot of all exited processes and removes its own snapshot,
+    so that scrapes read one file per live process (plus one) while the
+    totals stay the same. Called by one process at a time.'''
+    path = os.path.join(directory, 'metrics-%d.json' % pid)
+    snapshot = _read_snapshot(path)
+    if snapshot is None:
+        return
+    dead_path = os.path.join(directory, DEAD_SNAPSHOT)
+    dead = _read_snapshot(dead_path) or {
+        'folded': [], 'counters': [], 'histograms': []}
+    counters = {}
+    histograms = {}
+    for totals, kind in ((counters, 'counters'),
+                         (histograms, 'histograms')):
+        _add(totals, dead[kind])
+        _add(totals, snapshot[kind])
+    _write_snapshot(dead_path, {
+        'pid': None,
+        # scrapes skip the snapshots of these processes if they still
+        # find them
+        'folded': [folded for folded in dead['folded'] if os.path.exists(
+            os.path.join(directory, 'metrics-%d.json' % folded))] + [pid],
+        'counters': [(name, dict(labels), value)
+                     for (name, labels), value in counters.items()],
+        'gauges': [],
+        'histograms': [(name, dict(labels), values)
+                       for (name, labels), values in histograms.items()]
+    })
+    os.remove(path)
+
+
+def remove_snapshots(directory):
+    '''Removes the snapshots written by the processes of a previous run,
+    leaving the directory and any other file in place.'''
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')) + \
+            glob.glob(os.path.join(directory, 'metrics-*.json.tmp')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+metrics = Metrics()
+
+
+def _pool_gauges(db, app):
+    def collect():
+        pool = db.get_engine(app).pool
+        if not hasattr(pool, 'checkedout'):
+            return []
+        return [('db_pool_size', {}, pool.size()),
+                ('db_pool_checked_out', {}, pool.checkedout()),
+                ('db_pool_overflow', {}, max(0, pool.overflow()))]
+    return collect
+
+
+def setup_metrics(app, db=None):
+    directory = app.config.get(
+        'METRICS_MULTIPROC_DIR', os.environ.get('METRICS_MULTIPROC_DIR'))
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        metrics.directory = directory
+        metrics.flush_interval = float(app.config.get(
+            'METRICS_FLUSH_INTERVAL',
+            os.environ.get('METRICS_FLUSH_INTERVAL', FLUSH_INTERVAL)))
+        atexit.register(metrics.flush)
+    if db is not None:
+        metrics.register_gauges(_pool_gauges(db, app))
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        with metrics.lock:
+            metrics.in_flight += 1
+
+    @app.after_request
+    def record_response_metrics(response):
+        g.metrics_response = (response.status_code, response.content_length)
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exception=None):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+        now = time.perf_counter()
+        status, size = g.pop('metrics_response', (500, None))
+        rule = request.url_rule
+        route = rule.rule if rule is not None else '<unmatched>'
+        labels = {'method': request.method, 'route': route,
+                  'status': str(status)}
+
+        with metrics.lock:
+            metrics.in_flight -= 1
+        metrics.inc('http_requests_total', labels)
+        metrics.observe('http_request_duration_seconds', LATENCY_BUCKETS,
+                        labels, now - start)
+        if size is not None:
+            metrics.observe('http_response_size_bytes', SIZE_BUCKETS,
+                            {'method': request.method, 'route': route},
+                            size)
+        metrics.maybe_flush(now)
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(), content_type=CONTENT_TYPE)
@@ -1,41 +1,117 @@
+import base64
 import os
+import zlib
+from datetime import datetime, timedelta
 from sqlalchemy import (
     Column,
     String,
+    Text,
     Integer,
     Boolean,
+    Date,
     DateTime,
     ForeignKey,
-    create_engine
+    and_,
+    case,
+    create_engine,
+    event,
+    func,
+    inspect,
+    select
 )
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import deferred
+from sqlalchemy.types import TypeDecorator
 from flask_sqlalchemy import SQLAlchemy
 import json
-from flask_migrate import Migrate
 
 # Connection instructions
-# uncomment the two lines below to work on local machine
-# database_name = "jobportal"
-# database_path = "postgres://{}/{}". \
-#     format('postgres:mb@localhost:5432', database_name)
-
-# Database on Heroku
-database_path = os.environ['DATABASE_URL']
+# set DATABASE_URL to work on local machine, e.g.
+# export DATABASE_URL=postgres://postgres:mb@localhost:5432/jobportal
+# On Heroku DATABASE_URL is set by the Postgres add-on
 
 db = SQLAlchemy()
 
+# Accepted formats of date strings sent by clients
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                '%d.%m.%Y', '%m/%d/%Y', '%a, %d %b %Y %H:%M:%S GMT']
+
+
+def parse_datetime(value):
+    '''Converts a date string of a request body for a DateTime column'''
+    if value is None or isinstance(value, datetime):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            continue
+    raise ValueError('Unsupported date: %r' % (value,))
+
+
+class CompressedText(TypeDecorator):
+    '''Text column that stores values longer than `threshold` bytes zlib
+    compressed (base64 encoded behind MARKER) when that is shorter.
+    Values are always read back as text, whatever the threshold was when
+    they were written; a threshold of 0 turns compression off.'''
+    impl = String
+    MARKER = '\x01zlib:'
+    threshold = 0
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        data = value.encode('utf-8')
+        # plain text starting with the marker must not be read as packed
+        forced = value.startswith(self.MARKER)
+        if not forced and (not self.threshold or len(data) <= self.threshold):
+            return value
+        packed = self.MARKER + base64.b64encode(
+            zlib.compress(data)).decode('ascii')
+        return packed if forced or len(packed) < len(data) else value
+
+    def process_result_value(self, value, dialect):
+        if value is None or not value.startswith(self.MARKER):
+            return value
+        return zlib.decompress(base64.b64decode(
+            value[len(self.MARKER):])).decode('utf-8')
+
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    The database URL is resolved when the app is created: the argument,
+    app.config['DATABASE_URL'] or the DATABASE_URL environment variable.
+    No connection is opened until the first query; the tables are
+    created with `python manage.py create_db` or the migrations.
+    Long texts are compressed above TEXT_COMPRESSION_THRESHOLD bytes.
 '''
 
 
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_path or \
+        app.config.get('DATABASE_URL') or os.environ['DATABASE_URL']
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    CompressedText.threshold = int(app.config.get(
+        'TEXT_COMPRESSION_THRESHOLD',
+        os.environ.get('TEXT_COMPRESSION_THRESHOLD', 0)))
     db.app = app
     db.init_app(app)
-    db.create_all()
-    migrate = Migrate(app, db)
+
+
+'''
+commit()
+    commits the session, or only flushes it while the session is
+    marked with `defer_commit` by a transactional POST /batch, which
+    commits or rolls back all of its requests at the end
+'''
+
+
+def commit():
+    if db.session.info.get('defer_commit'):
+        db.session.flush()
+    else:
+        db.session.commit()
 
 
 '''
@@ -48,19 +124,22 @@ class commonMethods(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        commit()
 
 
 '''
 Company
 
+The long texts of companies, vacancies and applications are in the
+deferred group 'text': listings do not load them, detail routes load
+them with undefer_group('text').
 '''
 
 
@@ -79,8 +158,13 @@ class Company(commonMethods):
     logo_link = Column(String)
     facebook_link = Column(String)
     website_link = Column(String)
-    description = Column(String)
+    description = deferred(Column(CompressedText), group='text')
     seeking_employee = Column(Boolean)
+    # maintained by the Application mapper events, see below
+    application_count = Column(Integer, nullable=False, server_default='0')
+    # UTC time of the last write, for the delta sync (sync.py)
+    updated_at = Column(DateTime, index=True, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
     vacancies = db.relationship(
         'Vacancy', backref=db.backref('company', lazy=True))
     applications = db.relationship(
@@ -146,6 +230,8 @@ class Candidate(commonMethods):
     seeking_job = Column(Boolean)
     desired_salary = Column(Integer)
     desired_industry = Column(String)
+    # maintained by the Application mapper events, see below
+    application_count = Column(Integer, nullable=False, server_default='0')
     applications = db.relationship(
         'Application', backref=db.backref('candidate'), lazy=True)
 
@@ -200,14 +286,21 @@ class Vacancy(commonMethods):
 
     id = Column(Integer, primary_key=True)
     job_title = Column(String)
-    job_description = Column(String)
-    requirements = Column(String)
-    benefits = Column(String)
+    job_description = deferred(Column(CompressedText), group='text')
+    requirements = deferred(Column(CompressedText), group='text')
+    benefits = deferred(Column(CompressedText), group='text')
     city = Column(String)
     region = Column(String)
     min_salary = Column(Integer)
     date_posted = Column(DateTime)
     company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
+    # copy of Company.name, so that listings do not join the companies
+    company_name = Column(String)
+    # maintained by the Application mapper events, see below
+    application_count = Column(Integer, nullable=False, server_default='0')
+    # UTC time of the last write, for the delta sync (sync.py)
+    updated_at = Column(DateTime, index=True, default=datetime.utcnow,
+                        onupdate=datetime.utcnow)
     applications = db.relationship(
         'Application', backref=db.backref('vacancies'), lazy=True)
 
@@ -235,7 +328,8 @@ class Vacancy(commonMethods):
             'min_salary': self.min_salary,
             'date_posted': self.date_posted,
             'company_id': self.company_id,
-            'company_name': self.company.name
+            'company_name': self.company_name,
+            'application_count': self.application_count
         }
 
     def format_short(self):
@@ -247,10 +341,49 @@ class Vacancy(commonMethods):
             'min_salary': self.min_salary,
             'date_posted': self.date_posted,
             'company_id': self.company_id,
-            'company_name': self.company.name
+            'company_name': self.company_name,
+            'application_count': self.application_count
             }
 
 
+'''
+company_name_of(company_id)
+    the name of a company as a scalar subquery, to fill
+    Vacancy.company_name in the same INSERT or UPDATE statement
+copy_company_names(company_id=None)
+    bulk UPDATE that copies the company names to their vacancies, of one
+    company after a rename or of all of them as a backfill
+'''
+
+
+def company_name_of(company_id):
+    return select([Company.__table__.c.name]).where(
+        Company.__table__.c.id == company_id).as_scalar()
+
+
+def copy_company_names(company_id=None):
+    vacancies = Vacancy.__table__
+    statement = vacancies.update().values(
+        company_name=company_name_of(vacancies.c.company_id),
+        updated_at=datetime.utcnow())
+    if company_id is not None:
+        statement = statement.where(vacancies.c.company_id == company_id)
+    return statement
+
+
+@event.listens_for(Vacancy, 'before_insert')
+@event.listens_for(Vacancy, 'before_update')
+def fill_company_name(mapper, connection, vacancy):
+    if inspect(vacancy).attrs.company_id.history.has_changes():
+        vacancy.company_name = company_name_of(vacancy.company_id)
+
+
+@event.listens_for(Company, 'after_update')
+def rename_vacancies(mapper, connection, company):
+    if inspect(company).attrs.name.history.has_changes():
+        connection.execute(copy_company_names(company.id))
+
+
 '''
 Application
 '''
@@ -263,7 +396,7 @@ class Application(commonMethods):
     company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
     vacancy_id = Column(Integer, ForeignKey('vacancies.id'), nullable=False)
     candidate_id = Column(Integer, ForeignKey('candidates.id'), nullable=False)
-    cover_letter = Column(String)
+    cover_letter = deferred(Column(CompressedText), group='text')
     date_submitted = Column(DateTime)
 
     def __init__(self, company_id, vacancy_id, candidate_id,
@@ -273,3 +406,258 @@ class Application(commonMethods):
         self.candidate_id = candidate_id
         self.cover_letter = cover_letter
         self.date_submitted = date_submitted
+
+
+'''
+Idempotency key
+'''
+
+
+class IdempotencyKey(db.Model):
+    '''Response stored for an Idempotency-Key, shared by all workers when
+    IDEMPOTENCY_STORE is "database"; status is NULL while the first
+    request is still being served'''
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String(64), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status = Column(Integer)
+    body = Column(Text)
+    content_type = Column(String)
+    expires = Column(DateTime, nullable=False, index=True)
+
+
+'''
+Tombstone
+'''
+
+
+class Tombstone(db.Model):
+    '''A deleted company or vacancy, so that the delta sync can report
+    the deletion; old tombstones are purged with manage.py'''
+    __tablename__ = 'tombstones'
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False, index=True)
+
+
+'''
+tombstone(table, row_id)
+    INSERT of the tombstone of a deleted row of `table`
+purge_tombstones(connection, days)
+    deletes the tombstones older than `days`; returns their number
+backfill_updated_at(connection)
+    sets updated_at of the companies and vacancies written before it
+    existed, so that the delta sync returns them
+'''
+
+
+def tombstone(table, row_id):
+    return Tombstone.__table__.insert().values(
+        table_name=table.name, row_id=row_id, deleted_at=datetime.utcnow())
+
+
+def purge_tombstones(connection, days):
+    tombstones = Tombstone.__table__
+    return connection.execute(tombstones.delete().where(
+        tombstones.c.deleted_at < datetime.utcnow() - timedelta(
+            days=days))).rowcount
+
+
+def backfill_updated_at(connection):
+    for model in (Company, Vacancy):
+        table = model.__table__
+        connection.execute(table.update().where(
+            table.c.updated_at.is_(None)).values(
+            updated_at=datetime.utcnow()))
+
+
+@event.listens_for(Company, 'after_delete')
+@event.listens_for(Vacancy, 'after_delete')
+def bury(mapper, connection, target):
+    connection.execute(tombstone(mapper.local_table, target.id))
+
+
+'''
+Application rollup
+'''
+
+
+class ApplicationRollup(db.Model):
+    '''Applications of a vacancy submitted on one day, kept up to date by
+    the Application mapper events; date_posted is copied from the vacancy
+    so that the statistics of a company read only this table'''
+    __tablename__ = 'application_rollups'
+
+    company_id = Column(Integer, primary_key=True)
+    vacancy_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    applications = Column(Integer, nullable=False)
+    first_submitted = Column(DateTime)
+    date_posted = Column(DateTime)
+
+
+'''
+application_count_updates(vacancy_id, company_id, candidate_id, delta)
+    UPDATEs that add `delta` to the application counters of a vacancy,
+    its company and the candidate; they run in the transaction that
+    inserts or deletes the application and increment in SQL, so
+    concurrent applications are not lost
+reconcile_application_counts(connection)
+    repairs counters that drifted from the applications table, e.g.
+    after bulk deletes; returns the number of repaired rows
+'''
+
+
+def application_count_updates(vacancy_id, company_id, candidate_id, delta):
+    statements = []
+    for model, row_id in ((Vacancy, vacancy_id), (Company, company_id),
+                          (Candidate, candidate_id)):
+        table = model.__table__
+        values = {'application_count': table.c.application_count + delta}
+        # the counter is part of the synced rows; `databases` would set
+        # updated_at to NULL instead of running its onupdate
+        if 'updated_at' in table.c:
+            values['updated_at'] = datetime.utcnow()
+        statements.append(table.update().where(table.c.id == row_id).values(
+            **values))
+    return statements
+
+
+def reconcile_application_counts(connection):
+    applications = Application.__table__
+    repaired = 0
+    for model, key in ((Vacancy, 'vacancy_id'), (Company, 'company_id'),
+                       (Candidate, 'candidate_id')):
+        table = model.__table__
+        actual = select([func.count(applications.c.id)]).where(
+            applications.c[key] == table.c.id).as_scalar()
+        repaired += connection.execute(table.update().where(
+            table.c.application_count != actual).values(
+            application_count=actual)).rowcount
+    return repaired
+
+
+@event.listens_for(Application, 'after_insert')
+def count_application(mapper, connection, application):
+    for statement in application_count_updates(
+            application.vacancy_id, application.company_id,
+            application.candidate_id, 1):
+        connection.execute(statement)
+
+
+@event.listens_for(Application, 'after_delete')
+def uncount_application(mapper, connection, application):
+    for statement in application_count_updates(
+            application.vacancy_id, application.company_id,
+            application.candidate_id, -1):
+        connection.execute(statement)
+
+
+'''
+rollup_key(company_id, vacancy_id, day)
+rollup_added(company_id, vacancy_id, submitted)
+rollup_inserted(company_id, vacancy_id, submitted)
+rollup_removed(company_id, vacancy_id, submitted)
+    statements that keep the application rollup of a vacancy and day in
+    step with an inserted or deleted application; rollup_added returns no
+    rows when the rollup does not exist yet and rollup_inserted has to
+    create it
+rebuild_application_rollups(connection)
+    recomputes all rollups from the applications table, as a backfill
+'''
+
+
+def rollup_key(company_id, vacancy_id, day):
+    rollups = ApplicationRollup.__table__
+    return and_(rollups.c.company_id == company_id,
+                rollups.c.vacancy_id == vacancy_id, rollups.c.day == day)
+
+
+def rollup_added(company_id, vacancy_id, submitted):
+    rollups = ApplicationRollup.__table__
+    return rollups.update().where(rollup_key(
+        company_id, vacancy_id, submitted.date())).values(
+        applications=rollups.c.applications + 1,
+        first_submitted=case(
+            [(rollups.c.first_submitted > submitted, submitted)],
+            else_=rollups.c.first_submitted))
+
+
+def rollup_inserted(company_id, vacancy_id, submitted):
+    vacancies = Vacancy.__table__
+    return ApplicationRollup.__table__.insert().values(
+        company_id=company_id, vacancy_id=vacancy_id, day=submitted.date(),
+        applications=1, first_submitted=submitted,
+        date_posted=select([vacancies.c.date_posted]).where(
+            vacancies.c.id == vacancy_id).as_scalar())
+
+
+def rollup_removed(company_id, vacancy_id, submitted):
+    rollups = ApplicationRollup.__table__
+    applications = Application.__table__
+    day = submitted.date()
+    start = datetime(day.year, day.month, day.day)
+    key = rollup_key(company_id, vacancy_id, day)
+    return [
+        rollups.update().where(key).values(
+            applications=rollups.c.applications - 1,
+            first_submitted=select(
+                [func.min(applications.c.date_submitted)]).where(and_(
+                    applications.c.company_id == company_id,
+                    applications.c.vacancy_id == vacancy_id,
+                    applications.c.date_submitted >= start,
+                    applications.c.date_submitted < start + timedelta(
+                        days=1))).as_scalar()),
+        rollups.delete().where(and_(key, rollups.c.applications <= 0))]
+
+
+def rebuild_application_rollups(connection):
+    rollups = ApplicationRollup.__table__
+    applications = Application.__table__
+    vacancies = Vacancy.__table__
+    day = func.date(applications.c.date_submitted)
+    connection.execute(rollups.delete())
+    connection.execute(rollups.insert().from_select(
+        ['company_id', 'vacancy_id', 'day', 'applications',
+         'first_submitted', 'date_posted'],
+        select([applications.c.company_id, applications.c.vacancy_id, day,
+                func.count(applications.c.id),
+                func.min(applications.c.date_submitted),
+                func.max(vacancies.c.date_posted)])
+        .select_from(applications.join(
+            vacancies, applications.c.vacancy_id == vacancies.c.id))
+        .where(applications.c.date_submitted.isnot(None))
+        .group_by(applications.c.company_id, applications.c.vacancy_id,
+                  day)))
+
+
+@event.listens_for(Application, 'after_insert')
+def roll_up_application(mapper, connection, application):
+    if application.date_submitted is None:
+        return
+    added = rollup_added(application.company_id, application.vacancy_id,
+                         application.date_submitted)
+    if connection.execute(added).rowcount:
+        return
+    # the first application of the day creates the rollup; a concurrent
+    # one may have created it first
+    try:
+        with connection.begin_nested():
+            connection.execute(rollup_inserted(
+                application.company_id, application.vacancy_id,
+                application.date_submitted))
+    except IntegrityError:
+        connection.execute(added)
+
+
+@event.listens_for(Application, 'after_delete')
+def roll_down_application(mapper, connection, application):
+    if application.date_submitted is None:
+        return
+    for statement in rollup_removed(application.company_id,
+                                    application.vacancy_id,
+                                    application.date_submitted):
+        connection.execute(statement)
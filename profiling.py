@@ -0,0 +1,192 @@
+'''
+On-demand request profiling
+
+Enabled by setting PROFILE_DIR. A request is profiled when it carries an
+X-Profile header equal to PROFILE_TOKEN, or at random with probability
+PROFILE_SAMPLE_RATE. PROFILE_MODE selects the profiler:
+
+- "cprofile" (default) writes a .pstats file for pstats/snakeviz
+- "sampling" samples the request thread's stack every
+  PROFILE_SAMPLE_INTERVAL seconds and writes .collapsed stacks for
+  flamegraph.pl / speedscope
+
+GET /profiles lists the most recent profiles and GET /profiles/<name>
+downloads one; both require the X-Profile token.
+Without PROFILE_DIR no hooks are installed at all.
+'''
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import abort, g, jsonify, request, send_from_directory
+
+PROFILE_HEADER = 'X-Profile'
+SAMPLE_INTERVAL = 0.005
+KEEP_PROFILES = 200
+LIST_LIMIT = 50
+
+
+class StackSampler:
+    '''Samples the stack of one thread from a background thread.'''
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (os.path.basename(code.co_filename),
+                                code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _slug(rule):
+    return re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'
+
+
+def _prune(directory, keep):
+    entries = sorted(
+        (entry for entry in os.scandir(directory)
+         if entry.name.endswith('.json')),
+        key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:max(0, len(entries) - keep)]:
+        base = entry.path[:-len('.json')]
+        for suffix in ('.json', '.pstats', '.collapsed'):
+            try:
+                os.remove(base + suffix)
+            except OSError:
+                pass
+
+
+def setup_profiling(app):
+    directory = app.config.get('PROFILE_DIR', os.environ.get('PROFILE_DIR'))
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+
+    token = app.config.get('PROFILE_TOKEN', os.environ.get('PROFILE_TOKEN'))
+    sample_rate = float(app.config.get(
+        'PROFILE_SAMPLE_RATE', os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+    mode = app.config.get('PROFILE_MODE',
+                          os.environ.get('PROFILE_MODE', 'cprofile'))
+    interval = float(app.config.get(
+        'PROFILE_SAMPLE_INTERVAL',
+        os.environ.get('PROFILE_SAMPLE_INTERVAL', SAMPLE_INTERVAL)))
+    keep = int(app.config.get('PROFILE_KEEP',
+                              os.environ.get('PROFILE_KEEP', KEEP_PROFILES)))
+
+    def authorized():
+        return token and request.headers.get(PROFILE_HEADER) == token
+
+    @app.before_request
+    def start_profile():
+        if request.path.startswith('/profiles'):
+            return
+        if not (authorized() or
+                (sample_rate and random.random() < sample_rate)):
+            return
+        if mode == 'sampling':
+            g.profiler = StackSampler(threading.get_ident(), interval).start()
+        else:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        g.profile_started = time.perf_counter()
+
+    @app.teardown_request
+    def save_profile(exception=None):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        if mode == 'sampling':
+            profiler.stop()
+        else:
+            profiler.disable()
+
+        duration_ms = (time.perf_counter() - g.pop('profile_started')) * 1e3
+        rule = request.url_rule.rule if request.url_rule else request.path
+        created = datetime.utcnow()
+        name = '%s-%d-%s-%s' % (created.strftime('%Y%m%dT%H%M%S%f'),
+                                os.getpid(), request.method, _slug(rule))
+        suffix = '.collapsed' if mode == 'sampling' else '.pstats'
+        base = os.path.join(directory, name)
+
+        if mode == 'sampling':
+            profiler.dump(base + suffix)
+        else:
+            profiler.dump_stats(base + suffix)
+        with open(base + '.json', 'w') as f:
+            json.dump({
+                'name': name + suffix,
+                'method': request.method,
+                'route': rule,
+                'path': request.path,
+                'duration_ms': round(duration_ms, 3),
+                'mode': mode,
+                'created': created.isoformat() + 'Z'
+            }, f)
+        _prune(directory, keep)
+
+    # List recent profiles
+    @app.route('/profiles', methods=['GET'])
+    def get_profiles():
+        if not authorized():
+            abort(404)
+        entries = sorted(
+            (entry for entry in os.scandir(directory)
+             if entry.name.endswith('.json')),
+            key=lambda entry: entry.stat().st_mtime, reverse=True)
+        profiles = []
+        for entry in entries[:LIST_LIMIT]:
+            try:
+                with open(entry.path) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        return jsonify({
+          'success': True,
+          'profiles': profiles
+        })
+
+    # Download a profile
+    @app.route('/profiles/<name>', methods=['GET'])
+    def get_profile(name):
+        if not authorized():
+            abort(404)
+        if not name.endswith(('.pstats', '.collapsed')):
+            abort(404)
+        return send_from_directory(directory, name, as_attachment=True)
@@ -0,0 +1,176 @@
+'''
+Per-request SQL statistics
+
+SQLAlchemy engine events count the statements and the database time of
+every request. Statements slower than SQL_SLOW_QUERY_MS are logged with
+their bound parameters, and a warning is logged when the same statement
+runs more than SQL_REPEAT_THRESHOLD times in one request, the usual sign
+of an N+1 lazy load. In debug mode (or with SQL_STATS_HEADERS) the
+totals are sent back in the X-DB-Queries and Server-Timing headers.
+'''
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+logger = logging.getLogger('jobportal.sql')
+
+SLOW_QUERY_MS = 100.0
+REPEAT_THRESHOLD = 5
+# Transaction control, e.g. the savepoints of the test suite, is not
+# counted as a query
+TRANSACTION_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT',
+                          'ROLLBACK TO SAVEPOINT')
+
+_settings = {'slow_query_ms': SLOW_QUERY_MS}
+_local = threading.local()
+
+
+class QueryRecorder:
+    '''Collects statistics of the statements executed by the current
+    thread between start() and stop(); usable as a context manager.'''
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def start(self):
+        if not hasattr(_local, 'recorders'):
+            _local.recorders = []
+        _local.recorders.append(self)
+        return self
+
+    def stop(self):
+        recorders = getattr(_local, 'recorders', [])
+        if self in recorders:
+            recorders.remove(self)
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record(self, statement, duration):
+        self.queries += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        return [(statement, count)
+                for statement, count in self.statements.most_common()
+                if count > threshold]
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+
+    if not statement.startswith(TRANSACTION_STATEMENTS):
+        for recorder in getattr(_local, 'recorders', ()):
+            recorder.record(statement, duration)
+
+    if duration * 1000.0 >= _settings['slow_query_ms']:
+        logger.warning('Slow query (%.1f ms): %s; parameters: %r',
+                       duration * 1000.0, statement, parameters)
+
+
+# ORM rows turned into instances; rows of already loaded identities
+# are not counted
+@event.listens_for(Mapper, 'load')
+def _on_load(target, context):
+    for recorder in getattr(_local, 'recorders', ()):
+        recorder.rows += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start_time')
+        if starts:
+            starts.pop()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(queries=None, rows=None):
+    '''Fail with QueryBudgetExceeded when the block executes more than
+    `queries` statements or loads more than `rows` ORM rows.'''
+    with QueryRecorder() as recorder:
+        yield recorder
+
+    if queries is not None and recorder.queries > queries:
+        raise QueryBudgetExceeded(
+            'Expected at most %d queries, %d were executed:\n%s' % (
+                queries, recorder.queries,
+                '\n'.join('%dx %s' % (count, statement) for statement, count
+                          in recorder.statements.most_common())))
+    if rows is not None and recorder.rows > rows:
+        raise QueryBudgetExceeded(
+            'Expected at most %d rows, %d were loaded' % (
+                rows, recorder.rows))
+
+
+def _flag(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return value
+
+
+def setup_query_stats(app):
+    _settings['slow_query_ms'] = float(app.config.get(
+        'SQL_SLOW_QUERY_MS',
+        os.environ.get('SQL_SLOW_QUERY_MS', SLOW_QUERY_MS)))
+    repeat_threshold = int(app.config.get(
+        'SQL_REPEAT_THRESHOLD',
+        os.environ.get('SQL_REPEAT_THRESHOLD', REPEAT_THRESHOLD)))
+    send_headers = _flag(app.config.get(
+        'SQL_STATS_HEADERS', os.environ.get('SQL_STATS_HEADERS')))
+
+    @app.before_request
+    def start_query_stats():
+        g.query_recorder = QueryRecorder().start()
+
+    @app.after_request
+    def finish_query_stats(response):
+        recorder = g.pop('query_recorder', None)
+        if recorder is None:
+            return response
+        recorder.stop()
+
+        for statement, count in recorder.repeated(repeat_threshold):
+            logger.warning('Possible N+1: statement executed %d times in '
+                           '%s %s: %s', count, request.method,
+                           request.path, statement)
+
+        if send_headers or (send_headers is None and app.debug):
+            response.headers['X-DB-Queries'] = str(recorder.queries)
+            response.headers.add(
+                'Server-Timing', 'db;dur=%.2f;desc="%d queries"'
+                % (recorder.duration * 1000.0, recorder.queries))
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exception=None):
+        recorder = g.pop('query_recorder', None)
+        if recorder is not None:
+            recorder.stop()
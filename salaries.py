@@ -0,0 +1,222 @@
+'''
+Salary market statistics
+
+GET /stats/salaries?city=&region=&industry= returns the number of
+vacancies and the mean and 10th/50th/90th percentile of their
+min_salary, for any combination of the three filters (the industry is
+the one of the company).
+
+The statistics of every combination are computed at once from an
+in-memory NumPy snapshot and served from it. The snapshot is computed
+again in a background thread of every worker process, every
+SALARY_STATS_INTERVAL seconds or as soon as SALARY_STATS_WRITES vacancies
+have been written through the app (see changes.py). With an interval
+of 0 there is no thread and the snapshot is only refreshed on demand.
+'''
+import os
+import sys
+import threading
+import time
+from itertools import combinations
+
+import numpy as np
+from flask import jsonify, request
+from sqlalchemy import func, select
+
+from changes import subscribe
+from metrics import metrics
+from models import Company, Vacancy
+
+INTERVAL = 300.0
+WRITES = 100
+DIMENSIONS = ('city', 'region', 'industry')
+PERCENTILES = (('p10', 0.1), ('p50', 0.5), ('p90', 0.9))
+
+
+def _encode(values):
+    '''Codes of `values` and the distinct values (None counts as "")'''
+    distinct = {}
+    codes = [distinct.setdefault('' if value is None else value,
+                                 len(distinct)) for value in values]
+    return np.array(codes, dtype=np.int64), list(distinct)
+
+
+def compute_salary_stats(rows):
+    '''Statistics of (city, region, industry, salary, count) rows for
+    every combination of the dimensions, keyed by (city, region,
+    industry) with None for a dimension that is not filtered on
+
+    The rows are never expanded to one value per vacancy: the rows of a
+    group are sorted by salary and the percentiles are looked up in the
+    running total of their counts.'''
+    if not rows:
+        return {}
+    columns = list(zip(*rows))
+    encoded = [_encode(column) for column in columns[:3]]
+    ranks, salaries = _encode(columns[3])
+    salaries = np.array(salaries, dtype=np.float64)
+    # ranks in ascending order of salary
+    ranks = np.argsort(np.argsort(salaries))[ranks]
+    salaries = np.sort(salaries)
+    counts = np.asarray(columns[4], dtype=np.int64)
+
+    stats = {}
+    for size in range(len(DIMENSIONS) + 1):
+        for dimensions in combinations(range(len(DIMENSIONS)), size):
+            # one integer per group of the chosen dimensions
+            group = np.zeros(len(rows), dtype=np.int64)
+            for dimension in dimensions:
+                codes, distinct = encoded[dimension]
+                group = group * len(distinct) + codes
+
+            # the rows of every group in ascending order of salary, one
+            # group after the other
+            order = np.argsort(group * len(salaries) + ranks)
+            group = group[order]
+            values = salaries[ranks[order]]
+            weights = counts[order]
+            starts = np.concatenate(
+                ([0], np.flatnonzero(group[1:] != group[:-1]) + 1))
+            running = np.cumsum(weights)
+            sizes = np.add.reduceat(weights, starts)
+            offsets = running[starts] - weights[starts]
+
+            results = {
+                'count': sizes,
+                'mean': np.add.reduceat(values * weights, starts) / sizes
+            }
+            for name, share in PERCENTILES:
+                # linear interpolation, like numpy.percentile
+                position = offsets + (sizes - 1) * share
+                low = np.floor(position)
+                high = values[np.searchsorted(running, np.ceil(position),
+                                              side='right')]
+                low_value = values[np.searchsorted(running, low,
+                                                   side='right')]
+                results[name] = low_value + (high - low_value) \
+                    * (position - low)
+
+            for i, key in enumerate(group[starts].tolist()):
+                labels = [None] * len(DIMENSIONS)
+                for dimension in reversed(dimensions):
+                    codes, distinct = encoded[dimension]
+                    key, code = divmod(key, len(distinct))
+                    labels[dimension] = distinct[code]
+                stats[tuple(labels)] = {
+                    'count': int(results['count'][i]),
+                    'mean': round(float(results['mean'][i]), 2),
+                    'p10': round(float(results['p10'][i]), 2),
+                    'p50': round(float(results['p50'][i]), 2),
+                    'p90': round(float(results['p90'][i]), 2)
+                }
+    return stats
+
+
+def load_salary_rows(connection):
+    '''Salaries grouped by (city, region, industry, salary), so the
+    database sends one row per distinct salary of a group'''
+    vacancies = Vacancy.__table__
+    companies = Company.__table__
+    columns = [vacancies.c.city, vacancies.c.region, companies.c.industry,
+               vacancies.c.min_salary]
+    return connection.execute(
+        select(columns + [func.count()])
+        .select_from(vacancies.join(
+            companies, vacancies.c.company_id == companies.c.id))
+        .where(vacancies.c.min_salary.isnot(None))
+        .group_by(*columns)).fetchall()
+
+
+class SalaryStats:
+    def __init__(self, app, db, interval, writes):
+        self.app = app
+        self.db = db
+        self.interval = interval
+        self.writes = writes
+        self.pending_writes = 0
+        self.snapshot = None
+        self.computed_at = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def refresh(self, connection=None):
+        rows = load_salary_rows(connection or self.db.session)
+        snapshot = compute_salary_stats(rows)
+        with self.lock:
+            self.snapshot = snapshot
+            self.computed_at = time.time()
+        return snapshot
+
+    def get(self, key):
+        self._start_thread()
+        # read once: with an interval of 0, vacancies_changed may drop the
+        # snapshot in another thread at any time
+        snapshot = self.snapshot
+        if snapshot is None:
+            self.misses += 1
+            snapshot = self.refresh()
+        else:
+            self.hits += 1
+        return snapshot.get(key)
+
+    def vacancies_changed(self, changes):
+        self.pending_writes += len(changes)
+        if self.pending_writes >= self.writes:
+            self.pending_writes = 0
+            if self.interval > 0:
+                self.wake.set()
+            else:
+                self.snapshot = None
+
+    def _start_thread(self):
+        # threads do not survive the fork of a gunicorn worker
+        if self.interval <= 0 or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, daemon=True,
+                                           name='salary-stats')
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                with self.app.app_context():
+                    with self.db.engine.connect() as connection:
+                        self.refresh(connection)
+            except Exception:
+                print(sys.exc_info())
+
+
+def setup_salary_stats(app, db):
+    stats = SalaryStats(
+        app, db,
+        float(app.config.get(
+            'SALARY_STATS_INTERVAL',
+            os.environ.get('SALARY_STATS_INTERVAL', INTERVAL))),
+        int(app.config.get(
+            'SALARY_STATS_WRITES',
+            os.environ.get('SALARY_STATS_WRITES', WRITES))))
+    app.extensions['salary_stats'] = stats
+    subscribe(stats.vacancies_changed)
+    metrics.register_cache('salary_stats', lambda: (stats.hits, stats.misses))
+
+    # Get salary statistics of vacancies by city, region and industry
+    @app.route('/stats/salaries', methods=['GET'])
+    def get_salary_stats():
+        key = tuple(request.args.get(name) or None for name in DIMENSIONS)
+        result = stats.get(key) or {
+          'count': 0, 'mean': None, 'p10': None, 'p50': None, 'p90': None}
+
+        return jsonify(dict({
+          'success': True,
+          'computed_at': stats.computed_at
+        }, **dict(zip(DIMENSIONS, key)), **result))
@@ -0,0 +1,189 @@
+'''
+Similar vacancies
+
+GET /vacancies/<id>/similar returns the vacancies whose job title,
+description and requirements share the most word shingles (runs of
+SHINGLE_WORDS words) with those of the vacancy, most similar first.
+Vacancies with an estimated similarity of DUPLICATE_SIMILARITY or more
+are flagged as near duplicates.
+
+The similarity of two vacancies is estimated from MinHash signatures of
+their shingles. The signatures are split into BANDS bands and every
+worker process keeps a locality-sensitive hashing index of the bands in
+memory: only vacancies sharing a whole band with the vacancy are
+compared, instead of all vacancies. With 16 bands of 4 values, pairs
+with a similarity of 0.5 are found with a probability of 0.64 and pairs
+of 0.8 with 0.999. The index is read on the first request and updated
+after the app has committed vacancy writes (see changes.py).
+'''
+import re
+import sys
+import threading
+import zlib
+
+import numpy as np
+from flask import abort, jsonify, request
+from sqlalchemy import select
+
+from changes import subscribe
+from models import Vacancy
+
+SHINGLE_WORDS = 3
+PERMUTATIONS = 64
+BANDS = 16
+ROWS = PERMUTATIONS // BANDS
+MIN_SIMILARITY = 0.3
+DUPLICATE_SIMILARITY = 0.9
+MAX_RESULTS = 50
+PRIME = 4294967291
+
+_random = np.random.RandomState(48)
+_a = _random.randint(1, 1 << 31, PERMUTATIONS).astype(np.uint64)
+_b = _random.randint(0, 1 << 31, PERMUTATIONS).astype(np.uint64)
+
+TEXT_COLUMNS = ('job_title', 'job_description', 'requirements')
+
+
+def shingles(text):
+    '''Hashes of the runs of SHINGLE_WORDS words of `text`, or of all its
+    words for shorter texts'''
+    words = re.findall(r'\w+', text.lower())
+    size = min(SHINGLE_WORDS, len(words))
+    return {zlib.crc32(' '.join(words[i:i + size]).encode())
+            for i in range(len(words) - size + 1)} if size else set()
+
+
+def signature(texts):
+    '''MinHash signature of the shingles of `texts`, None without words'''
+    hashes = shingles(' '.join(text for text in texts if text))
+    if not hashes:
+        return None
+    values = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+    return ((np.outer(_a, values) + _b[:, None]) % PRIME).min(
+        axis=1).astype(np.uint32)
+
+
+def band_keys(vacancy_signature):
+    return [(band, vacancy_signature[band * ROWS:(band + 1) * ROWS].tobytes())
+            for band in range(BANDS)]
+
+
+class SimilarityIndex:
+    def __init__(self, db):
+        self.db = db
+        self.signatures = {}
+        self.buckets = {}
+        self.built = False
+        self.lock = threading.Lock()
+
+    def load(self, connection, ids=None):
+        '''(id, signature) of the vacancies, of `ids` only if given'''
+        vacancies = Vacancy.__table__
+        query = select([vacancies.c.id] + [
+            vacancies.c[name] for name in TEXT_COLUMNS])
+        if ids is not None:
+            query = query.where(vacancies.c.id.in_(ids))
+        for row in connection.execute(query):
+            yield row[0], signature(row[1:])
+
+    def build(self):
+        with self.lock:
+            if self.built:
+                return
+            self.signatures = {}
+            self.buckets = {}
+            for vacancy_id, vacancy_signature in self.load(self.db.session):
+                self._add(vacancy_id, vacancy_signature)
+            self.built = True
+
+    def _add(self, vacancy_id, vacancy_signature):
+        if vacancy_signature is None:
+            return
+        self.signatures[vacancy_id] = vacancy_signature
+        for key in band_keys(vacancy_signature):
+            self.buckets.setdefault(key, set()).add(vacancy_id)
+
+    def _remove(self, vacancy_id):
+        vacancy_signature = self.signatures.pop(vacancy_id, None)
+        if vacancy_signature is None:
+            return
+        for key in band_keys(vacancy_signature):
+            bucket = self.buckets[key]
+            bucket.discard(vacancy_id)
+            if not bucket:
+                del self.buckets[key]
+
+    def update(self, changes, connection=None):
+        '''Applies (action, id) changes, reading the new texts'''
+        if not self.built:
+            return
+        ids = list(dict.fromkeys(vacancy_id for action, vacancy_id in changes))
+        try:
+            if connection is None:
+                with self.db.engine.connect() as connection:
+                    rows = list(self.load(connection, ids))
+            else:
+                rows = list(self.load(connection, ids))
+        except Exception:
+            print(sys.exc_info())
+            # read again on the next request
+            self.built = False
+            return
+        with self.lock:
+            for vacancy_id in ids:
+                self._remove(vacancy_id)
+            for vacancy_id, vacancy_signature in rows:
+                self._add(vacancy_id, vacancy_signature)
+
+    def similar(self, vacancy_id, vacancy_signature):
+        '''(similarity, id) of the vacancies similar to a signature'''
+        self.build()
+        # update() changes the buckets and signatures in place
+        with self.lock:
+            candidates = set()
+            for key in band_keys(vacancy_signature):
+                candidates.update(self.buckets.get(key, ()))
+            candidates.discard(vacancy_id)
+            others = [(candidate, self.signatures[candidate])
+                      for candidate in candidates]
+        results = []
+        for candidate, other in others:
+            similarity = float(np.mean(other == vacancy_signature))
+            if similarity >= MIN_SIMILARITY:
+                results.append((similarity, candidate))
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results
+
+
+def setup_similar_vacancies(app, db):
+    index = SimilarityIndex(db)
+    app.extensions['similar_vacancies'] = index
+    subscribe(index.update, Vacancy)
+
+    # Get vacancies similar to a vacancy
+    @app.route('/vacancies/<int:vacancy_id>/similar', methods=['GET'])
+    def get_similar_vacancies(vacancy_id):
+        limit = request.args.get('limit', 10, type=int)
+        if not 0 < limit <= MAX_RESULTS:
+            abort(400)
+        rows = list(index.load(db.session, [vacancy_id]))
+        if not rows:
+            abort(404)
+
+        # the signature of the vacancy is computed again, in case the
+        # index has not seen its last write
+        results = [] if rows[0][1] is None else \
+            index.similar(vacancy_id, rows[0][1])[:limit]
+        vacancies = {vacancy.id: vacancy for vacancy in Vacancy.query.filter(
+            Vacancy.id.in_([result[1] for result in results])).all()
+            } if results else {}
+
+        return jsonify({
+          'success': True,
+          'vacancy_id': vacancy_id,
+          'similar': [dict(
+              vacancies[similar_id].format_short(),
+              similarity=round(similarity, 3),
+              near_duplicate=similarity >= DUPLICATE_SIMILARITY)
+            for similarity, similar_id in results if similar_id in vacancies]
+        })
@@ -0,0 +1,134 @@
+'''
+Delta sync
+
+GET /vacancies/changes?since=<cursor> and GET /companies/changes return
+the rows created or updated and the ids of the rows deleted since the
+cursor, oldest change first, at most `limit` per response. Without
+`since` all rows are returned (a full sync). The response carries the
+cursor of the next request; has_more tells to ask again right away.
+
+The changes are read by keyset pagination on the indexed updated_at
+columns and on the tombstones written for every delete, so a sync reads
+only the changes. Changes of the last DELTA_SYNC_LAG seconds are left
+for the next request, as transactions still running may commit changes
+stamped with an earlier time. Tombstones are purged after
+DELTA_SYNC_RETENTION_DAYS; older cursors return 410 and the client has
+to start a full sync again.
+'''
+import base64
+import os
+from datetime import datetime, timedelta
+
+from flask import abort, jsonify, request
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import undefer_group
+
+from models import Company, Tombstone, Vacancy
+
+LIMIT = 100
+MAX_LIMIT = 1000
+LAG_SECONDS = 5.0
+RETENTION_DAYS = 30
+# changes at the same time are ordered rows first, then tombstones; the
+# cursor after everything up to a time has source DONE
+ROWS, TOMBSTONES, DONE = 0, 1, 2
+
+
+def encode_cursor(time, source, row_id):
+    return base64.urlsafe_b64encode(('%s|%d|%d' % (
+        time.isoformat(), source, row_id)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        time, source, row_id = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(time), int(source), int(row_id)
+    except (ValueError, UnicodeError):
+        abort(400)
+
+
+def after(time_column, id_column, source, cursor):
+    '''Rows of `source` that come after the cursor'''
+    cursor_time, cursor_source, cursor_id = cursor
+    if source < cursor_source:
+        return time_column > cursor_time
+    if source > cursor_source:
+        return time_column >= cursor_time
+    return or_(time_column > cursor_time, and_(
+        time_column == cursor_time, id_column > cursor_id))
+
+
+def changes(query, cursor, until, limit):
+    '''(time, source, id, row or deleted id) of the first `limit` + 1
+    changes of the model of `query` after the cursor up to `until`'''
+    model = query.column_descriptions[0]['entity']
+    table = model.__table__
+    tombstones = Tombstone.__table__
+    updated = query.filter(table.c.updated_at <= until)
+    deleted = select([tombstones.c.deleted_at, tombstones.c.id,
+                      tombstones.c.row_id]).where(and_(
+                          tombstones.c.table_name == table.name,
+                          tombstones.c.deleted_at <= until))
+    if cursor is not None:
+        updated = updated.filter(after(
+            table.c.updated_at, table.c.id, ROWS, cursor))
+        deleted = deleted.where(after(
+            tombstones.c.deleted_at, tombstones.c.id, TOMBSTONES, cursor))
+    rows = updated.order_by(table.c.updated_at, table.c.id).limit(
+        limit + 1).all()
+    deletions = query.session.execute(deleted.order_by(
+        tombstones.c.deleted_at, tombstones.c.id).limit(limit + 1))
+    return sorted(
+        [(row.updated_at, ROWS, row.id, row) for row in rows]
+        + [(deleted_at, TOMBSTONES, tombstone_id, row_id)
+           for deleted_at, tombstone_id, row_id in deletions],
+        key=lambda change: change[:3])[:limit + 1]
+
+
+def setup_delta_sync(app):
+    lag = timedelta(seconds=float(app.config.get(
+        'DELTA_SYNC_LAG', os.environ.get('DELTA_SYNC_LAG', LAG_SECONDS))))
+    retention = timedelta(days=float(app.config.get(
+        'DELTA_SYNC_RETENTION_DAYS',
+        os.environ.get('DELTA_SYNC_RETENTION_DAYS', RETENTION_DAYS))))
+
+    def sync_response(query, key, format_row):
+        limit = request.args.get('limit', LIMIT, type=int)
+        if not 0 < limit <= MAX_LIMIT:
+            abort(400)
+        cursor = request.args.get('since')
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+            if cursor[0] < datetime.utcnow() - retention:
+                abort(410)
+        until = datetime.utcnow() - lag
+
+        found = changes(query, cursor, until, limit)
+        has_more = len(found) > limit
+        found = found[:limit]
+        if has_more:
+            next_cursor = encode_cursor(*found[-1][:3])
+        else:
+            next_cursor = encode_cursor(until, DONE, 0)
+
+        return jsonify({
+          'success': True,
+          key: [dict(format_row(row), updated_at=row.updated_at)
+                for time, source, row_id, row in found if source == ROWS],
+          'deleted': [row for time, source, row_id, row in found
+                      if source == TOMBSTONES],
+          'cursor': next_cursor,
+          'has_more': has_more
+        })
+
+    # Get the vacancies changed since a cursor
+    @app.route('/vacancies/changes', methods=['GET'])
+    def get_vacancy_changes():
+        return sync_response(Vacancy.query, 'vacancies', Vacancy.format_short)
+
+    # Get the companies changed since a cursor
+    @app.route('/companies/changes', methods=['GET'])
+    def get_company_changes():
+        return sync_response(Company.query.options(undefer_group('text')),
+                             'companies', Company.format)
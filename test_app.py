@@ -1,30 +1,124 @@
 import os
+import shutil
+import tempfile
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from sqlalchemy import create_engine, event
 from app import create_app
+from auth_stub import LocalAuth
+from autocomplete import PrefixIndex
+from idempotency import DatabaseStore
+from metrics import LATENCY_BUCKETS, Metrics, fold_snapshot
+from querystats import query_budget
+from sync import DONE, encode_cursor
 from models import (
-    setup_db,
+    db,
+    CompressedText,
     Company,
+    copy_company_names,
+    rebuild_application_rollups,
+    reconcile_application_counts,
     Candidate,
     Vacancy,
-    Application
+    Application,
+    ApplicationRollup,
+    IdempotencyKey
 )
 
+# In-memory SQLite by default; all tables of a Postgres database given
+# here are dropped, e.g. postgres://postgres:mb@localhost:5432/jobportal_test
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+
+
+def use_sqlite_savepoints(engine):
+    '''pysqlite opens transactions lazily and the first SAVEPOINT would
+    start (and its RELEASE commit) the outer transaction, so BEGIN is
+    emitted explicitly instead'''
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
+
+def seed_database():
+    '''Inserts the rows which the test cases refer to by id'''
+    now = datetime.now()
+    db.session.execute(Company.__table__.insert(), [
+        {'name': 'Google', 'industry': 'IT', 'city': 'Mountain View',
+         'region': 'California', 'seeking_employee': True}])
+    db.session.execute(Candidate.__table__.insert(), [
+        {'name': 'Max', 'surname': 'Musterman'},
+        {'name': 'Erika', 'surname': 'Musterfrau'}])
+    db.session.execute(Vacancy.__table__.insert(), [
+        {'job_title': 'Full-Stack Developer', 'city': 'San Francisco',
+         'region': 'California', 'date_posted': now, 'company_id': 1},
+        {'job_title': 'Data Engineer', 'city': 'San Francisco',
+         'region': 'California', 'date_posted': now, 'company_id': 1}])
+    db.session.execute(copy_company_names())
+    db.session.execute(Application.__table__.insert(), [
+        {'company_id': 1, 'vacancy_id': 1, 'candidate_id': 2,
+         'date_submitted': now},
+        {'company_id': 1, 'vacancy_id': 2, 'candidate_id': 1,
+         'date_submitted': now}])
+    reconcile_application_counts(db.session)
+    rebuild_application_rollups(db.session)
+    db.session.commit()
+
 
 class JobPortalTestCase(unittest.TestCase):
-    '''This class represents the jobportal test case'''
+    '''This class represents the jobportal test case
+
+    The schema is built and seeded once. Every test runs in a transaction
+    that is rolled back afterwards; commits of the app only release a
+    SAVEPOINT, so the tests do not depend on each other. Tokens are signed
+    by a local key (auth_stub.py) instead of Auth0.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.auth = LocalAuth().install()
+        cls.test_user_company = cls.auth.company_token()
+        cls.test_user_candidate = cls.auth.candidate_token()
+        cls.app = create_app({'DATABASE_URL': TEST_DATABASE_URL,
+                              'SALARY_STATS_INTERVAL': 0,
+                              'DELTA_SYNC_LAG': 0})
+        with cls.app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                use_sqlite_savepoints(db.engine)
+            db.drop_all()
+            db.create_all()
+            seed_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.session.remove()
+            db.drop_all()
+        cls.auth.uninstall()
 
     def setUp(self):
         '''Define test variables and initialize app.'''
-        self.app = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.create_scoped_session(
+            options={'bind': self.connection, 'binds': {}})
+        self.session_registry = db.session
+        db.session = self.session
+        self.session.begin_nested()
+
+        @event.listens_for(self.session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
         self.client = self.app.test_client
-        self.database_name = "jobportal_test"
-        self.database_path = "postgres://{}/{}". \
-            format('postgres:mb@localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
-        self.test_user_company = os.environ['USER_TOKEN_COMPANY']
-        self.test_user_candidate = os.environ['USER_TOKEN_CANDIDATE']
 
         self.new_company = {
             "address": "1600 Amphitheatre Parkway",
@@ -77,13 +171,39 @@ class JobPortalTestCase(unittest.TestCase):
             "cover_letter": "I am a perfect candidate"
         }
 
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
-
     def tearDown(self):
-        pass
+        self.session.remove()
+        db.session = self.session_registry
+        self.transaction.rollback()
+        self.connection.close()
+        self.app_context.pop()
+
+    def seed_vacancies(self, count):
+        '''Inserts a company with `count` vacancies and returns its id'''
+        company = Company(**dict(self.new_company, name='Budget Inc.',
+                                 phone=None, logo_link=None))
+        company.insert()
+        db.session.execute(Vacancy.__table__.insert(), [
+            dict(self.new_vacancy, company_id=company.id,
+                 company_name=company.name)
+            for _ in range(count)])
+        db.session.commit()
+        return company.id
+
+    def delete_where(self, model, *criterion):
+        '''Deletes the rows that would keep a parent row from deletion'''
+        model.query.filter(*criterion).delete()
+        db.session.commit()
+
+    def check_get_vacancies_budget(self, count):
+        '''GET /vacancies must not issue a query per vacancy'''
+        self.seed_vacancies(count)
+        with query_budget(queries=2):
+            res = self.client().get('/vacancies')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreaterEqual(len(data['vacancies']), count)
 
     '''
     POST
@@ -93,10 +213,11 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_add_new_company(self):
         '''Tests successful request to post a new company into the database'''
-        res = self.client().post('/companies', json=self.new_company,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_company})
+        with query_budget(queries=1):
+            res = self.client().post('/companies', json=self.new_company,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -104,10 +225,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_add_company(self):
         '''Tests error 404 for incorrect route'''
-        res = self.client().post('/company', json=self.new_company,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_company})
+        with query_budget(queries=0):
+            res = self.client().post('/company', json=self.new_company,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -120,10 +242,11 @@ class JobPortalTestCase(unittest.TestCase):
     def test_add_new_candidate(self):
         '''Tests successful request to post a new
         candidate profile into the database'''
-        res = self.client().post('/candidates', json=self.new_candidate,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_candidate})
+        with query_budget(queries=1):
+            res = self.client().post('/candidates', json=self.new_candidate,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -131,10 +254,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_add_new_candidate(self):
         '''Tests error 404 for incorrect route'''
-        res = self.client().post('/candidate', json=self.new_candidate,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_candidate})
+        with query_budget(queries=0):
+            res = self.client().post('/candidate', json=self.new_candidate,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -146,10 +270,11 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_add_new_vacancy(self):
         '''Tests successful request to post a new vacancy into the database'''
-        res = self.client().post('/vacancies', json=self.new_vacancy,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_company})
+        with query_budget(queries=1):
+            res = self.client().post('/vacancies', json=self.new_vacancy,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -157,10 +282,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_add_new_vacancy(self):
         '''Tests error 404 for incorrect route'''
-        res = self.client().post('/vacancy', json=self.new_vacancy,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_company})
+        with query_budget(queries=0):
+            res = self.client().post('/vacancy', json=self.new_vacancy,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -173,11 +299,14 @@ class JobPortalTestCase(unittest.TestCase):
     def test_add_new_application(self):
         '''Tests successful request to post
         a new candidate application by vacancy id'''
-        res = self.client().post('/vacancies/1/applications',
-                                 json=self.new_application,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_candidate})
+        # plus the counters of the vacancy, company and candidate and the
+        # rollup of the day (created by the first application of the day)
+        with query_budget(queries=8):
+            res = self.client().post('/vacancies/1/applications',
+                                     json=self.new_application,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -185,17 +314,93 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_406_not_acceptable_when_post_application(self):
         '''Tests error 406 when posting a duplicate application'''
-        res = self.client().post('/vacancies/1/applications',
-                                 json=self.new_application,
-                                 headers={
-                                     'Authorization': 'Bearer '
-                                     + self.test_user_candidate})
+        Application(vacancy_id=1, candidate_id=1, company_id=1,
+                    cover_letter=None, date_submitted=datetime.now()).insert()
+        with query_budget(queries=2):
+            res = self.client().post('/vacancies/1/applications',
+                                     json=self.new_application,
+                                     headers={
+                                         'Authorization': 'Bearer '
+                                         + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 406)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Not acceptable')
 
+    def test_retry_application_with_idempotency_key(self):
+        '''Tests that a retried application gets the stored response
+        instead of error 406'''
+        headers = {'Authorization': 'Bearer ' + self.test_user_candidate,
+                   'Idempotency-Key': 'retry-application'}
+        first = self.client().post('/vacancies/1/applications',
+                                   json=self.new_application,
+                                   headers=headers)
+        with query_budget(queries=0):
+            res = self.client().post('/vacancies/1/applications',
+                                     json=self.new_application,
+                                     headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+
+    def test_error_401_when_idempotency_key_is_replayed_by_forged_token(self):
+        '''Tests that a token with the subject of another user but not
+        signed by Auth0 gets error 401 instead of the stored response'''
+        headers = {'Authorization': 'Bearer ' + self.test_user_candidate,
+                   'Idempotency-Key': 'forged-replay'}
+        self.client().post('/vacancies/1/applications',
+                           json=self.new_application, headers=headers)
+        forged = LocalAuth().candidate_token()
+        res = self.client().post('/vacancies/1/applications',
+                                 json=self.new_application,
+                                 headers=dict(headers, Authorization='Bearer '
+                                              + forged))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['code'], 'invalid_header')
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_idempotency_key_of_dead_request_is_taken_over(self):
+        '''Tests that a pending key is held until its lease runs out and
+        then taken over by a retry'''
+        engine = create_engine('sqlite://')
+        IdempotencyKey.__table__.create(engine)
+        store = DatabaseStore(engine, ttl=60, lease=0.05)
+        self.assertIsNone(store.acquire('key', 'request', 0))
+        # the request that holds the key never releases it
+        with self.assertRaises(TimeoutError):
+            store.acquire('key', 'request', 0)
+        time.sleep(0.1)
+        self.assertIsNone(store.acquire('key', 'request', 0))
+        store.release('key', {'fingerprint': 'request', 'status': 200,
+                              'body': '{}',
+                              'content_type': 'application/json'})
+        time.sleep(0.1)
+
+        self.assertEqual(store.acquire('key', 'request', 0)['status'], 200)
+
+    def test_error_422_when_idempotency_key_is_reused(self):
+        '''Tests error 422 when an idempotency key is sent again
+        with a different request'''
+        headers = {'Authorization': 'Bearer ' + self.test_user_company,
+                   'Idempotency-Key': 'reused-key'}
+        self.client().post('/vacancies', json=self.new_vacancy,
+                           headers=headers)
+        res = self.client().post('/vacancies',
+                                 json=dict(self.new_vacancy, city='Berlin'),
+                                 headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(Vacancy.query.filter(
+            Vacancy.city == 'Berlin').count(), 0)
+
     '''
     GET
     '''
@@ -205,7 +410,8 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_get_companies(self):
         '''Tests successful request to get companies'''
-        res = self.client().get('/companies')
+        with query_budget(queries=1):
+            res = self.client().get('/companies')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -214,7 +420,8 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_get_companies(self):
         '''Test error 404 when get companies for incorrect route'''
-        res = self.client().get('/company')
+        with query_budget(queries=0):
+            res = self.client().get('/company')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -223,7 +430,8 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_get_company_by_id(self):
         '''Tests successful request to get company by id'''
-        res = self.client().get('/companies/1')
+        with query_budget(queries=1, rows=1):
+            res = self.client().get('/companies/1')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -232,7 +440,8 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_get_company_by_id(self):
         '''Tests error 404 when id is not valid'''
-        res = self.client().get('/companies/10000')
+        with query_budget(queries=1, rows=0):
+            res = self.client().get('/companies/10000')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -244,7 +453,8 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_get_candidate_by_id(self):
         '''Tests successful request to get a candidate by id'''
-        res = self.client().get('/candidates/1')
+        with query_budget(queries=1, rows=1):
+            res = self.client().get('/candidates/1')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -253,7 +463,8 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_get_candidate_by_id(self):
         '''Tests error 404 when id is not valid'''
-        res = self.client().get('/candidates/10000')
+        with query_budget(queries=1, rows=0):
+            res = self.client().get('/candidates/10000')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -265,16 +476,26 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_get_vacancies(self):
         '''Tests successful request to get vacancies'''
-        res = self.client().get('/vacancies')
+        with query_budget(queries=2):
+            res = self.client().get('/vacancies')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['vacancies'])
 
+    def test_get_vacancies_query_budget_with_10_vacancies(self):
+        '''Tests the query budget of getting 10 vacancies'''
+        self.check_get_vacancies_budget(10)
+
+    def test_get_vacancies_query_budget_with_1000_vacancies(self):
+        '''Tests the query budget of getting 1000 vacancies'''
+        self.check_get_vacancies_budget(1000)
+
     def test_error_404_not_found_when_get_vacancies(self):
         '''Test error 400 when get vacancies with incorrect route'''
-        res = self.client().get('/vacancy')
+        with query_budget(queries=0):
+            res = self.client().get('/vacancy')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -283,7 +504,8 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_get_vacancy_by_id(self):
         '''Tests successful request to get a vacancy by id'''
-        res = self.client().get('/vacancies/1')
+        with query_budget(queries=1, rows=2):
+            res = self.client().get('/vacancies/1')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -292,22 +514,86 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_get_vacancy_by_id(self):
         '''Tests error 404 when id is not valid'''
-        res = self.client().get('/vacancies/10000')
+        with query_budget(queries=1, rows=0):
+            res = self.client().get('/vacancies/10000')
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Not found')
 
+    def test_get_vacancies_by_ids(self):
+        '''Tests getting several vacancies by id in one query'''
+        with query_budget(queries=1, rows=3):
+            res = self.client().get('/vacancies?ids=2,10000,1,2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([vacancy['id'] for vacancy in data['vacancies']],
+                         [2, 1])
+        self.assertEqual(data['missing'], [10000])
+
+    def test_get_candidates_by_ids(self):
+        '''Tests getting several candidates by id in request order'''
+        with query_budget(queries=1, rows=2):
+            res = self.client().get('/candidates?ids=2,1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([candidate['id'] for candidate in data['candidates']],
+                         [2, 1])
+        self.assertEqual(data['missing'], [])
+
+    def test_get_vacancies_with_fields_and_includes(self):
+        '''Tests selected fields and includes loaded with one query each'''
+        with query_budget(queries=3):
+            res = self.client().get('/vacancies?fields=job_title'
+                                    '&include=company,application_count')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        for vacancy in data['vacancies']:
+            self.assertEqual(
+                sorted(vacancy),
+                ['application_count', 'company', 'id', 'job_title'])
+            self.assertEqual(vacancy['company']['id'], 1)
+            self.assertEqual(vacancy['application_count'], 1)
+
+    def test_error_400_when_get_unknown_fields(self):
+        '''Tests error 400 for unknown fields or includes'''
+        for path in ['/companies/1?fields=name,password',
+                     '/vacancies?include=candidates']:
+            with query_budget(queries=0):
+                res = self.client().get(path)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    def test_error_400_when_get_by_invalid_ids(self):
+        '''Tests error 400 for invalid or too many ids'''
+        too_many = ','.join(str(id) for id in range(1, 102))
+        for path in ['/companies?ids=1,a', '/companies?ids=' + too_many,
+                     '/candidates']:
+            with query_budget(queries=0):
+                res = self.client().get(path)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
     '''
     Application
     '''
     def test_get_applications_by_candidate_id(self):
         '''Tests successful request for applications by candidate id'''
-        res = self.client().get('/candidates/1/applications',
-                                headers={
-                                    'Authorization': 'Bearer '
-                                    + self.test_user_candidate})
+        with query_budget(queries=1):
+            res = self.client().get('/candidates/1/applications',
+                                    headers={
+                                        'Authorization': 'Bearer '
+                                        + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -315,10 +601,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_get_applications_by_candidate_id(self):
         '''Tests error 404 when getting applications by invalid candidate id'''
-        res = self.client().get('/candidates/1000/applications',
-                                headers={
-                                    'Authorization': 'Bearer '
-                                    + self.test_user_candidate})
+        with query_budget(queries=1, rows=0):
+            res = self.client().get('/candidates/1000/applications',
+                                    headers={
+                                        'Authorization': 'Bearer '
+                                        + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -327,10 +614,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_get_applications_by_vacancy_id(self):
         '''Tests successful request of applications by vacancy id'''
-        res = self.client().get('/vacancies/1/applications',
-                                headers={
-                                    'Authorization': 'Bearer '
-                                    + self.test_user_company})
+        with query_budget(queries=1):
+            res = self.client().get('/vacancies/1/applications',
+                                    headers={
+                                        'Authorization': 'Bearer '
+                                        + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -338,10 +626,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_404_not_found_when_get_applications_by_vacancy_id(self):
         '''Tests error 404 when getting applications by invalid vacancy id'''
-        res = self.client().get('/vacancies/1000/applications',
-                                headers={
-                                    'Authorization': 'Bearer '
-                                    + self.test_user_company})
+        with query_budget(queries=1, rows=0):
+            res = self.client().get('/vacancies/1000/applications',
+                                    headers={
+                                        'Authorization': 'Bearer '
+                                        + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -357,22 +646,55 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_update_company_by_id(self):
         '''Tests successful update of company information by id'''
-        res = self.client().patch('/companies/1', json=self.edit_company,
-                                  headers={
-                                      'Authorization': 'Bearer '
-                                      + self.test_user_company})
+        # the rename is copied to the vacancies with one more UPDATE
+        with query_budget(queries=3, rows=1):
+            res = self.client().patch('/companies/1', json=self.edit_company,
+                                      headers={
+                                          'Authorization': 'Bearer '
+                                          + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['id'], 1)
 
+    def test_company_name_of_vacancies_after_rename_and_delete(self):
+        '''Tests that the vacancies keep the current company name'''
+        headers = {'Authorization': 'Bearer ' + self.test_user_company}
+        self.client().patch('/companies/1', json={'name': 'Alphabet'},
+                            headers=headers)
+        res = self.client().delete('/companies/1', headers=headers)
+        # the request session is shared with the test and kept the failure
+        db.session.rollback()
+        with query_budget(queries=1):
+            data = json.loads(self.client().get('/vacancies').data)
+        stored = db.session.query(Vacancy.company_name).distinct().all()
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(
+            [vacancy['company_name'] for vacancy in data['vacancies']],
+            ['Alphabet', 'Alphabet'])
+        self.assertEqual(stored, [('Alphabet',)])
+
+    def test_company_name_of_new_vacancy(self):
+        '''Tests that a new vacancy gets the name of its company'''
+        res = self.client().post('/vacancies', json=self.new_vacancy,
+                                 headers={'Authorization': 'Bearer '
+                                          + self.test_user_company})
+        data = json.loads(self.client().get('/vacancies').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['vacancies']), 3)
+        self.assertEqual(data['vacancies'][-1]['company_name'], 'Google')
+
     def test_error_404_not_found_when_update_company(self):
         '''Test error 404 when trying to edit inexisting company id'''
-        res = self.client().patch('/companies/1000', json=self.edit_company,
-                                  headers={
-                                      'Authorization': 'Bearer '
-                                      + self.test_user_company})
+        with query_budget(queries=1, rows=0):
+            res = self.client().patch('/companies/1000',
+                                      json=self.edit_company,
+                                      headers={
+                                          'Authorization': 'Bearer '
+                                          + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 404)
@@ -384,10 +706,12 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_update_candidate_by_id(self):
         '''Tests successful update of a candidate information by id'''
-        res = self.client().patch('/candidates/1', json=self.edit_candidate,
-                                  headers={
-                                      'Authorization': 'Bearer '
-                                      + self.test_user_candidate})
+        with query_budget(queries=2, rows=1):
+            res = self.client().patch('/candidates/1',
+                                      json=self.edit_candidate,
+                                      headers={
+                                          'Authorization': 'Bearer '
+                                          + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
@@ -396,10 +720,12 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_422_unprocessable_when_update_candidate(self):
         '''Test error 422 when trying to edit inexisting candidate id'''
-        res = self.client().patch('/candidates/1000', json=self.edit_candidate,
-                                  headers={
-                                      'Authorization': 'Bearer '
-                                      + self.test_user_candidate})
+        with query_budget(queries=1, rows=0):
+            res = self.client().patch('/candidates/1000',
+                                      json=self.edit_candidate,
+                                      headers={
+                                          'Authorization': 'Bearer '
+                                          + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -411,22 +737,47 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_update_vacancy_by_id(self):
         '''Tests successful update of a vacancy information by id'''
-        res = self.client().patch('/vacancies/1', json=self.edit_vacancy,
-                                  headers={
-                                      'Authorization': 'Bearer '
-                                      + self.test_user_company})
+        with query_budget(queries=2, rows=1):
+            res = self.client().patch('/vacancies/1', json=self.edit_vacancy,
+                                      headers={
+                                          'Authorization': 'Bearer '
+                                          + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['id'], 1)
 
+    def test_update_vacancy_with_compressed_text(self):
+        '''Tests that long texts are stored compressed and read back'''
+        description = 'Build and run the services of the job portal. ' * 20
+        CompressedText.threshold = 100
+        try:
+            res = self.client().patch('/vacancies/1',
+                                      json={'job_description': description},
+                                      headers={
+                                          'Authorization': 'Bearer '
+                                          + self.test_user_company})
+        finally:
+            CompressedText.threshold = 0
+        stored = db.session.execute(
+            'SELECT job_description FROM vacancies WHERE id = 1').scalar()
+        with query_budget(queries=1):
+            data = json.loads(self.client().get('/vacancies/1').data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(stored.startswith(CompressedText.MARKER))
+        self.assertLess(len(stored), len(description))
+        self.assertEqual(data['vacancy']['job_description'], description)
+
     def test_error_422_unprocessable_when_update_vacancy(self):
         '''Test error 422 when vacancy id is not valid'''
-        res = self.client().patch('/vacancies/1000', json=self.edit_vacancy,
-                                  headers={
-                                      'Authorization': 'Bearer '
-                                      + self.test_user_company})
+        with query_budget(queries=1, rows=0):
+            res = self.client().patch('/vacancies/1000',
+                                      json=self.edit_vacancy,
+                                      headers={
+                                          'Authorization': 'Bearer '
+                                          + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -442,23 +793,328 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_delete_application(self):
         '''Tests successful deleting of an application'''
-        res = self.client().delete('/applications/1',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_candidate})
+        # plus the counters of the vacancy, company and candidate and the
+        # rollup of the day
+        with query_budget(queries=7, rows=1):
+            res = self.client().delete('/applications/1',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['id'], 1)
 
+    def application_counts(self):
+        return [db.session.query(model.application_count).filter(
+            model.id == 1).scalar() for model in (Vacancy, Company, Candidate)]
+
+    def test_application_counters(self):
+        '''Tests the counters after adding and deleting applications'''
+        candidate = {'Authorization': 'Bearer ' + self.test_user_candidate}
+        self.client().post('/vacancies/1/applications',
+                           json=self.new_application, headers=candidate)
+        added = self.application_counts()
+        self.client().delete('/applications/1', headers=candidate)
+        with query_budget(queries=1):
+            res = self.client().get('/candidates/1/applications',
+                                    headers=candidate)
+        data = json.loads(res.data)
+
+        self.assertEqual(added, [2, 3, 2])
+        self.assertEqual(self.application_counts(), [1, 2, 2])
+        self.assertEqual(data['number_applications'], 2)
+        self.assertEqual(len(data['applications_list']), 2)
+
+    def test_reconcile_application_counts(self):
+        '''Tests that reconciling repairs counters after bulk deletes'''
+        self.delete_where(Application, Application.vacancy_id == 1)
+        drifted = self.application_counts()
+        repaired = reconcile_application_counts(db.session)
+
+        self.assertEqual(drifted, [1, 2, 1])
+        self.assertEqual(repaired, 3)
+        self.assertEqual(self.application_counts(), [0, 1, 1])
+
+    def rollups(self):
+        return sorted(tuple(row) for row in db.session.query(
+            ApplicationRollup.company_id, ApplicationRollup.vacancy_id,
+            ApplicationRollup.day, ApplicationRollup.applications,
+            ApplicationRollup.first_submitted).all())
+
+    def test_get_company_stats(self):
+        '''Tests the hiring statistics read from the rollups'''
+        self.client().post('/vacancies/1/applications',
+                           json=self.new_application,
+                           headers={'Authorization': 'Bearer '
+                                    + self.test_user_candidate})
+        with query_budget(queries=3):
+            res = self.client().get('/companies/1/stats',
+                                    headers={'Authorization': 'Bearer '
+                                             + self.test_user_company})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [(vacancy['vacancy_id'], vacancy['applications'])
+             for vacancy in data['vacancies']], [(1, 2), (2, 1)])
+        self.assertGreaterEqual(
+            data['vacancies'][0]['first_application_seconds'], 0)
+        self.assertEqual(
+            sum(day['applications'] for day in data['applications_per_day']),
+            3)
+
+    def test_rollups_match_rebuild_after_delete(self):
+        '''Tests that incremental rollups equal the rebuilt ones'''
+        self.client().delete('/applications/1',
+                             headers={'Authorization': 'Bearer '
+                                      + self.test_user_candidate})
+        incremental = self.rollups()
+        rebuild_application_rollups(db.session)
+
+        self.assertEqual([row[:2] for row in incremental], [(1, 2)])
+        self.assertEqual(incremental, self.rollups())
+
+    def test_error_404_not_found_when_get_company_stats(self):
+        '''Tests error 404 for the statistics of an unknown company'''
+        res = self.client().get('/companies/1000/stats',
+                                headers={'Authorization': 'Bearer '
+                                         + self.auth.company_token(
+                                             company_id=1000)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_error_403_when_get_stats_of_other_company(self):
+        '''Tests error 403 for the statistics of a company which the
+        token is not issued for'''
+        res = self.client().get('/companies/1/stats',
+                                headers={'Authorization': 'Bearer '
+                                         + self.auth.company_token(
+                                             company_id=2)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['code'], 'forbidden')
+
+    def test_get_vacancy_facets(self):
+        '''Tests the facet counts, which ignore the filter of the facet'''
+        facets = self.app.extensions['vacancy_facets']
+        facets.invalidate()
+        Vacancy.query.get(1).min_salary = 60000
+        Vacancy.query.get(2).city = 'Oakland'
+        db.session.flush()
+        with query_budget(queries=1):
+            res = self.client().get('/vacancies/facets?city=Oakland')
+        with query_budget(queries=0):
+            self.client().get('/vacancies/facets?salary=50000-75000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['facets']['city'], [
+            {'value': 'Oakland', 'count': 1},
+            {'value': 'San Francisco', 'count': 1}])
+        self.assertEqual(data['facets']['industry'],
+                         [{'value': 'IT', 'count': 1}])
+        self.assertEqual(data['facets']['salary'], [])
+        facets.invalidate()
+
+    def test_error_400_when_get_facets_of_unknown_salary(self):
+        '''Tests error 400 for a salary bucket that does not exist'''
+        res = self.client().get('/vacancies/facets?salary=1-2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_autocomplete_job_titles(self):
+        '''Tests that the most frequent titles are completed first'''
+        self.app.extensions['autocomplete'].built.clear()
+        self.addCleanup(self.app.extensions['autocomplete'].built.clear)
+        db.session.execute(Vacancy.__table__.insert(), [
+            dict(self.new_vacancy, job_title='Data  analyst')
+            for _ in range(2)])
+        with query_budget(queries=1):
+            res = self.client().get('/autocomplete?q=DATA')
+        with query_budget(queries=0):
+            self.client().get('/autocomplete?q=full')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [
+            {'value': 'Data  analyst', 'count': 2},
+            {'value': 'Data Engineer', 'count': 1}])
+
+    def test_autocomplete_after_update(self):
+        '''Tests that committed changes are applied to the index'''
+        autocomplete = self.app.extensions['autocomplete']
+        autocomplete.built.clear()
+        self.addCleanup(autocomplete.built.clear)
+        self.client().get('/autocomplete?q=google&type=company')
+        Company.query.get(1).name = 'Alphabet'
+        db.session.flush()
+        autocomplete.refresh('company', [('update', 1)], db.session)
+        res = self.client().get('/autocomplete?q=al&type=company')
+        data = json.loads(res.data)
+        other = json.loads(self.client().get(
+            '/autocomplete?q=google&type=company').data)
+
+        self.assertEqual(data['results'], [{'value': 'Alphabet', 'count': 1}])
+        self.assertEqual(other['results'], [])
+
+    def test_autocomplete_recency_after_remove(self):
+        '''Tests that a value is ranked by its newest remaining row'''
+        index = PrefixIndex(Vacancy.__table__.c.job_title)
+        index.build([(1, 'Data steward'), (2, 'Data scientist'),
+                     (3, 'Data steward')])
+        index.remove(3)
+
+        self.assertEqual(index.search('data'), [
+            {'value': 'Data scientist', 'count': 1},
+            {'value': 'Data steward', 'count': 1}])
+
+    def test_autocomplete_last_code_point(self):
+        '''Tests prefixes ending in U+10FFFF, which has no successor'''
+        index = PrefixIndex(Vacancy.__table__.c.job_title)
+        index.build([(1, 'Data \U0010ffff'), (2, 'Data \U0010ffffx'),
+                     (3, 'Datb')])
+        self.addCleanup(self.app.extensions['autocomplete'].built.clear)
+        res = self.client().get('/autocomplete?q=%F4%8F%BF%BF')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [])
+        self.assertEqual(index.search('data \U0010ffff'), [
+            {'value': 'Data \U0010ffffx', 'count': 1},
+            {'value': 'Data \U0010ffff', 'count': 1}])
+
+    def test_error_400_when_autocomplete_unknown_type(self):
+        '''Tests error 400 for an unknown type of autocomplete'''
+        res = self.client().get('/autocomplete?q=a&type=city')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_similar_vacancies(self):
+        '''Tests that near duplicates are found and flagged'''
+        index = self.app.extensions['similar_vacancies']
+        index.built = False
+        self.addCleanup(setattr, index, 'built', False)
+        description = 'We are looking for an engineer who builds data ' \
+            'pipelines with Python and SQL and keeps them running.'
+        db.session.execute(Vacancy.__table__.insert(), [
+            dict(self.new_vacancy, job_title='Data Engineer',
+                 job_description=description),
+            dict(self.new_vacancy, job_title='Data Engineer',
+                 job_description=description, city='Oakland'),
+            dict(self.new_vacancy, job_title='Nurse',
+                 job_description='Night shifts in a small hospital.')])
+        ids = [vacancy.id for vacancy in Vacancy.query.filter(
+            Vacancy.job_description.isnot(None)).order_by(Vacancy.id)]
+        res = self.client().get('/vacancies/%d/similar' % ids[0])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([vacancy['id'] for vacancy in data['similar']],
+                         [ids[1]])
+        self.assertTrue(data['similar'][0]['near_duplicate'])
+
+    def test_error_404_not_found_when_get_similar_vacancies(self):
+        '''Tests error 404 for the similar vacancies of an unknown id'''
+        res = self.client().get('/vacancies/1000/similar')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_vacancy_changes(self):
+        '''Tests that a delta sync returns only the changed vacancies'''
+        headers = {'Authorization': 'Bearer ' + self.test_user_company}
+        first = json.loads(self.client().get('/vacancies/changes').data)
+        self.client().patch('/vacancies/2', json=self.edit_vacancy,
+                            headers=headers)
+        self.client().post('/vacancies', json=self.new_vacancy,
+                           headers=headers)
+        new_id = db.session.query(db.func.max(Vacancy.id)).scalar()
+        self.client().delete('/vacancies/%d' % new_id, headers=headers)
+        with query_budget(queries=2):
+            res = self.client().get('/vacancies/changes?since='
+                                    + first['cursor'])
+        data = json.loads(res.data)
+
+        self.assertEqual([vacancy['id'] for vacancy in first['vacancies']],
+                         [1, 2])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([vacancy['id'] for vacancy in data['vacancies']],
+                         [2])
+        self.assertEqual(data['vacancies'][0]['min_salary'], 100000)
+        self.assertEqual(data['deleted'], [new_id])
+        self.assertEqual(data['has_more'], False)
+
+    def test_get_company_changes_in_pages(self):
+        '''Tests that the cursor of a full page continues after it'''
+        Company(**dict(self.new_company, phone=None, logo_link=None)).insert()
+        first = json.loads(
+            self.client().get('/companies/changes?limit=1').data)
+        second = json.loads(self.client().get(
+            '/companies/changes?limit=1&since=' + first['cursor']).data)
+
+        self.assertEqual(first['has_more'], True)
+        self.assertEqual([company['id'] for company in first['companies']]
+                         + [company['id'] for company in second['companies']],
+                         [1, 2])
+        self.assertEqual(second['has_more'], False)
+
+    def test_error_410_when_get_changes_since_expired_cursor(self):
+        '''Tests error 410 for a cursor older than the tombstones'''
+        res = self.client().get('/vacancies/changes?since=' + encode_cursor(
+            datetime(2000, 1, 1), DONE, 0))
+        data = json.loads(res.data)
+        invalid = self.client().get('/vacancies/changes?since=abc')
+
+        self.assertEqual(res.status_code, 410)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_get_salary_stats(self):
+        '''Tests the salary statistics computed from the snapshot'''
+        for vacancy_id, salary in ((1, 100000), (2, 60000)):
+            Vacancy.query.get(vacancy_id).min_salary = salary
+        db.session.flush()
+        self.app.extensions['salary_stats'].refresh()
+        res = self.client().get('/stats/salaries?city=San%20Francisco'
+                                '&industry=IT')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['city'], 'San Francisco')
+        self.assertIsNone(data['region'])
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['mean'], 80000)
+        self.assertEqual((data['p10'], data['p50'], data['p90']),
+                         (64000, 80000, 96000))
+
+    def test_get_salary_stats_of_unknown_city(self):
+        '''Tests empty salary statistics for a city without vacancies'''
+        res = self.client().get('/stats/salaries?city=Atlantis')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['count'], 0)
+        self.assertIsNone(data['p50'])
+
     def test_error_422_when_deleting_application(self):
         '''Tests error 422 when deleting application
         by invalid application id'''
-        res = self.client().delete('/applications/1000',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_candidate})
+        with query_budget(queries=1, rows=0):
+            res = self.client().delete('/applications/1000',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -470,10 +1126,13 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_delete_vacancy_by_id(self):
         '''Tests successful deleting of a vacancy by id'''
-        res = self.client().delete('/vacancies/1',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_company})
+        self.delete_where(Application, Application.vacancy_id == 1)
+        # plus the tombstone of the vacancy
+        with query_budget(queries=4):
+            res = self.client().delete('/vacancies/1',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_company})
         data = json.loads(res.data)
         vacancy = Vacancy.query.filter(Vacancy.id == 1).one_or_none()
 
@@ -484,10 +1143,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_422_unprocessable_when_delete_vacancy(self):
         '''Tests error 422 when vacancy id does not exist'''
-        res = self.client().delete('/vacancies/1000',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_company})
+        with query_budget(queries=1, rows=0):
+            res = self.client().delete('/vacancies/1000',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -499,10 +1159,14 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_delete_company_by_id(self):
         '''Tests successful deleting of a company by id'''
-        res = self.client().delete('/companies/1',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_company})
+        self.delete_where(Application, Application.company_id == 1)
+        self.delete_where(Vacancy, Vacancy.company_id == 1)
+        # plus the tombstone of the company
+        with query_budget(queries=5):
+            res = self.client().delete('/companies/1',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_company})
         data = json.loads(res.data)
         company = Company.query.filter(Company.id == 1).one_or_none()
 
@@ -513,10 +1177,11 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_422_unprocessable_when_delete_company(self):
         '''Tests error 422 when company id does not exist'''
-        res = self.client().delete('/companies/1000',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_company})
+        with query_budget(queries=1, rows=0):
+            res = self.client().delete('/companies/1000',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_company})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
@@ -528,10 +1193,12 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_delete_candidate_by_id(self):
         '''Tests successful deleting of a candidate profile by id'''
-        res = self.client().delete('/candidates/1',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_candidate})
+        self.delete_where(Application, Application.candidate_id == 1)
+        with query_budget(queries=3):
+            res = self.client().delete('/candidates/1',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_candidate})
         data = json.loads(res.data)
         candidate = Candidate.query.filter(Candidate.id == 1).one_or_none()
 
@@ -542,16 +1209,184 @@ class JobPortalTestCase(unittest.TestCase):
 
     def test_error_422_unprocessable_when_delete_candidate(self):
         '''Tests error 422 when candidate id does not exist'''
-        res = self.client().delete('/candidates/1000',
-                                   headers={
-                                       'Authorization': 'Bearer '
-                                       + self.test_user_candidate})
+        with query_budget(queries=1, rows=0):
+            res = self.client().delete('/candidates/1000',
+                                       headers={
+                                           'Authorization': 'Bearer '
+                                           + self.test_user_candidate})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unprocessable')
 
+    '''
+    BATCH
+    '''
+    def test_batch(self):
+        '''Tests a batch of requests sent in one round trip'''
+        with query_budget(queries=4):
+            res = self.client().post('/batch', json={'requests': [
+                {'method': 'GET', 'path': '/companies/1'},
+                {'method': 'PATCH', 'path': '/vacancies/1',
+                 'body': self.edit_vacancy},
+                {'method': 'GET', 'path': '/companies/10000'}
+            ]}, headers={'Authorization': 'Bearer '
+                         + self.test_user_company})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], False)
+        self.assertEqual([response['status']
+                          for response in data['responses']],
+                         [200, 200, 404])
+        self.assertEqual(data['responses'][0]['body']['company']['id'], 1)
+        self.assertEqual(Vacancy.query.get(1).min_salary, 100000)
+
+    def test_batch_transaction_is_rolled_back(self):
+        '''Tests that no request of a failed transactional batch
+        is committed'''
+        res = self.client().post('/batch', json={
+            'transaction': True,
+            'requests': [
+                {'method': 'POST', 'path': '/vacancies',
+                 'body': dict(self.new_vacancy, job_title='Batch')},
+                {'method': 'DELETE', 'path': '/companies/1'},
+                {'method': 'GET', 'path': '/companies/1'}
+            ]}, headers={'Authorization': 'Bearer '
+                         + self.test_user_company})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], False)
+        self.assertEqual([response['status']
+                          for response in data['responses']], [200, 422])
+        self.assertEqual(Vacancy.query.filter(
+            Vacancy.job_title == 'Batch').count(), 0)
+
+    def test_error_400_bad_request_when_batch_is_empty(self):
+        '''Tests error 400 when a batch contains no requests'''
+        res = self.client().post('/batch', json={'requests': []})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
+    '''
+    METRICS
+    '''
+    def test_get_metrics(self):
+        '''Tests that served requests are exported on /metrics'''
+        self.client().get('/companies')
+        res = self.client().get('/metrics')
+        body = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('text/plain', res.headers['Content-Type'])
+        self.assertIn('jobportal_http_requests_total{method="GET",'
+                      'route="/companies",status="200"}', body)
+        self.assertIn('jobportal_http_request_duration_seconds_bucket{'
+                      'method="GET",route="/companies",status="200",'
+                      'le="+Inf"}', body)
+
+    def test_metrics_of_exited_workers_are_folded(self):
+        '''Tests that folding the snapshots of exited workers keeps the
+        totals and leaves one file'''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        worker = Metrics()
+        worker.inc('http_requests_total', {'route': '/'}, 2)
+        worker.observe('http_request_duration_seconds', LATENCY_BUCKETS,
+                       {'route': '/'}, 0.1)
+        for pid in (1001, 1002):
+            with open(os.path.join(directory,
+                                   'metrics-%d.json' % pid), 'w') as f:
+                json.dump(dict(worker.snapshot(), pid=pid), f)
+        scraper = Metrics()
+        scraper.directory = directory
+        before = scraper.render()
+        fold_snapshot(directory, 1001)
+        fold_snapshot(directory, 1002)
+
+        self.assertIn('jobportal_http_requests_total{route="/"} 4', before)
+        self.assertEqual(scraper.render(), before)
+        self.assertEqual(os.listdir(directory), ['metrics-dead.json'])
+
+    '''
+    ADMISSION CONTROL
+    '''
+    def create_limited_app(self, limits):
+        '''Creates an app which applies `limits` instead of the defaults'''
+        return create_app({'DATABASE_URL': TEST_DATABASE_URL,
+                           'ADMISSION_LIMITS': limits})
+
+    def test_error_429_too_many_requests(self):
+        '''Tests error 429 when a client has used up its rate limit'''
+        client = self.create_limited_app(
+            {'GET /': {'rate': 1, 'burst': 2}}).test_client()
+        for _ in range(2):
+            self.assertEqual(client.get('/').status_code, 200)
+        res = client.get('/')
+        data = json.loads(res.data)
+        # the route does not verify tokens, so they get no bucket of their
+        # own
+        other = client.get('/', headers={
+            'Authorization': 'Bearer ' + self.test_user_company})
+        body = client.get('/metrics').data.decode()
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Too many requests')
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(other.status_code, 429)
+        self.assertIn('jobportal_admission_shed_total{method="GET",'
+                      'reason="rate",route="/"}', body)
+
+    def test_error_429_when_batch_exceeds_rate_limit(self):
+        '''Tests that the requests of a batch count against the rate
+        limit of their route'''
+        client = self.create_limited_app(
+            {'GET /': {'rate': 1, 'burst': 2}}).test_client()
+        res = client.post('/batch', json={'requests': [
+            {'method': 'GET', 'path': '/'} for _ in range(3)]})
+        data = json.loads(res.data)
+
+        self.assertEqual([response['status']
+                          for response in data['responses']],
+                         [200, 200, 429])
+        self.assertEqual(data['success'], False)
+        self.assertEqual(client.get('/').status_code, 429)
+
+    def test_admission_buckets_are_bounded(self):
+        '''Tests that the least recently seen clients are dropped'''
+        import admission
+        self.addCleanup(setattr, admission, 'MAX_CLIENTS',
+                        admission.MAX_CLIENTS)
+        admission.MAX_CLIENTS = 2
+        limit = admission.RouteLimit(rate=1, burst=1)
+        for client in ('addr:1', 'addr:2', 'addr:1', 'addr:3'):
+            limit.take(client, 0.0)
+
+        self.assertEqual(list(limit.buckets), ['addr:1', 'addr:3'])
+
+    def test_error_503_when_route_is_busy(self):
+        '''Tests error 503 when all slots of a route are in use'''
+        app = self.create_limited_app({'GET /': {'concurrency': 1}})
+        limit = app.extensions['admission'].limits['GET /']
+        self.assertTrue(limit.acquire(0))
+        try:
+            res = app.test_client().get('/')
+        finally:
+            limit.release()
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Service unavailable')
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(app.test_client().get('/').status_code, 200)
+
     '''
     RBAC TEST
     '''
@@ -560,8 +1395,9 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_error_401_token_not_found_company(self):
         '''Tests error 401 when token is not provided for company user'''
-        res = self.client().post('/companies', json=self.new_company,
-                                 headers={'Authorization': 'Bearer'})
+        with query_budget(queries=0):
+            res = self.client().post('/companies', json=self.new_company,
+                                     headers={'Authorization': 'Bearer'})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 401)
@@ -571,7 +1407,8 @@ class JobPortalTestCase(unittest.TestCase):
     def test_error_401_no_authorization_header_company(self):
         '''Tests error 401 when authorization
         header is missing for company user'''
-        res = self.client().post('/companies', json=self.new_company)
+        with query_budget(queries=0):
+            res = self.client().post('/companies', json=self.new_company)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 401)
@@ -584,8 +1421,9 @@ class JobPortalTestCase(unittest.TestCase):
     '''
     def test_error_401_token_not_found_candidate(self):
         '''Tests error 401 when token is not provided for candidate user'''
-        res = self.client().post('/candidates', json=self.new_candidate,
-                                 headers={'Authorization': 'Bearer'})
+        with query_budget(queries=0):
+            res = self.client().post('/candidates', json=self.new_candidate,
+                                     headers={'Authorization': 'Bearer'})
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 401)
@@ -595,8 +1433,9 @@ class JobPortalTestCase(unittest.TestCase):
     def test_error_401_no_authorization_header_candidate(self):
         '''Tests error 401 when authorization header
         is missing for candidate user'''
-        res = self.client().post('/candidates',
-                                 json=self.new_candidate)
+        with query_budget(queries=0):
+            res = self.client().post('/candidates',
+                                     json=self.new_candidate)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 401)
@@ -606,8 +1445,8 @@ class JobPortalTestCase(unittest.TestCase):
 
 
 def suite():
-    '''The suite allows to customize order of execution of test cases because
-    some of them depend on specific state in the database.'''
+    '''The suite runs the test cases in the order of the API documentation;
+    each of them starts from the same seeded database.'''
     suite = unittest.TestSuite()
     suite.addTest(JobPortalTestCase('test_add_new_company'))
     suite.addTest(JobPortalTestCase(
@@ -621,6 +1460,14 @@ def suite():
     suite.addTest(JobPortalTestCase('test_add_new_application'))
     suite.addTest(JobPortalTestCase(
         'test_error_406_not_acceptable_when_post_application'))
+    suite.addTest(JobPortalTestCase(
+        'test_retry_application_with_idempotency_key'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_401_when_idempotency_key_is_replayed_by_forged_token'))
+    suite.addTest(JobPortalTestCase(
+        'test_idempotency_key_of_dead_request_is_taken_over'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_422_when_idempotency_key_is_reused'))
     suite.addTest(JobPortalTestCase('test_get_companies'))
     suite.addTest(JobPortalTestCase(
         'test_error_404_not_found_when_get_companies'))
@@ -631,11 +1478,21 @@ def suite():
     suite.addTest(JobPortalTestCase(
         'test_error_404_not_found_when_get_candidate_by_id'))
     suite.addTest(JobPortalTestCase('test_get_vacancies'))
+    suite.addTest(JobPortalTestCase(
+        'test_get_vacancies_query_budget_with_10_vacancies'))
+    suite.addTest(JobPortalTestCase(
+        'test_get_vacancies_query_budget_with_1000_vacancies'))
     suite.addTest(JobPortalTestCase(
         'test_error_404_not_found_when_get_vacancies'))
     suite.addTest(JobPortalTestCase('test_get_vacancy_by_id'))
     suite.addTest(JobPortalTestCase(
         'test_error_404_not_found_when_get_vacancy_by_id'))
+    suite.addTest(JobPortalTestCase('test_get_vacancies_by_ids'))
+    suite.addTest(JobPortalTestCase('test_get_candidates_by_ids'))
+    suite.addTest(JobPortalTestCase(
+        'test_get_vacancies_with_fields_and_includes'))
+    suite.addTest(JobPortalTestCase('test_error_400_when_get_unknown_fields'))
+    suite.addTest(JobPortalTestCase('test_error_400_when_get_by_invalid_ids'))
     suite.addTest(JobPortalTestCase('test_get_applications_by_candidate_id'))
     suite.addTest(JobPortalTestCase(
         'test_error_404_not_found_when_get_applications_by_candidate_id'))
@@ -643,15 +1500,46 @@ def suite():
     suite.addTest(JobPortalTestCase(
         'test_error_404_not_found_when_get_applications_by_vacancy_id'))
     suite.addTest(JobPortalTestCase('test_update_company_by_id'))
+    suite.addTest(JobPortalTestCase(
+        'test_company_name_of_vacancies_after_rename_and_delete'))
+    suite.addTest(JobPortalTestCase('test_company_name_of_new_vacancy'))
     suite.addTest(JobPortalTestCase(
         'test_error_404_not_found_when_update_company'))
     suite.addTest(JobPortalTestCase('test_update_candidate_by_id'))
     suite.addTest(JobPortalTestCase(
         'test_error_422_unprocessable_when_update_candidate'))
     suite.addTest(JobPortalTestCase('test_update_vacancy_by_id'))
+    suite.addTest(JobPortalTestCase(
+        'test_update_vacancy_with_compressed_text'))
     suite.addTest(JobPortalTestCase(
         'test_error_422_unprocessable_when_update_vacancy'))
     suite.addTest(JobPortalTestCase('test_delete_application'))
+    suite.addTest(JobPortalTestCase('test_application_counters'))
+    suite.addTest(JobPortalTestCase('test_reconcile_application_counts'))
+    suite.addTest(JobPortalTestCase('test_get_company_stats'))
+    suite.addTest(JobPortalTestCase('test_rollups_match_rebuild_after_delete'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_404_not_found_when_get_company_stats'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_403_when_get_stats_of_other_company'))
+    suite.addTest(JobPortalTestCase('test_get_vacancy_facets'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_400_when_get_facets_of_unknown_salary'))
+    suite.addTest(JobPortalTestCase('test_autocomplete_job_titles'))
+    suite.addTest(JobPortalTestCase('test_autocomplete_after_update'))
+    suite.addTest(JobPortalTestCase('test_autocomplete_recency_after_remove'))
+    suite.addTest(JobPortalTestCase('test_autocomplete_last_code_point'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_400_when_autocomplete_unknown_type'))
+    suite.addTest(JobPortalTestCase('test_get_similar_vacancies'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_404_not_found_when_get_similar_vacancies'))
+    suite.addTest(JobPortalTestCase('test_get_vacancy_changes'))
+    suite.addTest(JobPortalTestCase('test_get_company_changes_in_pages'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_410_when_get_changes_since_expired_cursor'))
+    suite.addTest(JobPortalTestCase('test_get_salary_stats'))
+    suite.addTest(JobPortalTestCase('test_get_salary_stats_of_unknown_city'))
     suite.addTest(JobPortalTestCase(
         'test_error_422_when_deleting_application'))
     suite.addTest(JobPortalTestCase('test_delete_vacancy_by_id'))
@@ -663,6 +1551,18 @@ def suite():
     suite.addTest(JobPortalTestCase('test_delete_candidate_by_id'))
     suite.addTest(JobPortalTestCase(
         'test_error_422_unprocessable_when_delete_candidate'))
+    suite.addTest(JobPortalTestCase('test_batch'))
+    suite.addTest(JobPortalTestCase('test_batch_transaction_is_rolled_back'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_400_bad_request_when_batch_is_empty'))
+    suite.addTest(JobPortalTestCase('test_get_metrics'))
+    suite.addTest(JobPortalTestCase(
+        'test_metrics_of_exited_workers_are_folded'))
+    suite.addTest(JobPortalTestCase('test_error_429_too_many_requests'))
+    suite.addTest(JobPortalTestCase(
+        'test_error_429_when_batch_exceeds_rate_limit'))
+    suite.addTest(JobPortalTestCase('test_admission_buckets_are_bounded'))
+    suite.addTest(JobPortalTestCase('test_error_503_when_route_is_busy'))
     suite.addTest(JobPortalTestCase('test_error_401_token_not_found_company'))
     suite.addTest(JobPortalTestCase(
         'test_error_401_no_authorization_header_company'))
@@ -0,0 +1,270 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import httpx
+
+from app import create_app
+from asgi import create_asgi_app
+from auth_stub import LocalAuth
+from models import db
+
+# Set by the server at insert time, so they differ between the two runs
+VOLATILE_FIELDS = ('date_posted', 'date_submitted')
+
+
+def strip_volatile(value):
+    if isinstance(value, dict):
+        return {key: strip_volatile(item) for key, item in value.items()
+                if key not in VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [strip_volatile(item) for item in value]
+    return value
+
+
+class ASGIParityTestCase(unittest.TestCase):
+    '''Sends the same requests to create_app and create_asgi_app, each on
+    its own empty database, and expects the same responses.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.auth = LocalAuth().install()
+        cls.company = {'Authorization': 'Bearer ' + cls.auth.company_token()}
+        cls.candidate = {
+            'Authorization': 'Bearer ' + cls.auth.candidate_token()}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.auth.uninstall()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def setUp(self):
+        directory = tempfile.mkdtemp(dir=self.directory)
+        wsgi_url = 'sqlite:///' + os.path.join(directory, 'wsgi.db')
+        asgi_url = 'sqlite:///' + os.path.join(directory, 'asgi.db')
+        self.app = create_app({'DATABASE_URL': wsgi_url})
+        self.client = self.app.test_client()
+        # the ASGI app uses the same schema on its own file
+        for url in (wsgi_url, asgi_url):
+            with create_app({'DATABASE_URL': url}).app_context():
+                db.create_all()
+        self.asgi_app = create_asgi_app(asgi_url)
+
+    def assert_same(self, requests):
+        async def run():
+            await self.asgi_app.router.startup()
+            try:
+                async with httpx.AsyncClient(
+                        app=self.asgi_app, base_url='http://test') as client:
+                    for method, path, headers, body in requests:
+                        expected = self.client.open(
+                            path, method=method, headers=headers, json=body)
+                        actual = await client.request(
+                            method, path, headers=headers, json=body)
+                        label = '%s %s' % (method, path)
+                        self.assertEqual(actual.status_code,
+                                         expected.status_code, label)
+                        self.assertEqual(
+                            strip_volatile(actual.json()),
+                            strip_volatile(expected.get_json()), label)
+            finally:
+                await self.asgi_app.router.shutdown()
+
+        asyncio.run(run())
+
+    def test_same_responses(self):
+        company = {'name': 'Google', 'industry': 'IT', 'employee': 10000,
+                   'city': 'Mountain View', 'region': 'California',
+                   'seeking_employee': True}
+        candidate = {'name': 'Max', 'surname': 'Musterman'}
+        vacancy = {'job_title': 'Full-Stack Developer',
+                   'city': 'San Francisco', 'region': 'California',
+                   'company_id': 1}
+        application = {'company_id': 1, 'candidate_id': 1,
+                       'cover_letter': 'I am a perfect candidate'}
+        self.assert_same([
+            ('GET', '/', None, None),
+            ('POST', '/companies', self.company, company),
+            ('POST', '/companies', self.company, dict(company, name='Acme')),
+            ('POST', '/candidates', self.candidate, candidate),
+            ('POST', '/vacancies', self.company, vacancy),
+            ('POST', '/vacancies', self.company,
+             dict(vacancy, job_title='Backend Developer', company_id=2)),
+            ('GET', '/companies', None, None),
+            ('GET', '/companies/1', None, None),
+            ('GET', '/companies/100', None, None),
+            ('GET', '/candidates/1', None, None),
+            ('GET', '/vacancies', None, None),
+            ('GET', '/vacancies/2', None, None),
+            ('GET', '/vacancies/100', None, None),
+            ('PATCH', '/companies/1', self.company, {'name': 'Google Inc.'}),
+            ('PATCH', '/companies/100', self.company, {'name': 'Nobody'}),
+            ('PATCH', '/candidates/1', self.candidate, {'city': 'Berlin'}),
+            ('PATCH', '/vacancies/1', self.company, {'min_salary': 100000}),
+            ('POST', '/vacancies/1/applications', self.candidate,
+             application),
+            ('POST', '/vacancies/1/applications', self.candidate,
+             application),
+            ('POST', '/vacancies/100/applications', self.candidate,
+             application),
+            ('GET', '/candidates/1/applications', self.candidate, None),
+            ('GET', '/candidates/1/applications?page=2', self.candidate,
+             None),
+            ('GET', '/vacancies/1/applications', self.company, None),
+            ('GET', '/vacancies/2/applications', self.company, None),
+            ('POST', '/companies', None, company),
+            ('POST', '/companies', self.candidate, company),
+            ('DELETE', '/companies/2', self.candidate, None),
+            ('DELETE', '/vacancies/1', self.company, None),
+            ('DELETE', '/applications/1', self.candidate, None),
+            ('DELETE', '/applications/1', self.candidate, None),
+            ('DELETE', '/vacancies/1', self.company, None),
+            ('DELETE', '/candidates/1', self.candidate, None),
+            ('DELETE', '/candidates/1', self.candidate, None),
+            ('DELETE', '/vacancies/2', self.company, None),
+            ('DELETE', '/companies/2', self.company, None),
+            ('GET', '/vacancies', None, None)
+        ])
+
+
+class ASGIEventsTestCase(unittest.TestCase):
+    '''Reads the Server-Sent Events streams of create_asgi_app while
+    vacancies and applications are added through its routes.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.auth = LocalAuth().install()
+        cls.company = {'Authorization': 'Bearer ' + cls.auth.company_token()}
+        cls.candidate = {
+            'Authorization': 'Bearer ' + cls.auth.candidate_token()}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.auth.uninstall()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def setUp(self):
+        url = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(dir=self.directory), 'asgi.db')
+        with create_app({'DATABASE_URL': url}).app_context():
+            db.create_all()
+        self.asgi_app = create_asgi_app(url)
+
+    async def open_stream(self, path, query, headers=None):
+        '''Starts a streaming request; returns the queue of the received
+        body chunks and a function that disconnects the client'''
+        chunks = asyncio.Queue()
+        disconnected = asyncio.Event()
+        requested = []
+
+        async def receive():
+            if not requested:
+                requested.append(True)
+                return {'type': 'http.request', 'body': b'',
+                        'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                self.assertEqual(message['status'], 200)
+            elif message.get('body'):
+                await chunks.put(message['body'].decode())
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'},
+            'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'root_path': '',
+            'query_string': query.encode(), 'server': ('test', 80),
+            'client': ('test', 1234), 'headers': [
+                (key.lower().encode(), value.encode())
+                for key, value in (headers or {}).items()]
+        }
+        task = asyncio.ensure_future(self.asgi_app(scope, receive, send))
+        self.assertTrue((await chunks.get()).startswith('retry:'))
+
+        async def disconnect():
+            disconnected.set()
+            await task
+
+        return chunks, disconnect
+
+    def run_with_client(self, test):
+        async def run():
+            await self.asgi_app.router.startup()
+            try:
+                async with httpx.AsyncClient(
+                        app=self.asgi_app, base_url='http://test') as client:
+                    await test(client)
+            finally:
+                await self.asgi_app.router.shutdown()
+
+        asyncio.run(run())
+
+    def test_stream_new_vacancies_matching_filters(self):
+        async def test(client):
+            await client.post('/companies', headers=self.company,
+                              json={'name': 'Google'})
+            chunks, disconnect = await self.open_stream(
+                '/events/vacancies', 'city=Berlin&min_salary=50000')
+            for city, salary in (('Paris', 90000), ('Berlin', 40000),
+                                 ('Berlin', 60000)):
+                await client.post('/vacancies', headers=self.company, json={
+                    'job_title': 'Developer', 'city': city,
+                    'min_salary': salary, 'company_id': 1})
+            chunk = await asyncio.wait_for(chunks.get(), 5)
+            await disconnect()
+
+            self.assertTrue(chunk.startswith('event: vacancy\n'))
+            data = json.loads(chunk.split('data: ', 1)[1])
+            self.assertEqual((data['id'], data['city'], data['min_salary']),
+                             (3, 'Berlin', 60000))
+            self.assertTrue(chunks.empty())
+            self.assertEqual(
+                sum(len(streams) for streams in
+                    self.asgi_app.state.events.streams.values()), 0)
+
+        self.run_with_client(test)
+
+    def test_stream_new_applications_of_company(self):
+        async def test(client):
+            for name in ('Google', 'Acme'):
+                await client.post('/companies', headers=self.company,
+                                  json={'name': name})
+            await client.post('/candidates', headers=self.candidate,
+                              json={'name': 'Max'})
+            for company_id in (1, 2):
+                await client.post('/vacancies', headers=self.company,
+                                  json={'job_title': 'Developer',
+                                        'company_id': company_id})
+            unauthorized = await client.get('/events/applications')
+            # an accepted subscription would stream until the timeout
+            other_company = await asyncio.wait_for(client.get(
+                '/events/applications?company_id=2', headers=self.company), 5)
+            chunks, disconnect = await self.open_stream(
+                '/events/applications', 'company_id=2', {
+                    'Authorization': 'Bearer '
+                    + self.auth.company_token(company_id=2)})
+            for vacancy_id, company_id in ((1, 1), (2, 2)):
+                await client.post(
+                    '/vacancies/%d/applications' % vacancy_id,
+                    headers=self.candidate,
+                    json={'company_id': company_id, 'candidate_id': 1})
+            chunk = await asyncio.wait_for(chunks.get(), 5)
+            await disconnect()
+
+            self.assertEqual(unauthorized.status_code, 401)
+            self.assertEqual(other_company.status_code, 403)
+            data = json.loads(chunk.split('data: ', 1)[1])
+            self.assertEqual((data['id'], data['vacancy_id']), (2, 2))
+
+        self.run_with_client(test)
+
+
+if __name__ == "__main__":
+    unittest.main()
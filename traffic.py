@@ -0,0 +1,95 @@
+'''
+Opt-in capture of anonymized request shapes
+
+When TRAFFIC_CAPTURE_FILE is set, every request is appended to that file
+as one JSON line with its start time, method, route template, path
+parameters, query arguments, body size, status and duration. Headers,
+bodies and client addresses are never written. The file is rotated by
+size; a "{pid}" placeholder in the file name gives every worker process
+its own file. benchmarks/replay.py re-issues captured traffic.
+'''
+import json
+import logging
+import os
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+from flask import g, request
+
+CAPTURE_MAX_BYTES = 50 * 1024 * 1024
+CAPTURE_BACKUP_COUNT = 5
+# Query arguments whose values are never written
+REDACTED_ARGS = {'email', 'phone', 'token', 'access_token'}
+
+
+def _capture_logger(path, max_bytes, backup_count):
+    logger = logging.getLogger('jobportal.traffic.' + path)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                      backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+
+def _query_args():
+    args = {}
+    for key, values in request.args.lists():
+        if key.lower() in REDACTED_ARGS:
+            values = ['*'] * len(values)
+        args[key] = values
+    return args
+
+
+def setup_traffic_capture(app):
+    path = app.config.get('TRAFFIC_CAPTURE_FILE',
+                          os.environ.get('TRAFFIC_CAPTURE_FILE'))
+    if not path:
+        return
+
+    max_bytes = int(app.config.get('TRAFFIC_CAPTURE_MAX_BYTES',
+                                   CAPTURE_MAX_BYTES))
+    backup_count = int(app.config.get('TRAFFIC_CAPTURE_BACKUP_COUNT',
+                                      CAPTURE_BACKUP_COUNT))
+    loggers = {}
+    lock = threading.Lock()
+
+    def capture_logger():
+        # The file is opened by the process that serves the requests: with
+        # preload_app the app is created in the gunicorn master, and
+        # workers must not share (and rotate) the file opened there
+        pid = os.getpid()
+        logger = loggers.get(pid)
+        if logger is None:
+            with lock:
+                logger = loggers.get(pid)
+                if logger is None:
+                    logger = loggers[pid] = _capture_logger(
+                        path.format(pid=pid), max_bytes, backup_count)
+        return logger
+
+    @app.before_request
+    def start_capture():
+        g.capture_started = (time.time(), time.perf_counter())
+
+    @app.after_request
+    def capture_request(response):
+        started = g.pop('capture_started', None)
+        if started is None:
+            return response
+
+        rule = request.url_rule
+        capture_logger().info(json.dumps({
+            'ts': round(started[0], 6),
+            'method': request.method,
+            'route': rule.rule if rule is not None else None,
+            'view_args': request.view_args or {},
+            'args': _query_args(),
+            'body_bytes': request.content_length or 0,
+            'status': response.status_code,
+            'duration_ms': round(
+                (time.perf_counter() - started[1]) * 1000.0, 3)
+        }, sort_keys=True))
+        return response